@@ -0,0 +1,12 @@
+"""
+Benchmarks of DiskSnapshot. The bench_*.py scripts each measure one component;
+run.py times the generate, view and compare scenarios end to end on synthetic
+inputs (synthetic.py) and reports them as JSON.
+"""
+import sys
+from pathlib import Path
+
+# The modules under src are imported flat, as main.py does
+_SRC = str(Path(__file__).resolve().parent.parent / 'src')
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
@@ -0,0 +1,87 @@
+#!/usr/bin/python3 -u
+"""
+Size and speed of block snapshots: the records of a snapshot (or of a
+synthetic one) are written as plain records and with every available codec
+('none' only front-codes the paths), then
+each file is read in full (iter_records, read_snapshot) and probed with random
+path lookups.
+
+    > python bench_compress.py                  # synthetic snapshot of 200,000 entries
+    > python bench_compress.py some.snap --block-size 65536
+"""
+import sys
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import Snapshot
+from Snapshot import SnapshotReader, SnapshotFileWriter
+from SnapshotBlocks import COMPRESSION_CODECS, DEFAULT_BLOCK_SIZE
+
+def make_records(entries, seed=0):
+    # A directory every 20 entries, with the null hash, like a real walk
+    rnd = random.Random(seed)
+    records = []
+    for i in range(entries):
+        d = f'root/project{i // 5000}/src/module{i // 100 % 50}/pkg{i // 20 % 5}'
+        if i % 20 == 0:
+            records.append((Snapshot.ENTRY_TYPE_DIR, d.encode('utf-8'), 0, 1700000000 + i // 20, Snapshot.NULL_HASH))
+        else:
+            records.append((Snapshot.ENTRY_TYPE_FILE, f'{d}/source_file_{i}.py'.encode('utf-8'),
+                            rnd.randrange(1 << 16), 1700000000 + rnd.randrange(1 << 20), rnd.randbytes(32)))
+    return records
+
+def read_records(snap_file):
+    info = SnapshotReader(snap_file).read_info()
+    records = [(r.type, r.path_bytes, r.size, r.time, r.hash) for r in SnapshotReader(snap_file).iter_records()]
+    return records, info.hash_name
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser(description='Block snapshot size and speed')
+    parser.add_argument('snapshot', nargs='?', help='Snapshot whose records are used (default: synthetic records)')
+    parser.add_argument('--entries', type=int, default=200_000, help='Entries in the synthetic snapshot')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help='Uncompressed bytes per block')
+    parser.add_argument('--lookups', type=int, default=2000, help='Random path lookups per file')
+    args = parser.parse_args()
+
+    if args.snapshot:
+        records, hash_name = read_records(args.snapshot)
+    else:
+        records, hash_name = make_records(args.entries), 'sha256'
+    probes = [r[1].decode('utf-8') for r in random.Random(1).sample(records, min(args.lookups, len(records)))]
+    print(f'{len(records):,} records, block size {args.block_size:,} bytes')
+
+    plain_size = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for codec in [None] + list(COMPRESSION_CODECS):
+            name = codec or 'plain'
+            if codec and not COMPRESSION_CODECS[codec].available():
+                print(f'{name:>6}: skipped ({COMPRESSION_CODECS[codec].module} not installed)')
+                continue
+            snap_file = Path(tmp) / f'{name}.snap'
+            def write():
+                with snap_file.open('wb') as f:
+                    out = SnapshotFileWriter(f, hash_name=hash_name, compression=codec, block_size=args.block_size)
+                    out.write_records(records)
+                    out.finish()
+            write_time, _ = timed(write)
+            size = snap_file.stat().st_size
+            plain_size = plain_size or size
+            reader = SnapshotReader(snap_file)
+            iter_time, _ = timed(lambda: sum(1 for _ in reader.iter_records()))
+            dicts_time, _ = timed(reader.read_snapshot)
+            lookup_time, _ = timed(lambda: [reader.lookup(path) for path in probes])
+            print(f'{name:>6}: {size / 2**20:8.2f} MiB ({size / plain_size:6.1%}), '
+                  f'write {len(records) / write_time:>10,.0f}/s, iter_records {len(records) / iter_time:>10,.0f}/s, '
+                  f'read_snapshot {len(records) / dicts_time:>10,.0f}/s, lookup {len(probes) / lookup_time:>8,.0f}/s')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3 -u
+"""
+Throughput of the hash algorithms generate --hash can use, in GB/s: over an
+in-memory buffer (CPU bound) and through utils.hash_file over a file, which
+after the first run is read from the page cache.
+Algorithms whose package is not installed are listed as skipped.
+
+    > python bench_hash.py                  # 256 MiB of random data
+    > python bench_hash.py --size 1024 --runs 5
+    > python bench_hash.py --file /some/big.iso
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import utils
+from Snapshot import HASH_ALGORITHMS, DEFAULT_HASH_CHUNK_SIZE
+
+def hash_memory(algo, data, chunk_size):
+    hasher = algo.new()
+    view = memoryview(data)
+    for pos in range(0, len(data), chunk_size):
+        hasher.update(view[pos:pos + chunk_size])
+    return hasher.digest()
+
+def hash_path(algo, path, chunk_size):
+    return utils.hash_file(path, algo.new(), bytearray(chunk_size)).digest()
+
+def best_rate(func, size, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return size / best / 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description='Hash algorithm throughput')
+    parser.add_argument('--file', help='File to hash (default: a generated file of --size MiB)')
+    parser.add_argument('--size', type=int, default=256, help='MiB of random data to hash')
+    parser.add_argument('--runs', type=int, default=3, help='Timed runs per algorithm (best is reported)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_HASH_CHUNK_SIZE, help='Bytes per update() call')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.file
+        if not path:
+            path = str(Path(tmp) / 'bench.dat')
+            with open(path, 'wb') as f:
+                for _ in range(args.size):
+                    f.write(os.urandom(1 << 20))
+        data = Path(path).read_bytes()
+        print(f'Data: {path} ({len(data) / 2**20:,.0f} MiB), chunk size {args.chunk_size:,} bytes')
+        for name, algo in HASH_ALGORITHMS.items():
+            if not algo.digest_size:
+                continue
+            if not algo.available():
+                print(f'{name:>8}: skipped ({algo.module} not installed)')
+                continue
+            memory = best_rate(lambda: hash_memory(algo, data, args.chunk_size), len(data), args.runs)
+            file = best_rate(lambda: hash_path(algo, path, args.chunk_size), len(data), args.runs)
+            print(f'{name:>8}: {memory:6.2f} GB/s in memory, {file:6.2f} GB/s from file')
+
+if __name__ == "__main__":
+    main()
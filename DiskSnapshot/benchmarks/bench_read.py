@@ -0,0 +1,105 @@
+#!/usr/bin/python3 -u
+"""
+Records per second and peak RSS of the snapshot readers: the old
+f.read()-per-field reader, read_snapshot() (list of dicts) and iter_records()
+(mmap record views, with and without decoding paths) and read_table()
+(columnar SnapshotTable).
+
+    > python bench_read.py                  # synthetic snapshot of 1,000,000 entries
+    > python bench_read.py some.snap
+"""
+import sys
+import json
+import time
+import struct
+import random
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import Snapshot
+from Snapshot import SnapshotReader
+
+def legacy_read(snap_file):
+    # The reader before mmap support: three f.read() calls and a dict per entry
+    entries = []
+    with open(snap_file, 'rb') as f:
+        magic = f.read(len(Snapshot.SNAPSHOT_FILE_HEADER))
+        if magic != Snapshot.SNAPSHOT_FILE_HEADER:
+            raise ValueError('legacy reader only reads v1 snapshots')
+        while True:
+            header = f.read(struct.calcsize(Snapshot.ENTRY_HEADER_FORMAT))
+            if not header:
+                break
+            entry_type, path_len = struct.unpack(Snapshot.ENTRY_HEADER_FORMAT, header)
+            rel_path = f.read(path_len).decode('utf-8')
+            size, time, hash_value = struct.unpack(Snapshot.ENTRY_FILE_FORMAT, f.read(struct.calcsize(Snapshot.ENTRY_FILE_FORMAT)))
+            entries.append({'type': entry_type, 'path': rel_path, 'size': size, 'time': time, 'hash': hash_value})
+    return len(entries)
+
+def records_fields(snap_file):
+    return sum(1 for r in SnapshotReader(snap_file).iter_records() if r.size >= 0)
+
+def records_paths(snap_file):
+    return sum(1 for r in SnapshotReader(snap_file).iter_records() if r.path)
+
+READERS = {
+    'legacy': legacy_read,
+    'read_snapshot': lambda snap_file: len(SnapshotReader(snap_file).read_snapshot()),
+    'iter_records': records_fields,
+    'iter_records+path': records_paths,
+    'read_table': lambda snap_file: len(SnapshotReader(snap_file).read_table()),
+}
+
+def make_snapshot(snap_file, entries, seed=0):
+    # v1 layout so that the legacy reader can take part
+    rnd = random.Random(seed)
+    with open(snap_file, 'wb') as f:
+        f.write(Snapshot.SNAPSHOT_FILE_HEADER)
+        for i in range(entries):
+            path = f'root/dir{i // 1000}/sub{i // 50 % 20}/file{i}.dat'.encode('utf-8')
+            f.write(struct.pack(Snapshot.ENTRY_HEADER_FORMAT, Snapshot.ENTRY_TYPE_FILE, len(path)))
+            f.write(path)
+            f.write(struct.pack(Snapshot.ENTRY_FILE_FORMAT, rnd.randrange(1 << 30), 1700000000 + i, rnd.randbytes(32)))
+
+def run_child(reader, snap_file):
+    import resource
+    start = time.perf_counter()
+    count = READERS[reader](snap_file)
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    print(json.dumps({'records': count, 'seconds': elapsed, 'peak_rss_kib': rss}))
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot reader throughput')
+    parser.add_argument('snapshot', nargs='?', help='Snapshot to read (default: a generated v1 snapshot)')
+    parser.add_argument('--entries', type=int, default=1_000_000, help='Entries in the synthetic snapshot')
+    parser.add_argument('--reader', choices=READERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.reader:  # child process, so each reader gets its own peak RSS
+        run_child(args.reader, args.snapshot)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        snap_file = args.snapshot
+        if not snap_file:
+            snap_file = str(Path(tmp) / 'bench.snap')
+            make_snapshot(snap_file, args.entries)
+        print(f'Snapshot: {snap_file} ({Path(snap_file).stat().st_size / 2**20:,.1f} MiB)')
+        for reader in READERS:
+            out = subprocess.run([sys.executable, __file__, snap_file, '--reader', reader],
+                                 capture_output=True, text=True)
+            if out.returncode != 0:
+                print(f'{reader:>18}: failed ({out.stderr.strip().splitlines()[-1]})')
+                continue
+            result = json.loads(out.stdout)
+            print(f"{reader:>18}: {result['records'] / result['seconds']:>12,.0f} records/s, "
+                  f"peak RSS {result['peak_rss_kib'] / 1024:,.1f} MiB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/python3 -u
+"""
+Compare the pathlib recursive walker that SnapshotWriter used to have with the
+current os.scandir walker: wall time, and stat/open/getdents syscalls per entry.
+Syscalls are counted in process, by wrapping os.stat, os.lstat, os.scandir and
+os.listdir and the stat calls of the DirEntry objects handed out, and also
+traced when strace is installed.
+
+    > python bench_walk.py                  # synthetic tree of 20000 files
+    > python bench_walk.py /some/tree --runs 5
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import collections
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+from Snapshot import SnapshotWriter
+
+STRACE_SYSCALLS = 'stat,lstat,fstat,newfstatat,statx,openat,getdents64'
+
+def legacy_walk(path:Path, root_parent:Path):
+    # Walk of the old recursive _write_entry, without hashing or writing
+    count = 1
+    str(path.relative_to(root_parent)).encode('utf-8')
+    if path.is_file():
+        path.stat().st_size
+        path.stat().st_mtime
+    elif path.is_symlink():
+        pass
+    elif path.is_dir():
+        path.stat().st_mtime
+        for entry in path.iterdir():
+            count += legacy_walk(entry, root_parent)
+    return count
+
+def scandir_walk(path:Path):
+    writer = SnapshotWriter(path, os.devnull)
+    return sum(1 for _ in writer._walk_entries(path, 0))
+
+WALKERS = {
+    'legacy': lambda path: legacy_walk(path, path.parent),
+    'scandir': scandir_walk,
+    'none': lambda path: 0,
+}
+
+def make_tree(root:Path, files, fanout=20):
+    dirs = [root]
+    for i in range(files):
+        if i % fanout == 0:
+            d = dirs[len(dirs) // fanout] / f'dir{len(dirs)}'
+            d.mkdir()
+            dirs.append(d)
+        (dirs[-1] / f'file{i}.dat').write_bytes(b'x' * (i % 64))
+
+class _CountedEntry:
+    """
+    os.DirEntry stand-in counting the stat calls the real one makes: its lstat is made once,
+    on first use, and a followed stat only for a symlink; the types come from readdir.
+    """
+    def __init__(this, entry:os.DirEntry, calls):
+        this._entry = entry
+        this._calls = calls
+        this._cached = set()
+        this.name = entry.name
+        this.path = entry.path
+
+    def __fspath__(this):
+        return this.path
+
+    def _stat_call(this, follow_symlinks):
+        kind = 'stat' if follow_symlinks and this._entry.is_symlink() else 'lstat'
+        if kind not in this._cached:
+            this._cached.add(kind)
+            this._calls[kind] += 1
+
+    def stat(this, *, follow_symlinks=True):
+        this._stat_call(follow_symlinks)
+        return this._entry.stat(follow_symlinks=follow_symlinks)
+
+    def is_file(this, *, follow_symlinks=True):
+        if follow_symlinks and this._entry.is_symlink():
+            this._stat_call(True)
+        return this._entry.is_file(follow_symlinks=follow_symlinks)
+
+    def is_dir(this, *, follow_symlinks=True):
+        if follow_symlinks and this._entry.is_symlink():
+            this._stat_call(True)
+        return this._entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_symlink(this):
+        return this._entry.is_symlink()
+
+class _CountedScandir:
+    def __init__(this, it, calls):
+        this._it = it
+        this._calls = calls
+
+    def __enter__(this):
+        return this
+
+    def __exit__(this, *exc):
+        this._it.close()
+
+    def __iter__(this):
+        return (_CountedEntry(entry, this._calls) for entry in this._it)
+
+def count_calls(walker, tree:Path):
+    """
+    Run walker in process and return the stat, lstat, scandir and listdir calls it made.
+    pathlib's lstat() is os.stat(follow_symlinks=False), counted as lstat.
+    """
+    calls = collections.Counter()
+    stat, lstat, scandir, listdir = os.stat, os.lstat, os.scandir, os.listdir
+    def counted_stat(path, *, dir_fd=None, follow_symlinks=True):
+        calls['stat' if follow_symlinks else 'lstat'] += 1
+        return stat(path, dir_fd=dir_fd, follow_symlinks=follow_symlinks)
+    def counted_lstat(path, *, dir_fd=None):
+        calls['lstat'] += 1
+        return lstat(path, dir_fd=dir_fd)
+    def counted_scandir(path='.'):
+        calls['scandir'] += 1
+        return _CountedScandir(scandir(path), calls)
+    def counted_listdir(path='.'):
+        calls['listdir'] += 1
+        return listdir(path)
+    os.stat, os.lstat, os.scandir, os.listdir = counted_stat, counted_lstat, counted_scandir, counted_listdir
+    try:
+        WALKERS[walker](tree)
+    finally:
+        os.stat, os.lstat, os.scandir, os.listdir = stat, lstat, scandir, listdir
+    return calls
+
+def count_syscalls(walker, tree:Path):
+    out = subprocess.run(
+        ['strace', '-f', '-c', '-e', f'trace={STRACE_SYSCALLS}', sys.executable, __file__, '--walk', walker, str(tree)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True
+    ).stderr
+    calls = {}
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) >= 5 and re.fullmatch(r'\d+', parts[3]) and parts[-1] != 'total':
+            calls[parts[-1]] = int(parts[3])
+    return calls
+
+def main():
+    parser = argparse.ArgumentParser(description='os.scandir walker vs legacy pathlib walker')
+    parser.add_argument('tree', nargs='?', help='Tree to walk (default: a generated synthetic tree)')
+    parser.add_argument('--files', type=int, default=20000, help='Files in the synthetic tree')
+    parser.add_argument('--runs', type=int, default=3, help='Timed runs per walker (best is reported)')
+    parser.add_argument('--walk', choices=WALKERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.walk:  # child process traced by strace
+        WALKERS[args.walk](Path(args.tree).resolve())
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = Path(args.tree).resolve() if args.tree else Path(tmp) / 'tree'
+        if not args.tree:
+            tree.mkdir()
+            make_tree(tree, args.files)
+
+        entries = WALKERS['scandir'](tree)
+        print(f'Tree: {tree} ({entries:,} entries)')
+        for name in ('legacy', 'scandir'):
+            best = min(_timed(WALKERS[name], tree) for _ in range(args.runs))
+            print(f'{name:>8}: {best:.3f}s, {entries / best:,.0f} entries/s')
+
+        print('In process (os and DirEntry calls; a scandir is one opendir and its readdirs):')
+        for name in ('legacy', 'scandir'):
+            _print_calls(name, count_calls(name, tree), entries)
+
+        if not shutil.which('strace'):
+            print('strace not found: traced syscall counts skipped')
+            return
+        print('strace:')
+        startup = count_syscalls('none', tree)
+        for name in ('legacy', 'scandir'):
+            calls = count_syscalls(name, tree)
+            _print_calls(name, {k: v - startup.get(k, 0) for k, v in calls.items()}, entries)
+
+def _print_calls(name, calls, entries):
+    per_entry = {k: v / entries for k, v in calls.items()}
+    total = sum(per_entry.values())
+    detail = ', '.join(f'{k}={v:.2f}' for k, v in sorted(per_entry.items()) if v > 0.005)
+    print(f'{name:>8}: {total:.2f} syscalls/entry ({detail})')
+
+def _timed(walker, tree):
+    start = time.perf_counter()
+    walker(tree)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    main()
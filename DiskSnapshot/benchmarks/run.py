@@ -0,0 +1,238 @@
+#!/usr/bin/python3 -u
+"""
+End-to-end scenarios of generate, view and compare on deterministic synthetic
+inputs: wall time (best of --runs), entries/s, MB/s and peak RSS of each
+scenario, which runs in a fresh process. Results are written as JSON; with
+--baseline, the rates are compared with those of an earlier run.
+
+    > python -m benchmarks.run --output before.json
+    > python -m benchmarks.run --output after.json --baseline before.json
+    > python benchmarks/run.py --scenario compare --snap-entries 5000000
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+import subprocess
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+if __package__ in (None, ''):
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.synthetic import TreeSpec, make_tree, write_snapshot
+from Snapshot import SnapshotWriter, SnapshotReader
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Version of the JSON layout written by this script
+RESULTS_FORMAT = 1
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes, None where unknown.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+# Scenarios: name -> (inputs used, function of the input paths and a scratch
+# directory returning the (entries, bytes) processed). Inputs are the synthetic
+# tree on disk and synthetic snapshots (see prepare_inputs); *_changed ones have
+# --change-rate of their files changed, as a later snapshot of the same tree.
+
+def _generate(**writer_args):
+    def run(inputs, out_dir):
+        writer = SnapshotWriter(inputs['tree'], Path(out_dir) / 'out.snap', **writer_args)
+        writer.write_snapshot()
+        return writer.stats.entries, writer.stats.bytes_seen
+    return run
+
+def _read_snapshot(snap):
+    def run(inputs, out_dir):
+        return len(SnapshotReader(inputs[snap]).read_snapshot()), os.path.getsize(inputs[snap])
+    return run
+
+def _iter_records(inputs, out_dir):
+    return sum(1 for _ in SnapshotReader(inputs['snap']).iter_records()), os.path.getsize(inputs['snap'])
+
+def _compare(a, b):
+    def run(inputs, out_dir):
+        added, removed, modified = SnapshotReader.compare_snapshots(inputs[a], inputs[b])
+        entries = SnapshotReader(inputs[a]).read_info().entry_count + SnapshotReader(inputs[b]).read_info().entry_count
+        return entries, os.path.getsize(inputs[a]) + os.path.getsize(inputs[b])
+    return run
+
+SCENARIOS = {
+    'generate': (('tree',), _generate()),
+    'generate-nohash': (('tree',), _generate(hash_name='none')),
+    'generate-j4': (('tree',), _generate(jobs=4)),
+    'generate-zlib': (('tree',), _generate(compression='zlib')),
+    'view': (('snap',), _read_snapshot('snap')),
+    'view-zlib': (('snap_zlib',), _read_snapshot('snap_zlib')),
+    'iter_records': (('snap',), _iter_records),
+    'compare': (('snap', 'snap_changed'), _compare('snap', 'snap_changed')),
+    'compare-unsorted': (('snap_unsorted', 'snap_changed_unsorted'), _compare('snap_unsorted', 'snap_changed_unsorted')),
+}
+
+# Synthetic snapshots: name -> arguments of synthetic.write_snapshot
+SNAPSHOT_INPUTS = {
+    'snap': {},
+    'snap_zlib': {'compression': 'zlib'},
+    'snap_changed': {'changes': None},
+    'snap_unsorted': {'sort_paths': False},
+    'snap_changed_unsorted': {'sort_paths': False, 'changes': None},
+}
+
+def prepare_inputs(work_dir:Path, tree_spec:TreeSpec, snap_spec:TreeSpec, change_rate, scenarios):
+    """
+    Create the inputs the scenarios need in work_dir, reusing those made by an earlier
+    run with the same specs. Return {input name: path}.
+    """
+    specs = {'tree': tree_spec.to_dict(), 'snap': snap_spec.to_dict(), 'change_rate': change_rate}
+    work_dir.mkdir(parents=True, exist_ok=True)
+    spec_file = work_dir / 'inputs.json'
+    inputs = {'tree': work_dir / tree_spec.name}
+    if not spec_file.exists() or json.loads(spec_file.read_text()) != specs:
+        # Inputs of other specs: only remove what this script creates
+        shutil.rmtree(inputs['tree'], ignore_errors=True)
+        for name in SNAPSHOT_INPUTS:
+            (work_dir / f'{name}.snap').unlink(missing_ok=True)
+    spec_file.write_text(json.dumps(specs))
+
+    needed = {name for scenario in scenarios for name in SCENARIOS[scenario][0]}
+    if 'tree' in needed and not inputs['tree'].exists():
+        print(f'Creating tree of {tree_spec.entry_count():,} entries in {inputs["tree"]}', file=sys.stderr)
+        make_tree(work_dir, tree_spec)
+    for name, snap_args in SNAPSHOT_INPUTS.items():
+        inputs[name] = work_dir / f'{name}.snap'
+        if name not in needed or inputs[name].exists():
+            continue
+        print(f'Writing {name} ({snap_spec.entry_count():,} entries)', file=sys.stderr)
+        if 'changes' in snap_args:
+            snap_args = dict(snap_args, changes=change_rate)
+        write_snapshot(inputs[name], snap_spec, **snap_args)
+    return {name: str(path) for name, path in inputs.items()}
+
+def run_scenario(name, inputs, runs):
+    """
+    Run one scenario runs times in this process; return its result dict.
+    """
+    _, scenario = SCENARIOS[name]
+    best = None
+    with tempfile.TemporaryDirectory(dir=Path(inputs['tree']).parent) as out_dir:
+        for _ in range(runs):
+            start = time.perf_counter()
+            entries, size = scenario(inputs, out_dir)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return {
+        'wall_seconds': best,
+        'entries': entries,
+        'bytes': size,
+        'entries_per_second': entries / best if best else None,
+        'mb_per_second': size / best / 1e6 if best else None,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).resolve().parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(results, baseline):
+    """
+    Lines comparing the entries/s of each scenario with a baseline run.
+    """
+    lines = []
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before or not before.get('entries_per_second') or not result['entries_per_second']:
+            lines.append(f'{name:>18}: no baseline')
+            continue
+        ratio = result['entries_per_second'] / before['entries_per_second']
+        lines.append(f'{name:>18}: {before["entries_per_second"]:>12,.0f} -> {result["entries_per_second"]:>12,.0f} entries/s '
+                     f'({(ratio - 1) * 100:+.1f}%)')
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='DiskSnapshot end-to-end benchmarks')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, dest='scenarios',
+                        help='Scenario to run, repeatable (default: all)')
+    parser.add_argument('--runs', type=int, default=3, help='Timed runs per scenario (best is reported)')
+    parser.add_argument('--files', type=int, default=20000, help='Files in the synthetic tree of the generate scenarios')
+    parser.add_argument('--depth', type=int, default=3, help='Directory depth of the synthetic tree')
+    parser.add_argument('--fanout', type=int, default=8, help='Subdirectories per directory of the synthetic tree')
+    parser.add_argument('--sizes', default='lognormal:8:1.5:4194304',
+                        help='File size distribution: fixed:N, uniform:MIN:MAX or lognormal:MU:SIGMA[:MAX] (default: %(default)s)')
+    parser.add_argument('--snap-entries', type=int, default=1_000_000,
+                        help='Entries of the synthetic snapshots of the view and compare scenarios')
+    parser.add_argument('--change-rate', type=float, default=0.01,
+                        help='Share of the files changed in the second snapshot of compare')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic inputs')
+    parser.add_argument('--work-dir', help='Directory keeping the inputs between runs (default: a temporary one)')
+    parser.add_argument('--output', help='Write the results as JSON to this file (default: stdout)')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    scenarios = args.scenarios or list(SCENARIOS)
+    tree_spec = TreeSpec(args.files, args.depth, args.fanout, args.sizes, args.seed)
+    snap_spec = TreeSpec.for_entries(args.snap_entries, sizes=args.sizes, seed=args.seed)
+    tmp_dir = None if args.work_dir else tempfile.mkdtemp(prefix='disksnapshot-bench-')
+    work_dir = Path(args.work_dir or tmp_dir).resolve()
+    try:
+        inputs = prepare_inputs(work_dir, tree_spec, snap_spec, args.change_rate, scenarios)
+        results = {
+            'format': RESULTS_FORMAT,
+            'meta': {
+                'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                'commit': _git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'runs': args.runs,
+                'tree': tree_spec.to_dict(),
+                'snapshot': snap_spec.to_dict(),
+                'change_rate': args.change_rate,
+            },
+            'scenarios': {},
+        }
+        # A fresh interpreter per scenario, so that peak RSS is its own
+        spawn = multiprocessing.get_context('spawn')
+        for name in scenarios:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                result = executor.submit(run_scenario, name, inputs, args.runs).result()
+            results['scenarios'][name] = result
+            rss = f'{result["peak_rss_bytes"] / 2**20:,.0f} MiB' if result['peak_rss_bytes'] else 'n/a'
+            print(f'{name:>18}: {result["wall_seconds"]:8.3f}s {result["entries_per_second"]:>12,.0f} entries/s '
+                  f'{result["mb_per_second"]:>10,.1f} MB/s  peak RSS {rss}', file=sys.stderr)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as out:
+            json.dump(results, out, indent=2)
+            out.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print('\n'.join(compare_results(results, baseline)), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Deterministic synthetic inputs for the benchmarks: a TreeSpec describes a tree
+(file count, depth, fan-out, size distribution, seed); make_tree() creates it
+on disk and write_snapshot() writes the snapshot of such a tree straight from
+the spec, without touching the filesystem, for millions of entries.
+The same spec always gives the same paths, sizes, times and contents.
+"""
+import os
+import random
+import hashlib
+from pathlib import Path
+
+from Snapshot import SnapshotFileWriter, HASH_ALGORITHMS, ENTRY_TYPE_FILE, ENTRY_TYPE_DIR, NULL_HASH
+
+# Times of the synthetic entries, spread over the 2**24 seconds after this
+BASE_TIME = 1700000000
+# Random bytes file contents are cut from
+CONTENT_POOL_SIZE = 1 << 20
+
+def size_sampler(spec):
+    """
+    Return rnd -> file size for a size distribution spec: fixed:N, uniform:MIN:MAX
+    or lognormal:MU:SIGMA[:MAX] (MU and SIGMA of the natural log of the size in bytes).
+    """
+    kind, *params = spec.split(':')
+    try:
+        params = [float(p) for p in params]
+        if kind == 'fixed' and len(params) == 1:
+            size = int(params[0])
+            return lambda rnd: size
+        if kind == 'uniform' and len(params) == 2:
+            low, high = int(params[0]), int(params[1])
+            return lambda rnd: rnd.randint(low, high)
+        if kind == 'lognormal' and len(params) in (2, 3):
+            mu, sigma = params[:2]
+            cap = int(params[2]) if len(params) == 3 else 1 << 30
+            return lambda rnd: min(cap, int(rnd.lognormvariate(mu, sigma)))
+    except ValueError:
+        pass
+    raise ValueError(f'Invalid size distribution: {spec} (fixed:N, uniform:MIN:MAX or lognormal:MU:SIGMA[:MAX])')
+
+class TreeSpec:
+    """
+    Shape of a synthetic tree: files spread evenly over the root and the
+    directories of a complete tree of the given depth and fan-out.
+    """
+    __slots__ = ('files', 'depth', 'fanout', 'sizes', 'seed', 'name')
+
+    def __init__(this, files=20000, depth=3, fanout=8, sizes='lognormal:8:1.5:4194304', seed=0, name='tree'):
+        if files < 0 or depth < 0 or fanout < 1:
+            raise ValueError('files and depth must be >= 0, fanout >= 1')
+        size_sampler(sizes)
+        this.files = files
+        this.depth = depth
+        this.fanout = fanout
+        this.sizes = sizes
+        this.seed = seed
+        this.name = name
+
+    @classmethod
+    def for_entries(cls, entries, depth=4, fanout=10, **kwargs):
+        """
+        Spec of about `entries` entries in all, directories included.
+        """
+        dirs = cls(0, depth, fanout).dir_count()
+        return cls(max(0, entries - dirs), depth, fanout, **kwargs)
+
+    def dir_count(this):
+        # root + fanout + fanout**2 + ... + fanout**depth
+        return sum(this.fanout ** level for level in range(this.depth + 1))
+
+    def entry_count(this):
+        return this.files + this.dir_count()
+
+    def to_dict(this):
+        return {name: getattr(this, name) for name in this.__slots__}
+
+    def iter_entries(this):
+        """
+        Yield (type, rel_path, size, time, content seed) in canonical order:
+        in every directory the subdirectories (d...) with all they hold come
+        before the files (f...).
+        """
+        rnd = random.Random(this.seed)
+        sample_size = size_sampler(this.sizes)
+        per_dir, extra = divmod(this.files, this.dir_count())
+        digits = len(str(max(this.files, this.fanout, 1) - 1))
+        counters = {'dirs': 0, 'files': 0}
+
+        def walk(path, level):
+            yield ENTRY_TYPE_DIR, path, 0, BASE_TIME + rnd.randrange(1 << 24), 0
+            if level < this.depth:
+                for i in range(this.fanout):
+                    yield from walk(f'{path}/d{i:0{digits}}', level + 1)
+            count = per_dir + (counters['dirs'] < extra)
+            counters['dirs'] += 1
+            for _ in range(count):
+                yield (ENTRY_TYPE_FILE, f'{path}/f{counters["files"]:0{digits}}.dat', sample_size(rnd),
+                       BASE_TIME + rnd.randrange(1 << 24), rnd.getrandbits(32))
+                counters['files'] += 1
+        return walk(this.name, 0)
+
+    def iter_records(this, hash_name='sha256', changes=0.0, change_seed=1):
+        """
+        Yield the snapshot records (type, rel_path, size, time, hash) of the tree,
+        hashes derived from each file's content seed. With changes, that share of the
+        files is removed, modified or gets a new file next to it (a third each),
+        as in a later snapshot of the same tree.
+        """
+        digest_size = HASH_ALGORITHMS[hash_name].digest_size
+        mutate = random.Random(change_seed) if changes else None
+        for entry_type, path, size, time, content_seed in this.iter_entries():
+            if entry_type != ENTRY_TYPE_FILE:
+                yield entry_type, path.encode('utf-8'), size, time, NULL_HASH[:digest_size]
+                continue
+            hash_value = hashlib.blake2b(content_seed.to_bytes(4, 'little'), digest_size=digest_size).digest() if digest_size else b''
+            if mutate is not None and mutate.random() < changes:
+                change = mutate.randrange(3)
+                if change == 0:
+                    continue
+                if change == 1:
+                    size, time, hash_value = size + 1, time + 1, mutate.randbytes(digest_size)
+                else:
+                    yield entry_type, path.encode('utf-8'), size, time, hash_value
+                    # f12.dat, then the new f12.new: still in canonical order
+                    path, hash_value = path[:-len('dat')] + 'new', mutate.randbytes(digest_size)
+            yield entry_type, path.encode('utf-8'), size, time, hash_value
+
+def make_tree(root, spec:TreeSpec):
+    """
+    Create the tree of spec as root/spec.name, contents cut from a seeded pool of
+    random bytes and times set as in the spec. Return (entries, bytes of all files).
+    """
+    root = Path(root)
+    pool = random.Random(spec.seed).randbytes(CONTENT_POOL_SIZE)
+    entries = total_size = 0
+    dir_times = []
+    for entry_type, path, size, time, content_seed in spec.iter_entries():
+        target = root / path
+        entries += 1
+        if entry_type == ENTRY_TYPE_DIR:
+            target.mkdir()
+            dir_times.append((target, time))
+            continue
+        start = content_seed % CONTENT_POOL_SIZE
+        with target.open('wb') as f:
+            left = size
+            while left:
+                chunk = pool[start:start + left]
+                f.write(chunk)
+                left -= len(chunk)
+                start = 0
+        os.utime(target, (time, time))
+        total_size += size
+    # Creating entries changes the time of their directory: set those last, deepest first
+    for target, time in reversed(dir_times):
+        os.utime(target, (time, time))
+    return entries, total_size
+
+def write_snapshot(snap_file, spec:TreeSpec, hash_name='sha256', sort_paths=True, compression=None, changes=0.0):
+    """
+    Write the snapshot of spec's tree (see TreeSpec.iter_records) without creating
+    the tree. Return (entries, bytes of all files).
+    """
+    totals = [0, 0]
+    def counted(records):
+        for record in records:
+            totals[0] += 1
+            totals[1] += record[2]
+            yield record
+    with Path(snap_file).open('wb') as f:
+        out = SnapshotFileWriter(f, 2, sort_paths, hash_name, compression)
+        out.write_records(counted(spec.iter_records(hash_name, changes)))
+        out.finish()
+    return tuple(totals)
@@ -1,23 +1,41 @@
 import os
+import sys
 import logging
 import shlex
+import shutil
+import time
 import argparse
+import signal
+import functools
 import config
 from pathlib import Path
-from Snapshot import SnapshotWriter, SnapshotReader
+import SnapshotDiff
+import SnapshotShards
+import SnapshotWatch
+import SnapshotTableView
+from SnapshotStats import PhaseStats
+from SnapshotBlocks import COMPRESSION_CODECS
+from SnapshotChunks import DEFAULT_CHUNK_AVG_SIZE, DEFAULT_CHUNK_MIN_FILE_SIZE
+from Snapshot import (SnapshotWriter, SnapshotReader, SnapshotHashFiller, DEFAULT_HASH_CHUNK_SIZE, HASH_ALGORITHMS, DEFAULT_HASH_ALGORITHM,
+                      DIFF_ADDED, DIFF_REMOVED, DIFF_MODIFIED, ENTRY_TYPE_DIR, ENTRY_TYPE_SYMLINK, EXTRA_FIELDS_LINKS,
+                      EXTRA_FIELDS_STAT)
 
-def _on_snap_not_found(file):
-    print(f'Snapshot file not found: {shlex.quote(str(file))}')
+# Seconds between two redraws of the generate progress line
+PROGRESS_LINE_INTERVAL = 0.5
+
+def _on_snap_not_found(file, out = None):
+    print(f'Snapshot file not found: {shlex.quote(str(file))}', file=out)
     exit(-1)
 
 # Generate snapshot
-def generate(src_path, ignore_hidden = False, ignore_symlinks = False, max_rec_depth = -1, output_name = None, output_dir = None, show = False, human = False):
+def generate(src_path, ignore_hidden = False, ignore_symlinks = False, max_rec_depth = -1, output_name = None, output_dir = None, show = False, human = False, jobs = 1, chunk_size = None, base_file = None, rehash = False, version = 2, sort_paths = False, hash_name = DEFAULT_HASH_ALGORITHM, hash_files = True, compression = None, shard = None, processes = 1, progress = None, precount = False, phase_stats = None, record_links = False, record_stat = False, chunk_min_file_size = None, chunk_avg_size = DEFAULT_CHUNK_AVG_SIZE, out = None):
     # Compute output file path
     src_path = Path(src_path).resolve()
     if not output_name or output_name is None:
+        __shard = f'.{shard[0]}-of-{shard[1]}' if shard else ''
         __tmp = 1
-        while os.path.exists(output_name := f"{src_path.name}{f' ({__tmp})' if __tmp > 1 else ''}.snap"): __tmp += 1
-    if not  output_dir: output_dir  = Path.cwd()
+        while os.path.exists(output_name := f"{src_path.name}{__shard}{f' ({__tmp})' if __tmp > 1 else ''}.snap"): __tmp += 1
+    output_dir = Path(output_dir) if output_dir else Path.cwd()
     output_dir.mkdir(parents=True, exist_ok=True)
     dest_path = output_dir / output_name
         
@@ -25,25 +43,120 @@ def generate(src_path, ignore_hidden = False, ignore_symlinks = False, max_rec_d
     logging.info(f'Generate: Snapshot = "{shlex.quote(str(dest_path))}"')
 
     if not src_path.exists():
-        print(f'Source path does not exist: {shlex.quote(str(src_path.absolute()))}')
+        print(f'Source path does not exist: {shlex.quote(str(src_path.absolute()))}', file=out)
         exit(-1)
+    if base_file:
+        base_file = Path(base_file).resolve()
+        logging.info(f'Generate: Base = "{shlex.quote(str(base_file))}"')
+        if not base_file.exists():
+            _on_snap_not_found(base_file.absolute(), out)
         
-    print(f'Taking snapshot from source: {shlex.quote(str(src_path.absolute()))}')
-    print()
+    extra_fields = (EXTRA_FIELDS_LINKS if record_links else 0) | (EXTRA_FIELDS_STAT if record_stat else 0)
+    try:
+        if processes != 1:
+            if shard:
+                raise ValueError('--processes takes every shard itself: it cannot be combined with --shard')
+            writer = SnapshotShards.ShardedSnapshotWriter(src_path, dest_path, processes, compression, progress, phase_stats,
+                                                          ignore_hidden=ignore_hidden, ignore_symlinks=ignore_symlinks, max_rec_depth=max_rec_depth,
+                                                          jobs=jobs, chunk_size=chunk_size or DEFAULT_HASH_CHUNK_SIZE, base_file=base_file,
+                                                          rehash=rehash, version=version, sort_paths=sort_paths, hash_name=hash_name, hash_files=hash_files,
+                                                          extra_fields=extra_fields, chunk_min_file_size=chunk_min_file_size, chunk_avg_size=chunk_avg_size)
+        else:
+            writer = SnapshotWriter(src_path, dest_path, ignore_hidden, ignore_symlinks, max_rec_depth, jobs,
+                                    chunk_size or DEFAULT_HASH_CHUNK_SIZE, base_file, rehash, version, sort_paths, hash_name, hash_files, compression,
+                                    shard, progress, phase_stats=phase_stats, extra_fields=extra_fields,
+                                    chunk_min_file_size=chunk_min_file_size, chunk_avg_size=chunk_avg_size)
+    except ValueError as e:
+        print(e, file=out)
+        exit(-1)
+    logging.info(f'Generate: Hash = {hash_name if hash_files else "deferred"}')
+    if shard:
+        logging.info(f'Generate: Shard {shard[0]} of {shard[1]}')
+        
+    if precount:
+        writer.expected_totals = writer.precount()
+        logging.info(f'Generate: Pre-count found {writer.expected_totals[0]:,} entries, {writer.expected_totals[1]:,} bytes of files')
+        
+    print(f'Taking snapshot from source: {shlex.quote(str(src_path.absolute()))}', file=out)
+    print(file=out)
     
-    writer = SnapshotWriter(src_path, dest_path, ignore_hidden, ignore_symlinks, max_rec_depth)
     writer.write_snapshot()
+    if progress is not None and hasattr(progress, 'finish'):
+        progress.finish()
     logging.info(f"Generate: Snapshot written to {shlex.quote(str(dest_path))}")
+    if base_file:
+        logging.info(f'Generate: {writer.files_hashed:,} files hashed, {writer.hashes_reused:,} hashes reused from base')
     
-    print(f'Snapshot Saved in: {shlex.quote(str(dest_path.absolute()))}')
-    print()
+    print(f'Snapshot Saved in: {shlex.quote(str(dest_path.absolute()))}', file=out)
+    print(file=out)
+    print_write_report(writer.stats, human, out)
+    print(file=out)
     
     if show:
-        reader = SnapshotReader(dest_path)
-        reader.print_snapshot(False, human)
+        if phase_stats is not None:
+            phase_stats.switch('output')
+        reader = SnapshotReader(dest_path, phase_stats)
+        reader.print_snapshot(False, human, out)
         
+def _format_size(num_bytes, human):
+    return SnapshotReader._get_size_string(num_bytes, True) if human else f'{num_bytes:,} bytes'
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}' if hours else f'{minutes}:{seconds:02}'
+
+class ProgressLine:
+    """
+    Progress callback of SnapshotWriter drawing one line on a terminal, redrawn
+    at most every PROGRESS_LINE_INTERVAL seconds so it costs next to nothing.
+    """
+    def __init__(this, stream=None):
+        this._stream = stream or sys.stderr
+        this._next = 0.0
+        this._width = 0
+
+    def __call__(this, stats):
+        now = time.monotonic()
+        if now < this._next:
+            return
+        this._next = now + PROGRESS_LINE_INTERVAL
+        eta = stats.eta()
+        line = (f'{stats.entries:,} entries, {stats.files_per_second():,.0f} files/s, '
+                f'{stats.bytes_per_second() / (1 << 20):,.1f} MiB/s'
+                f'{f", ETA {_format_seconds(eta)}" if eta is not None else ""}')
+        if stats.path:
+            line += f'  {stats.path}'
+        width = shutil.get_terminal_size().columns - 1
+        if len(line) > width:
+            line = line[:max(0, width - 3)] + '...'
+        # Pad over the rest of the previous line
+        this._stream.write(f'\r{line:<{this._width}}')
+        this._stream.flush()
+        this._width = len(line)
+
+    def finish(this):
+        if this._width:
+            this._stream.write(f'\r{"":<{this._width}}\r')
+            this._stream.flush()
+            this._width = 0
+
+def print_write_report(stats, human = False, out = None):
+    elapsed = stats.elapsed
+    print(f'Entries: {stats.entries:,} ({stats.files:,} files, {_format_size(stats.bytes_seen, human)}) in {elapsed:.2f}s, '
+          f'{stats.files_per_second():,.0f} files/s', file=out)
+    print(f'Hashed: {stats.files_hashed:,} files, {_format_size(stats.bytes_hashed, human)}, '
+          f'{stats.bytes_per_second() / (1 << 20):,.1f} MiB/s'
+          f'{f", {stats.hashes_reused:,} hashes reused" if stats.hashes_reused else ""}'
+          f'{f", {stats.hashes_linked:,} hard links not read again" if stats.hashes_linked else ""}', file=out)
+    slowest = stats.slowest_files()
+    if slowest:
+        print('Slowest files to hash:', file=out)
+        for seconds, path in slowest:
+            print(f'  {seconds:8.3f}s  {shlex.quote(str(path))}', file=out)
+
 # View snapshot
-def view(snapshot_file, human = False):
+def view(snapshot_file, human = False, path = None, phase_stats = None):
     snapshot_file = Path(snapshot_file).resolve()
     
     logging.info(f'View: Snapshot = "{shlex.quote(str(snapshot_file))}"')
@@ -53,11 +166,25 @@ def view(snapshot_file, human = False):
 
     print(f'Viewing Snapshot: {shlex.quote(str(snapshot_file.absolute()))}')
     
-    reader = SnapshotReader(snapshot_file)
+    reader = SnapshotReader(snapshot_file, phase_stats)
+    if phase_stats is not None:
+        phase_stats.switch('output')
+    if path is not None:
+        entry = reader.lookup(path)
+        if entry is None:
+            print(f'Path not found in snapshot: {shlex.quote(path)}')
+            return
+        print(SnapshotReader._get_entry_string(entry, human))
+        return
     reader.print_snapshot(False, human)
 
+def _count_diff(phase_stats, counts):
+    if phase_stats is not None:
+        for kind, name in ((DIFF_ADDED, 'added'), (DIFF_REMOVED, 'removed'), (DIFF_MODIFIED, 'modified')):
+            phase_stats.count(name, counts[kind])
+
 # Compare snapshots
-def compare(snap_a, snap_b, human = False):
+def compare(snap_a, snap_b, human = False, fmt = 'text', output = None, ignore_hash = False, phase_stats = None):
     snap_a = Path(snap_a).resolve()
     snap_b = Path(snap_b).resolve()
     
@@ -65,23 +192,149 @@ def compare(snap_a, snap_b, human = False):
         _on_snap_not_found(snap_a.absolute())
     if not snap_b.exists():
         _on_snap_not_found(snap_b.absolute())
-        
+    
+    try:
+        events = SnapshotReader.iter_diff(snap_a, snap_b, False if ignore_hash else None, phase_stats)
+    except ValueError as e:
+        print(f'{e} (use --ignore-hash)')
+        exit(-1)
+    if phase_stats is not None:
+        # Writing the events out; reading, sorting and diffing are timed as they are pulled
+        phase_stats.switch('output')
+    if fmt != 'text':
+        # Machine readable output: nothing else may go to the same stream
+        logging.info(f'Compare: {shlex.quote(str(snap_a))} -> {shlex.quote(str(snap_b))} as {fmt}')
+        write_diff = SnapshotDiff.DIFF_WRITERS[fmt]
+        binary = fmt == 'bin'
+        info_a, info_b = SnapshotReader(snap_a).read_info(), SnapshotReader(snap_b).read_info()
+        if binary:
+            if info_a.hash_name != info_b.hash_name:
+                print(f'Binary diffs need both snapshots hashed alike ({info_a.hash_name}, {info_b.hash_name})', file=sys.stderr)
+                exit(-1)
+            # Records of the second snapshot are copied as they are
+            write_diff = functools.partial(write_diff, hash_name=info_b.hash_name, extra_fields=info_b.extra_fields)
+        elif fmt == 'csv':
+            write_diff = functools.partial(write_diff, extra_fields=info_a.extra_fields | info_b.extra_fields)
+        if output:
+            with open(output, 'wb') if binary else open(output, 'w', encoding='utf-8', newline='') as out:
+                counts = write_diff(events, out)
+        else:
+            counts = write_diff(events, sys.stdout.buffer if binary else sys.stdout)
+        logging.info(f'Compare: Added: {counts[DIFF_ADDED]}, Removed: {counts[DIFF_REMOVED]}, Modified: {counts[DIFF_MODIFIED]}')
+        _count_diff(phase_stats, counts)
+        return
     
     print(f'Comparing Snapshots:\n  1. {shlex.quote(str(snap_a.absolute()))}\n  2. {shlex.quote(str(snap_b.absolute()))}')
     print()
         
-    added, removed, modified = SnapshotReader.compare_snapshots(snap_a, snap_b)
+    if output:
+        with open(output, 'w', encoding='utf-8') as out:
+            counts = SnapshotReader.print_diff(events, human, out)
+    else:
+        counts = SnapshotReader.print_diff(events, human)
+    _count_diff(phase_stats, counts)
     
-    if not added and not removed and not modified:
+    if not any(counts.values()):
         print('Compare: No differences found!')
         return
     
-    print(f'[Added: {len(added)}, Removed: {len(removed)}, Modified: {len(modified)}]')
-    SnapshotReader.print_snapshot_comparisons(added, removed, modified, human)
+    print()
+    print(f'[Added: {counts[DIFF_ADDED]}, Removed: {counts[DIFF_REMOVED]}, Modified: {counts[DIFF_MODIFIED]}]')
+
+# Hash files of a snapshot taken with --no-hash
+def fill_hashes(snapshot_file, src_path, paths = None, min_size = 0, changed_from = None, jobs = 1, chunk_size = None):
+    snapshot_file = Path(snapshot_file).resolve()
+    src_path = Path(src_path).resolve()
+    if not snapshot_file.exists():
+        _on_snap_not_found(snapshot_file.absolute())
+    if not src_path.exists():
+        print(f'Source path does not exist: {shlex.quote(str(src_path.absolute()))}')
+        exit(-1)
+    if changed_from:
+        changed_from = Path(changed_from).resolve()
+        if not changed_from.exists():
+            _on_snap_not_found(changed_from.absolute())
+    
+    logging.info(f'Fill hashes: Snapshot = "{shlex.quote(str(snapshot_file))}", Source = "{shlex.quote(str(src_path))}"')
+    filler = SnapshotHashFiller(snapshot_file, src_path, jobs, chunk_size or DEFAULT_HASH_CHUNK_SIZE)
+    try:
+        filler.fill(paths, min_size, changed_from)
+    except ValueError as e:
+        print(e)
+        exit(-1)
+    print(f'Hashed: {filler.files_hashed:,}, Reused: {filler.hashes_reused:,}, Changed since snapshot: {filler.files_skipped:,}')
+
+# Merge the shards of a snapshot (generate --shard)
+def merge(shard_files, output, compression = None):
+    shard_files = [Path(shard_file).resolve() for shard_file in shard_files]
+    for shard_file in shard_files:
+        if not shard_file.exists():
+            _on_snap_not_found(shard_file.absolute())
+    
+    logging.info(f'Merge: {len(shard_files)} shards -> "{shlex.quote(str(output))}"')
+    try:
+        count = SnapshotShards.merge_snapshots(shard_files, output, compression)
+    except ValueError as e:
+        print(e)
+        exit(-1)
+    print(f'Merged {count:,} entries')
+    print(f'Snapshot Saved in: {shlex.quote(str(Path(output).absolute()))}')
+
+# Apply a binary diff
+def apply(snapshot_file, diff_file, output):
+    snapshot_file = Path(snapshot_file).resolve()
+    diff_file = Path(diff_file).resolve()
+    if not snapshot_file.exists():
+        _on_snap_not_found(snapshot_file.absolute())
+    if not diff_file.exists():
+        print(f'Diff file not found: {shlex.quote(str(diff_file))}')
+        exit(-1)
+    
+    try:
+        SnapshotDiff.apply_diff(snapshot_file, diff_file, output)
+    except ValueError as e:
+        print(e)
+        exit(-1)
+    print(f'Snapshot Saved in: {shlex.quote(str(Path(output).absolute()))}')
+
+# Keep a snapshot up to date from filesystem events
+def watch(src_path, output = None, interval = SnapshotWatch.DEFAULT_WATCH_INTERVAL, poll = False, ignore_hidden = False, ignore_symlinks = False, max_rec_depth = -1, jobs = 1, chunk_size = None, hash_name = DEFAULT_HASH_ALGORITHM, compression = None, record_links = False, record_stat = False, chunk_min_file_size = None, chunk_avg_size = DEFAULT_CHUNK_AVG_SIZE):
+    src_path = Path(src_path).resolve()
+    if not src_path.exists():
+        print(f'Source path does not exist: {shlex.quote(str(src_path.absolute()))}')
+        exit(-1)
+    dest_path = Path(output).resolve() if output else Path.cwd() / f'{src_path.name}.snap'
+    logging.info(f'Watch: Source = "{shlex.quote(str(src_path))}"')
+    logging.info(f'Watch: Snapshot = "{shlex.quote(str(dest_path))}"')
+    
+    extra_fields = (EXTRA_FIELDS_LINKS if record_links else 0) | (EXTRA_FIELDS_STAT if record_stat else 0)
+    try:
+        watcher = SnapshotWatch.SnapshotWatcher(src_path, dest_path, interval, poll, ignore_hidden=ignore_hidden,
+                                                ignore_symlinks=ignore_symlinks, max_rec_depth=max_rec_depth, jobs=jobs,
+                                                chunk_size=chunk_size or DEFAULT_HASH_CHUNK_SIZE, hash_name=hash_name,
+                                                compression=compression, extra_fields=extra_fields,
+                                                chunk_min_file_size=chunk_min_file_size, chunk_avg_size=chunk_avg_size)
+    except ValueError as e:
+        print(e)
+        exit(-1)
+    # Stop after a last update of the snapshot; SIGUSR1 updates it right away
+    signal.signal(signal.SIGINT, lambda *_: watcher.stop())
+    signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda *_: watcher.request_update())
+    
+    print(f'Watching source: {shlex.quote(str(src_path))} (Ctrl+C to stop)')
+    print()
+    try:
+        watcher.run()
+    except ValueError as e:
+        print(e)
+        exit(-1)
+    print(f'Snapshot Saved in: {shlex.quote(str(dest_path))} ({watcher.updates:,} updates)')
 
 
 def add_commands(parser: argparse.ArgumentParser, dest='command', required=True, title='commands', description='valid commands'):
-    subparsers = parser.add_subparsers(dest = dest, required = required, title = title, description = description, metavar='{generate, view, compare}')
+    subparsers = parser.add_subparsers(dest = dest, required = required, title = title, description = description, metavar='{generate, view, compare, apply, fill-hashes, merge, watch}')
     
     # Generate command
     gen_parser = subparsers.add_parser('generate', aliases=['g', 'w'], 
@@ -99,16 +352,59 @@ def add_commands(parser: argparse.ArgumentParser, dest='command', required=True,
                           help='Ignore symlinks')
     gen_parser.add_argument('--max-recursion-depth', type=int, default=-1,
                           help='Maximum recursion depth (default: unlimited)')
+    gen_parser.add_argument('-j', '--jobs', type=int, default=1,
+                          help='Number of files hashed in parallel (0 = one per CPU, default: 1)')
+    gen_parser.add_argument('--chunk-size', type=int, default=DEFAULT_HASH_CHUNK_SIZE,
+                          help=f'Read buffer size in bytes used per hashing worker (default: {DEFAULT_HASH_CHUNK_SIZE})')
+    gen_parser.add_argument('--base', metavar='BASE_SNAPSHOT',
+                          help='Previous snapshot of the same source; unchanged files (same size and time) reuse its hashes')
+    gen_parser.add_argument('--rehash', action='store_true',
+                          help='With --base, hash every file anyway and warn about content changes that kept size and time')
+    gen_parser.add_argument('--format-version', type=int, choices=(1, 2), default=2,
+                          help='Snapshot file format: 2 is indexed for fast path lookup, 1 is the legacy format (default: 2)')
+    gen_parser.add_argument('--hash', choices=HASH_ALGORITHMS, default=DEFAULT_HASH_ALGORITHM, dest='hash_name',
+                          help=f'File content hash: xxh3 and blake3 need the xxhash/blake3 packages, none only records size and time (default: {DEFAULT_HASH_ALGORITHM})')
+    gen_parser.add_argument('--no-hash', action='store_false', dest='hash_files',
+                          help='Only record size and time of files (hashes from --base are still reused); see fill-hashes')
+    gen_parser.add_argument('--compress', choices=COMPRESSION_CODECS, dest='compression',
+                          help='Store records in blocks with front-coded paths, compressed unless none; view and compare read them as usual (zstd needs the zstandard package). Without it records keep full paths')
+    gen_parser.add_argument('--shard', type=_shard_arg, metavar='I/N',
+                          help='Only record the top-level entries of shard I out of N (counted from 0), for the merge command')
+    gen_parser.add_argument('--processes', type=int, default=1,
+                          help='Take the snapshot as shards in this many worker processes and merge them (0 = one per CPU, default: 1)')
+    gen_parser.add_argument('--progress', action='store_true', default=None,
+                          help='Show a progress line on stderr (default: when stderr is a terminal)')
+    gen_parser.add_argument('--no-progress', action='store_false', dest='progress',
+                          help='Do not show the progress line')
+    gen_parser.add_argument('--precount', action='store_true',
+                          help='Walk the source once before taking the snapshot, for an ETA without --base')
+    gen_parser.add_argument('--record-links', action='store_true',
+                          help='Record the device, inode and link count of every entry, so that compare reports hard link changes')
+    gen_parser.add_argument('--record-stat', action='store_true',
+                          help='Also record nanosecond modification and change times, mode, owner and group of every entry: '
+                               'compare reports changes within the same second and of permissions, and --base only reuses '
+                               'hashes of files whose inode and nanosecond times did not change either')
+    gen_parser.add_argument('--chunks', type=int, nargs='?', const=DEFAULT_CHUNK_MIN_FILE_SIZE, metavar='MIN_FILE_SIZE', dest='chunk_min_file_size',
+                          help=f'Record the content-defined chunks of files of MIN_FILE_SIZE bytes or more (default: {DEFAULT_CHUNK_MIN_FILE_SIZE}), '
+                               'so that compare reports which byte ranges of them changed')
+    gen_parser.add_argument('--chunk-average', type=int, default=DEFAULT_CHUNK_AVG_SIZE, dest='chunk_avg_size',
+                          help=f'Average chunk size in bytes of --chunks (default: {DEFAULT_CHUNK_AVG_SIZE})')
+    gen_parser.add_argument('--sorted', action='store_true', dest='sort_paths',
+                          help='Write entries in canonical path order, which lets compare stream the snapshot without sorting it')
     gen_parser.add_argument('-H', '--human', action='store_true', default=False,
                         help='Use human friendly units for output')
+    _add_stats_arguments(gen_parser)
     
     # View command
     view_parser = subparsers.add_parser('view', aliases=['v', 'r'],
                                       help='View snapshot file content')
     view_parser.add_argument('snapshot_file', metavar='SNAPSHOT_FILE',
                            help='Snapshot file to view')
+    view_parser.add_argument('--path',
+                           help='Only show the entry of this path, as recorded (e.g. "folder/sub/file")')
     view_parser.add_argument('-H', '--human', action='store_true', default=False,
                         help='Use human friendly units for output')
+    _add_stats_arguments(view_parser)
     
     # Compare command
     compare_parser = subparsers.add_parser('compare', aliases=['c'],
@@ -117,18 +413,180 @@ def add_commands(parser: argparse.ArgumentParser, dest='command', required=True,
                               help='First snapshot file to compare')
     compare_parser.add_argument('snap_b', metavar='SNAP_B',
                               help='Second snapshot file to compare')
+    compare_parser.add_argument('--format', choices=SnapshotDiff.EXPORT_FORMATS, default='text',
+                              help='Output format: text for reading, jsonl/csv for pipelines, bin for the apply command (default: text)')
+    compare_parser.add_argument('--output',
+                              help='Write the differences to this file instead of stdout')
+    compare_parser.add_argument('--ignore-hash', action='store_true',
+                              help='Compare entries by size and time only, e.g. snapshots hashed with different algorithms')
     compare_parser.add_argument('-H', '--human', action='store_true', default=False,
                         help='Use human friendly units for output')
+    _add_stats_arguments(compare_parser)
     
+    # Apply command
+    apply_parser = subparsers.add_parser('apply',
+                                       help='Apply a binary diff (compare --format bin) to a snapshot')
+    apply_parser.add_argument('snapshot_file', metavar='SNAPSHOT_FILE',
+                            help='Snapshot the diff was computed from')
+    apply_parser.add_argument('diff_file', metavar='DIFF_FILE',
+                            help='Binary diff file')
+    apply_parser.add_argument('--output', required=True,
+                            help='Resulting snapshot file')
+    
+    # Fill hashes command
+    fill_parser = subparsers.add_parser('fill-hashes',
+                                      help='Hash files left unhashed by generate --no-hash, in place')
+    fill_parser.add_argument('snapshot_file', metavar='SNAPSHOT_FILE',
+                           help='Snapshot file to complete')
+    fill_parser.add_argument('src_path', help='Source directory the snapshot was taken from')
+    fill_parser.add_argument('--path', action='append', dest='paths',
+                           help='Only hash this path, as recorded (repeatable)')
+    fill_parser.add_argument('--min-size', type=int, default=0,
+                           help='Only hash files of at least this many bytes')
+    fill_parser.add_argument('--changed-from', metavar='BASE_SNAPSHOT',
+                           help='Only hash files new or changed (size or time) since this snapshot; unchanged files reuse its hashes')
+    fill_parser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='Number of files hashed in parallel (0 = one per CPU, default: 1)')
+    fill_parser.add_argument('--chunk-size', type=int, default=DEFAULT_HASH_CHUNK_SIZE,
+                           help=f'Read buffer size in bytes used per hashing worker (default: {DEFAULT_HASH_CHUNK_SIZE})')
+    
+    # Merge command
+    merge_parser = subparsers.add_parser('merge',
+                                       help='Combine the shards of a snapshot (generate --shard) into one snapshot')
+    merge_parser.add_argument('shard_files', metavar='SHARD_FILE', nargs='+',
+                            help='Shard files, one per shard')
+    merge_parser.add_argument('--output', required=True,
+                            help='Resulting snapshot file')
+    merge_parser.add_argument('--compress', choices=COMPRESSION_CODECS, dest='compression',
+                            help='Store records in blocks with front-coded paths, compressed unless none')
+    
+    # Watch command
+    watch_parser = subparsers.add_parser('watch',
+                                       help='Keep a snapshot up to date, looking again only at what changed (inotify, polling elsewhere)')
+    watch_parser.add_argument('src_path', help='Source directory path')
+    watch_parser.add_argument('--output', help='Snapshot file kept up to date, next to its change journal (default: SOURCE_NAME.snap)')
+    watch_parser.add_argument('--interval', type=float, default=SnapshotWatch.DEFAULT_WATCH_INTERVAL,
+                            help=f'Seconds between two updates of the snapshot, when there were changes (default: {SnapshotWatch.DEFAULT_WATCH_INTERVAL}); '
+                                 'SIGUSR1 updates it right away')
+    watch_parser.add_argument('--poll', action='store_true',
+                            help='Walk the whole source every interval instead of using inotify')
+    watch_parser.add_argument('--ignore-hidden', action='store_true',
+                            help='Ignore hidden files and directories')
+    watch_parser.add_argument('--ignore-symlinks', action='store_true',
+                            help='Ignore symlinks')
+    watch_parser.add_argument('--max-recursion-depth', type=int, default=-1,
+                            help='Maximum recursion depth (default: unlimited)')
+    watch_parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='Number of files hashed in parallel (0 = one per CPU, default: 1)')
+    watch_parser.add_argument('--chunk-size', type=int, default=DEFAULT_HASH_CHUNK_SIZE,
+                            help=f'Read buffer size in bytes used per hashing worker (default: {DEFAULT_HASH_CHUNK_SIZE})')
+    watch_parser.add_argument('--hash', choices=HASH_ALGORITHMS, default=DEFAULT_HASH_ALGORITHM, dest='hash_name',
+                            help=f'File content hash (default: {DEFAULT_HASH_ALGORITHM})')
+    watch_parser.add_argument('--compress', choices=COMPRESSION_CODECS, dest='compression',
+                            help='Store records in blocks with front-coded paths, compressed unless none')
+    watch_parser.add_argument('--record-links', action='store_true',
+                            help='Record the device, inode and link count of every entry')
+    watch_parser.add_argument('--record-stat', action='store_true',
+                            help='Also record nanosecond times, mode, owner and group of every entry')
+    watch_parser.add_argument('--chunks', type=int, nargs='?', const=DEFAULT_CHUNK_MIN_FILE_SIZE, metavar='MIN_FILE_SIZE', dest='chunk_min_file_size',
+                            help=f'Record the content-defined chunks of files of MIN_FILE_SIZE bytes or more (default: {DEFAULT_CHUNK_MIN_FILE_SIZE})')
+    watch_parser.add_argument('--chunk-average', type=int, default=DEFAULT_CHUNK_AVG_SIZE, dest='chunk_avg_size',
+                            help=f'Average chunk size in bytes of --chunks (default: {DEFAULT_CHUNK_AVG_SIZE})')
     
     parser.add_argument('-H', '--human', action='store_true', default=False,
                         help='Use human friendly units for output')
     
     return subparsers
 
+def _add_stats_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--stats', action='store_true',
+                        help='Print the time spent in each phase (walk, hash, read, decode, diff, write...) to stderr at the end')
+    parser.add_argument('--stats-json', metavar='FILE',
+                        help='Write the phase times and counters as JSON to FILE (- for stdout)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Run under cProfile: dump the profile to FILE (for pstats or snakeviz) and print the top functions to stderr')
+
+def _shard_arg(value):
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected I/N, got {value!r}')
+    if not 0 <= index < count <= 0xffff:
+        raise argparse.ArgumentTypeError(f'shard {value} out of range')
+    return index, count
+
 _COMMAND_ARG_GENERATE = ('generate', 'g', 'w')
 _COMMAND_ARG_VIEW = ('view', 'v', 'r')
 _COMMAND_ARG_COMPARE = ('compare', 'c')
+_COMMAND_ARG_APPLY = ('apply',)
+_COMMAND_ARG_FILL_HASHES = ('fill-hashes',)
+_COMMAND_ARG_MERGE = ('merge',)
+_COMMAND_ARG_WATCH = ('watch',)
+_COMMAND_ARGS = (_COMMAND_ARG_GENERATE, _COMMAND_ARG_VIEW, _COMMAND_ARG_COMPARE, _COMMAND_ARG_APPLY,
+                 _COMMAND_ARG_FILL_HASHES, _COMMAND_ARG_MERGE, _COMMAND_ARG_WATCH)
+
+# Functions listed by --profile on stderr
+PROFILE_TOP_FUNCTIONS = 25
+
+def cli(args):
+    if getattr(args, 'profile', None):
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(_run_command, args)
+        finally:
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+            logging.info(f'Profile written to {shlex.quote(args.profile)}')
+        return
+    _run_command(args)
+
+def _run_command(args):
+    phase_stats = None
+    if getattr(args, 'stats', False) or getattr(args, 'stats_json', None):
+        phase_stats = PhaseStats(next((names[0] for names in _COMMAND_ARGS if args.command in names), args.command))
+    _run(args, phase_stats)
+    if phase_stats is None:
+        return
+    phase_stats.finish()
+    if args.stats:
+        sys.stderr.write('\n'.join(phase_stats.summary_lines()) + '\n')
+    if args.stats_json == '-':
+        phase_stats.write_json(sys.stdout)
+    elif args.stats_json:
+        with open(args.stats_json, 'w', encoding='utf-8') as out:
+            phase_stats.write_json(out)
+
+def _run(args, phase_stats):
+    if args.command in _COMMAND_ARG_GENERATE:
+        generate(args.src_path, args.ignore_hidden, args.ignore_symlinks, args.max_recursion_depth,
+                 args.output, args.output_dir, args.show, args.human, args.jobs, args.chunk_size,
+                 args.base, args.rehash, args.format_version, args.sort_paths, args.hash_name, args.hash_files, args.compression,
+                 args.shard, args.processes,
+                 ProgressLine() if (sys.stderr.isatty() if args.progress is None else args.progress) else None, args.precount,
+                 phase_stats, args.record_links, args.record_stat, args.chunk_min_file_size, args.chunk_avg_size)
+    elif args.command in _COMMAND_ARG_VIEW:
+        view(args.snapshot_file, args.human, args.path, phase_stats)
+    elif args.command in _COMMAND_ARG_COMPARE:
+        compare(args.snap_a, args.snap_b, args.human, args.format, args.output, args.ignore_hash, phase_stats)
+    elif args.command in _COMMAND_ARG_APPLY:
+        apply(args.snapshot_file, args.diff_file, args.output)
+    elif args.command in _COMMAND_ARG_FILL_HASHES:
+        fill_hashes(args.snapshot_file, args.src_path, args.paths, args.min_size, args.changed_from,
+                    args.jobs, args.chunk_size)
+    elif args.command in _COMMAND_ARG_MERGE:
+        merge(args.shard_files, args.output, args.compression)
+    elif args.command in _COMMAND_ARG_WATCH:
+        watch(args.src_path, args.output, args.interval, args.poll, args.ignore_hidden, args.ignore_symlinks,
+              args.max_recursion_depth, args.jobs, args.chunk_size, args.hash_name, args.compression,
+              args.record_links, args.record_stat, args.chunk_min_file_size, args.chunk_avg_size)
+
+# Interval between two polls of a running GUI task, and the most text inserted per poll
+GUI_POLL_INTERVAL_MS = 50
+GUI_INSERT_BATCH_CHARS = 1 << 16
+# Initial column widths of the viewer tables, in pixels
+GUI_COLUMN_WIDTHS = {'op': 40, 'type': 70, 'path': 320, 'size': 90, 'time': 140, 'hash': 160}
 
 def gui(args = None):
     GUI_LANGUAGES = {
@@ -160,6 +618,21 @@ def gui(args = None):
             'error_select_file': 'Please select a snapshot file.',
             'error_select_both_files': 'Please select both snapshot files.',
             'error_select_directory': 'Please select a source directory.',
+            'button_cancel': 'Cancel',
+            'status_ready': 'Ready',
+            'status_progress': '{entries:,} entries, {size} processed',
+            'status_output': '{lines:,} lines',
+            'status_cancelled': 'Cancelled',
+            'status_working': 'Working...',
+            'status_entries': '{shown:,} of {total:,} entries',
+            'label_filter': 'Path prefix:',
+            'button_filter': 'Filter',
+            'column_op': 'Op',
+            'column_type': 'Type',
+            'column_path': 'Path',
+            'column_size': 'Size',
+            'column_time': 'Time',
+            'column_hash': 'Hash',
             'title_license': f'License of {config.APP_NAME}',
             'title_about': f'About {config.APP_NAME}'
         },
@@ -191,6 +664,21 @@ def gui(args = None):
             'error_select_file': '请选择一个快照文件。',
             'error_select_both_files': '请选择两个快照文件。',
             'error_select_directory': '请选择一个源目录。',
+            'button_cancel': '取消',
+            'status_ready': '就绪',
+            'status_progress': '{entries:,} 个条目, 已处理 {size}',
+            'status_output': '{lines:,} 行',
+            'status_cancelled': '已取消',
+            'status_working': '处理中...',
+            'status_entries': '显示 {shown:,} / {total:,} 个条目',
+            'label_filter': '路径前缀:',
+            'button_filter': '筛选',
+            'column_op': '操作',
+            'column_type': '类型',
+            'column_path': '路径',
+            'column_size': '大小',
+            'column_time': '时间',
+            'column_hash': '哈希',
             'title_license': f'{config.APP_NAME} 的许可证',
             'title_about': f'关于 {config.APP_NAME}'
         }
@@ -265,12 +753,23 @@ def gui(args = None):
             checkbuttons[2].config(text=lang['check_show_snapshot'])
         
         gen_btn.config(text=lang['button_generate_snapshot'])
+        cancel_btn.config(text=lang['button_cancel'])
+        for label, btn in ((view_filter_label, view_filter_btn), (cmp_filter_label, cmp_filter_btn)):
+            label.config(text=lang['label_filter'])
+            btn.config(text=lang['button_filter'])
+        view_table.update_headings()
+        cmp_table.update_headings()
+        if not task_state['running']:
+            status_var.set(lang['status_ready'])
     
     def change_language(lang):
         nonlocal current_lang
         current_lang = lang
         update_ui_texts()
     
+    import io
+    import queue
+    import threading
     import tkinter as tk
     from tkinter import ttk, filedialog, messagebox
 
@@ -316,6 +815,257 @@ def gui(args = None):
 
     mainWnd.config(menu=menubar)
 
+    # Status bar
+    status_frame = ttk.Frame(mainWnd)
+    status_frame.pack(side='bottom', fill='x', padx=8, pady=(0, 4))
+    status_var = tk.StringVar(value='Ready')
+    ttk.Label(status_frame, textvariable=status_var, anchor='w').pack(side='left', fill='x', expand=True)
+    cancel_btn = ttk.Button(status_frame, text='Cancel', state='disabled')
+    cancel_btn.pack(side='right')
+
+    # Generate, view and compare run on a worker thread, so the window stays responsive.
+    # Tk may only be used from the main thread: the worker posts its output to task_queue
+    # and its progress to task_state, which poll_task() picks up through after()
+    task_queue = queue.Queue()
+    task_cancel = threading.Event()
+    task_state = {'running': False, 'output': None, 'progress': None, 'lines': 0}
+    # disabled while a task runs
+    task_buttons = []
+
+    class TaskCancelled(Exception):
+        pass
+
+    class QueueWriter(io.TextIOBase):
+        """
+        Output stream of the tasks, passed to the CLI functions they run as out.
+        """
+        def write(this, text):
+            if task_cancel.is_set():
+                raise TaskCancelled()
+            task_queue.put(('text', text))
+            if text.strip():
+                task_state['last_text'] = text.strip()
+            return len(text)
+    task_output = QueueWriter()
+
+    def on_progress(stats):
+        if task_cancel.is_set():
+            raise TaskCancelled()
+        task_state['progress'] = (stats.entries, stats.bytes_seen, stats.path)
+
+    def run_task(func, output=None, on_done=None):
+        """
+        Run func() on the worker thread; what it writes to task_output goes to the output Text widget,
+        and on_done(result) is called on the Tk thread once it returns.
+        """
+        if task_state['running']:
+            return
+        if output is not None:
+            output.delete('1.0', tk.END)
+        task_cancel.clear()
+        task_state.update(running=True, output=output, progress=None, lines=0, last_text=None)
+        status_var.set(GUI_LANGUAGES[current_lang]['status_working'])
+        for btn in task_buttons:
+            btn.config(state='disabled')
+        cancel_btn.config(state='normal')
+        def work():
+            try:
+                result = func()
+                task_queue.put(('result', result))
+            except TaskCancelled:
+                task_queue.put(('cancelled', None))
+            except SystemExit as e:
+                # The CLI functions print their error to out before exiting
+                if e.code not in (None, 0):
+                    message = e.code if isinstance(e.code, str) else task_state['last_text']
+                    task_queue.put(('error', message or f'Exit code {e.code}'))
+            except Exception as e:
+                task_queue.put(('error', str(e)))
+            task_queue.put(('done', on_done))
+        threading.Thread(target=work, daemon=True).start()
+        mainWnd.after(GUI_POLL_INTERVAL_MS, poll_task)
+
+    def poll_task():
+        lang = GUI_LANGUAGES[current_lang]
+        output = task_state['output']
+        chunks, size, done = [], 0, None
+        # Bounded batches, so a flood of output cannot stall the event loop
+        while size < GUI_INSERT_BATCH_CHARS:
+            try:
+                kind, value = task_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'text':
+                chunks.append(value)
+                size += len(value)
+            elif kind == 'result':
+                task_state['result'] = value
+            elif kind == 'error':
+                messagebox.showerror('Error', value)
+            elif kind == 'cancelled':
+                chunks.append(f"\n{lang['status_cancelled']}\n")
+            elif kind == 'done':
+                done = (value,)
+                break
+        if chunks and output is not None:
+            text = ''.join(chunks)
+            task_state['lines'] += text.count('\n')
+            output.insert(tk.END, text)
+        progress = task_state['progress']
+        if progress is not None:
+            entries, total_size, path = progress
+            status = lang['status_progress'].format(entries=entries, size=SnapshotReader._get_size_string(total_size, True))
+            status_var.set(f'{status}: {path}' if path else status)
+        elif output is not None:
+            status_var.set(lang['status_output'].format(lines=task_state['lines']))
+        if done is None:
+            mainWnd.after(GUI_POLL_INTERVAL_MS, poll_task)
+            return
+        result = task_state.pop('result', None)
+        task_state.update(running=False, output=None)
+        for btn in task_buttons:
+            btn.config(state='normal')
+        cancel_btn.config(state='disabled')
+        if task_cancel.is_set():
+            status_var.set(lang['status_cancelled'])
+        elif done[0] is not None and result is not None:
+            done[0](result)
+        elif progress is None and output is None:
+            status_var.set(lang['status_ready'])
+
+    def cancel_task():
+        task_cancel.set()
+    cancel_btn.config(command=cancel_task)
+
+    def entry_columns(entry):
+        human = human_units_var.get()
+        sized = entry['type'] not in (ENTRY_TYPE_DIR, ENTRY_TYPE_SYMLINK)
+        size = SnapshotReader._get_size_string(entry['size'], human) if sized else ''
+        time = SnapshotReader._get_time_string(entry['time'], human)
+        hash_value = entry['hash'].hex() if sized else ''
+        old = entry.get('old')
+        if old is not None:
+            if sized:
+                size = f"{SnapshotReader._get_size_string(old['size'], human)} -> {size}"
+            time = f"{SnapshotReader._get_time_string(old['time'], human)} -> {time}"
+            if sized and old['hash'] != entry['hash']:
+                hash_value = f"{old['hash'].hex()} -> {hash_value}"
+        return SnapshotReader._get_entry_type_string(entry), entry['path'], size, time, hash_value
+
+    def diff_columns(entry):
+        return (entry['op'],) + entry_columns(entry)
+
+    class VirtualTable:
+        """
+        ttk.Treeview showing a TableView: only the rows in sight are items, filled
+        again as the view scrolls, so the widget stays small whatever the number of entries.
+        Clicking a heading sorts by its column.
+        """
+        def __init__(this, parent, columns, format_row):
+            this.columns = columns
+            this.format_row = format_row
+            this.view = None
+            this.first = 0
+            this.row_height = 20
+            this.frame = ttk.Frame(parent)
+            this.tree = ttk.Treeview(this.frame, columns=columns, show='headings', selectmode='browse')
+            this.scrollbar = ttk.Scrollbar(this.frame, orient='vertical', command=this.scroll)
+            this.tree.grid(row=0, column=0, sticky='nsew')
+            this.scrollbar.grid(row=0, column=1, sticky='ns')
+            this.frame.rowconfigure(0, weight=1)
+            this.frame.columnconfigure(0, weight=1)
+            for column in columns:
+                this.tree.heading(column, command=lambda column=column: this.sort(column))
+                this.tree.column(column, width=GUI_COLUMN_WIDTHS[column], stretch=column == 'path')
+            this.tree.bind('<Configure>', lambda e: this.refresh())
+            this.tree.bind('<MouseWheel>', lambda e: this.scroll('scroll', -1 if e.delta > 0 else 1, 'wheel'))
+            this.tree.bind('<Button-4>', lambda e: this.scroll('scroll', -1, 'wheel'))
+            this.tree.bind('<Button-5>', lambda e: this.scroll('scroll', 1, 'wheel'))
+            this.tree.bind('<Prior>', lambda e: this.scroll('scroll', -1, 'pages'))
+            this.tree.bind('<Next>', lambda e: this.scroll('scroll', 1, 'pages'))
+            this.update_headings()
+
+        def visible_rows(this):
+            # The heading takes about one row
+            return max(1, this.tree.winfo_height() // this.row_height - 1)
+
+        def set_view(this, view):
+            this.view = view
+            this.first = 0
+            this.update_headings()
+            this.refresh()
+            lang = GUI_LANGUAGES[current_lang]
+            status = lang['status_entries'].format(shown=len(view), total=view.total)
+            counts = getattr(view, 'counts', None)
+            if counts is not None:
+                status += f' [Added: {counts[DIFF_ADDED]:,}, Removed: {counts[DIFF_REMOVED]:,}, Modified: {counts[DIFF_MODIFIED]:,}]'
+            status_var.set(status)
+
+        def _swap_view(this, old_view, new_view):
+            # Another snapshot may have been opened while the worker ran
+            if this.view is old_view:
+                this.set_view(new_view)
+
+        def refresh(this):
+            tree, view = this.tree, this.view
+            tree.delete(*tree.get_children())
+            if view is None:
+                this.scrollbar.set(0, 1)
+                return
+            total, count = len(view), this.visible_rows()
+            this.first = max(0, min(this.first, total - count))
+            for entry in view.page(this.first, count):
+                tree.insert('', 'end', values=this.format_row(entry))
+            items = tree.get_children()
+            if items:
+                bbox = tree.bbox(items[0])
+                if bbox:
+                    this.row_height = max(1, bbox[3])
+            if total:
+                this.scrollbar.set(this.first / total, min(1, (this.first + count) / total))
+            else:
+                this.scrollbar.set(0, 1)
+
+        def scroll(this, action, amount, unit=None):
+            if this.view is None:
+                return
+            if action == 'moveto':
+                this.first = int(float(amount) * len(this.view))
+            else:
+                step = {'pages': this.visible_rows(), 'wheel': 3}.get(unit, 1)
+                this.first += int(amount) * step
+            this.refresh()
+
+        def update_headings(this):
+            lang = GUI_LANGUAGES[current_lang]
+            for column in this.columns:
+                text = lang[f'column_{column}']
+                if this.view is not None and this.view.sort_key == column:
+                    text += ' \u25bc' if this.view.reverse else ' \u25b2'
+                this.tree.heading(column, text=text)
+
+        def sort(this, column):
+            view = this.view
+            if view is None or column not in view.SORT_KEYS:
+                return
+            reverse = view.sort_key == column and not view.reverse
+            # Sorted on the worker while the table keeps showing the current view
+            def work():
+                sorted_view = view.copy()
+                sorted_view.sort(column, reverse)
+                return sorted_view
+            run_task(work, on_done=lambda new_view: this._swap_view(view, new_view))
+
+        def filter(this, prefix):
+            view = this.view
+            if view is None:
+                return
+            def work():
+                filtered_view = view.copy()
+                filtered_view.filter(prefix)
+                return filtered_view
+            run_task(work, on_done=lambda new_view: this._swap_view(view, new_view))
+
     # TabControl
     tabControl = ttk.Notebook(mainWnd)
     style = ttk.Style()
@@ -344,26 +1094,27 @@ def gui(args = None):
     view_btn_frame = ttk.Frame(view_frame)
     view_btn_frame.pack(fill='x', padx=8, pady=(8,0))
     def do_view():
-        view_output.delete('1.0', tk.END)
         file = view_file_var.get()
         if not file:
             messagebox.showerror('Error', GUI_LANGUAGES[current_lang]['error_select_file'])
             return
-        try:
-            import io, sys
-            buf = io.StringIO()
-            sys_stdout = sys.stdout
-            sys.stdout = buf
-            view(file, human_units_var.get())
-            sys.stdout = sys_stdout
-            view_output.insert(tk.END, buf.getvalue())
-        except Exception as e:
-            sys.stdout = sys_stdout
-            messagebox.showerror('Error', str(e))
+        logging.info(f'View: Snapshot = "{shlex.quote(str(file))}"')
+        run_task(lambda: SnapshotTableView.open_view(file), on_done=view_table.set_view)
     view_btn = ttk.Button(view_btn_frame, text='View Snapshot', command=do_view)
     view_btn.pack(fill='x')
-    view_output = tk.Text(view_frame, height=10)
-    view_output.pack(fill='both', expand=True, padx=8, pady=4)
+    view_filter_frame = ttk.Frame(view_frame)
+    view_filter_frame.pack(fill='x', padx=8, pady=(8,0))
+    view_filter_label = ttk.Label(view_filter_frame, text='Path prefix:')
+    view_filter_label.grid(row=0, column=0, padx=(0,4))
+    view_filter_var = tk.StringVar()
+    view_filter_entry = ttk.Entry(view_filter_frame, textvariable=view_filter_var)
+    view_filter_entry.grid(row=0, column=1, sticky='ew')
+    view_filter_entry.bind('<Return>', lambda e: view_table.filter(view_filter_var.get()))
+    view_filter_btn = ttk.Button(view_filter_frame, text='Filter', command=lambda: view_table.filter(view_filter_var.get()))
+    view_filter_btn.grid(row=0, column=2, padx=(4,0))
+    view_filter_frame.columnconfigure(1, weight=1)
+    view_table = VirtualTable(view_frame, ('type', 'path', 'size', 'time', 'hash'), entry_columns)
+    view_table.frame.pack(fill='both', expand=True, padx=8, pady=4)
 
     # --- Snapshot Comparison ---
     cmp_frame = ttk.LabelFrame(pageViewer, text='Compare Snapshots')
@@ -397,27 +1148,29 @@ def gui(args = None):
     cmp_btn_frame = ttk.Frame(cmp_frame)
     cmp_btn_frame.pack(fill='x', padx=8, pady=(8,0))
     def do_compare():
-        cmp_output.delete('1.0', tk.END)
         a = cmp_a_var.get()
         b = cmp_b_var.get()
         if not a or not b:
             messagebox.showerror('Error', GUI_LANGUAGES[current_lang]['error_select_both_files'])
             return
-        try:
-            import io, sys
-            buf = io.StringIO()
-            sys_stdout = sys.stdout
-            sys.stdout = buf
-            compare(a, b, human_units_var.get())
-            sys.stdout = sys_stdout
-            cmp_output.insert(tk.END, buf.getvalue())
-        except Exception as e:
-            sys.stdout = sys_stdout
-            messagebox.showerror('Error', str(e))
+        logging.info(f'Compare: "{shlex.quote(str(a))}" -> "{shlex.quote(str(b))}"')
+        run_task(lambda: SnapshotTableView.DiffView.from_snapshots(a, b), on_done=cmp_table.set_view)
     cmp_btn = ttk.Button(cmp_btn_frame, text='Compare Snapshots', command=do_compare)
     cmp_btn.pack(fill='x')
-    cmp_output = tk.Text(cmp_frame, height=10)
-    cmp_output.pack(fill='both', expand=True, padx=8, pady=4)
+    cmp_filter_frame = ttk.Frame(cmp_frame)
+    cmp_filter_frame.pack(fill='x', padx=8, pady=(8,0))
+    cmp_filter_label = ttk.Label(cmp_filter_frame, text='Path prefix:')
+    cmp_filter_label.grid(row=0, column=0, padx=(0,4))
+    cmp_filter_var = tk.StringVar()
+    cmp_filter_entry = ttk.Entry(cmp_filter_frame, textvariable=cmp_filter_var)
+    cmp_filter_entry.grid(row=0, column=1, sticky='ew')
+    cmp_filter_entry.bind('<Return>', lambda e: cmp_table.filter(cmp_filter_var.get()))
+    cmp_filter_btn = ttk.Button(cmp_filter_frame, text='Filter', command=lambda: cmp_table.filter(cmp_filter_var.get()))
+    cmp_filter_btn.grid(row=0, column=2, padx=(4,0))
+    cmp_filter_frame.columnconfigure(1, weight=1)
+    cmp_table = VirtualTable(cmp_frame, ('op', 'type', 'path', 'size', 'time', 'hash'), diff_columns)
+    cmp_table.frame.pack(fill='both', expand=True, padx=8, pady=4)
+    human_units_var.trace_add('write', lambda *_: (view_table.refresh(), cmp_table.refresh()))
 
     # Generator Tab
     pageGenerate = ttk.Frame(tabControl)
@@ -466,37 +1219,25 @@ def gui(args = None):
     gen_btn_frame = ttk.Frame(pageGenerate)
     gen_btn_frame.pack(fill='x', padx=8, pady=(8,0))
     def do_generate():
-        gen_output.delete('1.0', tk.END)
         src = gen_src_var.get()
         if not src:
             messagebox.showerror('Error', GUI_LANGUAGES[current_lang]['error_select_directory'])
             return
         try:
-            import io, sys
-            buf = io.StringIO()
-            sys_stdout = sys.stdout
-            sys.stdout = buf
-            generate(
-                src,
-                gen_ignore_hidden_var.get(),
-                gen_ignore_symlinks_var.get(),
-                int(gen_max_depth_var.get()),
-                gen_output_var.get() or None,
-                gen_output_dir_var.get() or None,
-                gen_show_var.get(),
-                human_units_var.get()
-            )
-            sys.stdout = sys_stdout
-            gen_output.insert(tk.END, buf.getvalue())
-        except Exception as e:
-            sys.stdout = sys_stdout
+            max_depth = int(gen_max_depth_var.get())
+        except ValueError as e:
             messagebox.showerror('Error', str(e))
+            return
+        args = (src, gen_ignore_hidden_var.get(), gen_ignore_symlinks_var.get(), max_depth,
+                gen_output_var.get() or None, gen_output_dir_var.get() or None, gen_show_var.get(), human_units_var.get())
+        run_task(lambda: generate(*args, progress=on_progress, out=task_output), gen_output)
     gen_btn = ttk.Button(gen_btn_frame, text='Generate Snapshot', command=do_generate)
     gen_btn.pack(fill='x')
     ttk.Checkbutton(pageGenerate, text='Show Snapshot After Generation', variable=gen_show_var).pack(anchor='w', padx=8)
     gen_output = tk.Text(pageGenerate, height=15)
     gen_output.pack(fill='both', expand=True, padx=8, pady=4)
 
+    task_buttons.extend((view_btn, cmp_btn, gen_btn, view_filter_btn, cmp_filter_btn))
     tabControl.pack(expand=True, fill='both')
     
     
@@ -1,127 +1,1445 @@
 import io
+import os
+import logging
 import utils
 import struct
+import mmap
 import hashlib
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from typing import Optional
+import zlib
+import sys
+import heapq
+import shutil
+import tempfile
+import itertools
+import threading
+import importlib
+import importlib.util
+import functools
+import contextlib
+from array import array
+from time import perf_counter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from pathlib import Path
+from SnapshotBlocks import (CompressionCodec, COMPRESSION_CODEC_IDS, get_compression_codec, shared_prefix_size,
+                            append_varint, read_varint, BLOCK_HEADER_FORMAT, DEFAULT_BLOCK_SIZE)
+from SnapshotStats import PhaseStats, TimedFile
+from SnapshotChunks import (ContentChunker, changed_ranges, write_chunk_section, read_chunk_section,
+                            DEFAULT_CHUNK_AVG_SIZE, CHANGED_RANGES_SHOWN)
 
 SNAPSHOT_FILE_HEADER = b'DISK01SNAP'
+SNAPSHOT_FILE_HEADER_V2 = b'DISK02SNAP'
 ENTRY_TYPE_FILE = 1
 ENTRY_TYPE_DIR = 2
 ENTRY_TYPE_SYMLINK = 3
+ENTRY_TYPE_NAMES = {ENTRY_TYPE_FILE: 'FILE', ENTRY_TYPE_DIR: 'DIR', ENTRY_TYPE_SYMLINK: 'SYMLINK'}
+# Set in the type byte of a file record whose hash was not computed (generate --no-hash);
+# its hash field holds zeros until fill-hashes writes the hash and clears the flag
+ENTRY_FLAG_UNHASHED = 0x80
+ENTRY_TYPE_MASK = 0x7f
 
-# Binary entry format: type(1) | path_len(2) | path(utf8) | size(8) | time(8) | hash(32)
-ENTRY_HEADER_FORMAT = '<B H'
+# Binary entry format: type(1) | path_len | path(utf8) | size(8) | time(8) | hash(digest_size)
+# path_len is an unsigned LEB128 varint in v2 files (one byte for most paths) and a uint16 in v1 files;
+# v1 files and v2 files without SNAPSHOT_FLAG_HASH_ALGO hold 32-byte SHA-256 hashes
+ENTRY_HEADER_FORMAT = '<B H'  # v1
+# Longest path a v1 record holds
+V1_MAX_PATH_SIZE = 0xffff
 ENTRY_FILE_FORMAT = '<Q Q 32s'  # size, time, hash
+NULL_HASH = b'\x00' * 32
+
+def entry_file_format(digest_size):
+    return f'<Q Q {digest_size}s'
+
+# v2 file: magic | header | records | index | footer
+# header: header_size(2) | flags(4) | hash_algo(1) | digest_size(1) | compression(1)
+#         | shard_index(2) | shard_count(2) | extra_fields(4)
+# compression (see SnapshotBlocks), the shard fields and extra_fields (the EXTRA_FIELD_* mask)
+# only mean something with SNAPSHOT_FLAG_BLOCKS, SNAPSHOT_FLAG_SHARD and SNAPSHOT_FLAG_EXTRA_FIELDS
+SNAPSHOT_V2_HEADER_FORMAT = '<H I B B B H H I'
+SNAPSHOT_FLAG_INDEXED = 0x1
+# records are in canonical path order (see path_sort_key)
+SNAPSHOT_FLAG_SORTED = 0x2
+# hashes are not SHA-256: set so that readers unaware of hash_algo refuse the file
+SNAPSHOT_FLAG_HASH_ALGO = 0x4
+# some records may carry ENTRY_FLAG_UNHASHED
+SNAPSHOT_FLAG_UNHASHED = 0x8
+# records are front-coded into blocks, compressed unless the codec is 'none';
+# index offsets point to the block holding the record
+SNAPSHOT_FLAG_BLOCKS = 0x10
+# records are one shard of a snapshot (generate --shard): the root and the top-level entries assigned to it
+SNAPSHOT_FLAG_SHARD = 0x20
+# records end with the extra fields of the header's extra_fields mask, after the hash
+SNAPSHOT_FLAG_EXTRA_FIELDS = 0x40
+# a chunk section (see SnapshotChunks) lies between the index and the footer
+SNAPSHOT_FLAG_CHUNKS = 0x80
+SNAPSHOT_KNOWN_FLAGS = (SNAPSHOT_FLAG_INDEXED | SNAPSHOT_FLAG_SORTED | SNAPSHOT_FLAG_HASH_ALGO | SNAPSHOT_FLAG_UNHASHED
+                        | SNAPSHOT_FLAG_BLOCKS | SNAPSHOT_FLAG_SHARD | SNAPSHOT_FLAG_EXTRA_FIELDS | SNAPSHOT_FLAG_CHUNKS)
+# offset of the flags field in v2 files
+_SNAPSHOT_V2_FLAGS_OFFSET = len(SNAPSHOT_FILE_HEADER_V2) + 2
+# index: one path_key(8) | record_offset(8) per record, sorted by path_key (see path_key())
+INDEX_ENTRY_FORMAT = '<Q Q'
+# footer: index_offset(8) | entry_count(8) | magic(8)
+SNAPSHOT_FOOTER_FORMAT = '<Q Q 8s'
+SNAPSHOT_FOOTER_MAGIC = b'DSNAPIDX'
+
+DEFAULT_HASH_CHUNK_SIZE = 1024 * 1024
+
+# Records per in-memory run when an unsorted snapshot is sorted for comparison
+EXTERNAL_SORT_RUN_SIZE = 1 << 19
+
+DIFF_ADDED = '+'
+DIFF_REMOVED = '-'
+DIFF_MODIFIED = '*'
+
+# Lines gathered before each write when printing large outputs
+PRINT_BATCH_LINES = 4096
+
+# Bytes of encoded records gathered before each write of SnapshotFileWriter
+WRITE_BUFFER_SIZE = 1 << 20
+
+_ENTRY_HEADER_STRUCT = struct.Struct(ENTRY_HEADER_FORMAT)
+_SNAPSHOT_V2_HEADER_STRUCT = struct.Struct(SNAPSHOT_V2_HEADER_FORMAT)
+_ENTRY_FILE_STRUCT = struct.Struct(ENTRY_FILE_FORMAT)
+_INDEX_ENTRY_STRUCT = struct.Struct(INDEX_ENTRY_FORMAT)
+# size and time, which lead the fields after the path whatever the digest size
+_ENTRY_SIZE_TIME_STRUCT = struct.Struct('<Q Q')
+_BLOCK_HEADER_STRUCT = struct.Struct(BLOCK_HEADER_FORMAT)
+
+# Optional fields of every record, taken from its stat result (st_<name>) and stored
+# after the hash in this order when their bit is in the extra_fields mask:
+# (bit, name, struct format, whether compare reports a change of it)
+EXTRA_FIELD_DEV = 0x1
+EXTRA_FIELD_INO = 0x2
+EXTRA_FIELD_NLINK = 0x4
+EXTRA_FIELD_MTIME_NS = 0x8
+EXTRA_FIELD_CTIME_NS = 0x10
+EXTRA_FIELD_MODE = 0x20
+EXTRA_FIELD_UID = 0x40
+EXTRA_FIELD_GID = 0x80
+EXTRA_FIELDS = (
+    (EXTRA_FIELD_DEV, 'dev', 'Q', False),
+    (EXTRA_FIELD_INO, 'ino', 'Q', True),
+    (EXTRA_FIELD_NLINK, 'nlink', 'I', True),
+    (EXTRA_FIELD_MTIME_NS, 'mtime_ns', 'q', True),
+    # also changed by chmod, chown, link and rename: only used to trust base hashes
+    (EXTRA_FIELD_CTIME_NS, 'ctime_ns', 'q', False),
+    (EXTRA_FIELD_MODE, 'mode', 'I', True),
+    (EXTRA_FIELD_UID, 'uid', 'I', True),
+    (EXTRA_FIELD_GID, 'gid', 'I', True),
+)
+# generate --record-links
+EXTRA_FIELDS_LINKS = EXTRA_FIELD_DEV | EXTRA_FIELD_INO | EXTRA_FIELD_NLINK
+# generate --record-stat
+EXTRA_FIELDS_STAT = (EXTRA_FIELDS_LINKS | EXTRA_FIELD_MTIME_NS | EXTRA_FIELD_CTIME_NS
+                     | EXTRA_FIELD_MODE | EXTRA_FIELD_UID | EXTRA_FIELD_GID)
+# Fields that must match too (when both snapshots have them) for --base to reuse a hash:
+# rewrites within the second of the recorded time, or that restored it, still change these
+EXTRA_FIELDS_STAMP = EXTRA_FIELD_INO | EXTRA_FIELD_MTIME_NS | EXTRA_FIELD_CTIME_NS
+EXTRA_FIELDS_KNOWN = sum(bit for bit, *_ in EXTRA_FIELDS)
+
+@functools.lru_cache(maxsize=None)
+def extra_fields_struct(mask):
+    return struct.Struct('<' + ''.join(fmt for bit, _, fmt, _ in EXTRA_FIELDS if mask & bit))
+
+@functools.lru_cache(maxsize=None)
+def extra_field_names(mask):
+    return tuple(name for bit, name, _, _ in EXTRA_FIELDS if mask & bit)
+
+@functools.lru_cache(maxsize=None)
+def entry_file_struct(digest_size):
+    return struct.Struct(entry_file_format(digest_size))
+
+class HashAlgorithm:
+    """
+    Content hash recorded for files. id and digest_size are stored in the v2 header;
+    module names the optional package the algorithm comes from.
+    """
+    __slots__ = ('name', 'id', 'digest_size', 'module', '_new')
+
+    def __init__(this, name, algo_id, digest_size, new, module=None):
+        this.name = name
+        this.id = algo_id
+        this.digest_size = digest_size
+        this.module = module
+        this._new = new
+
+    def available(this):
+        return this.module is None or importlib.util.find_spec(this.module) is not None
+
+    def new(this):
+        """
+        Return a fresh hasher (update()/digest()), or None for the 'none' algorithm.
+        """
+        return this._new() if this._new is not None else None
+
+def _optional_hasher(module, name, **kwargs):
+    return lambda: getattr(importlib.import_module(module), name)(**kwargs)
+
+HASH_ALGORITHMS = {algo.name: algo for algo in (
+    # Files are not read: compare falls back to size and time
+    HashAlgorithm('none', 0, 0, None),
+    HashAlgorithm('sha256', 1, 32, hashlib.sha256),
+    HashAlgorithm('blake2b', 2, 32, functools.partial(hashlib.blake2b, digest_size=32)),
+    HashAlgorithm('xxh3', 3, 16, _optional_hasher('xxhash', 'xxh3_128'), 'xxhash'),
+    HashAlgorithm('blake3', 4, 32, _optional_hasher('blake3', 'blake3'), 'blake3'),
+)}
+HASH_ALGORITHM_IDS = {algo.id: algo for algo in HASH_ALGORITHMS.values()}
+DEFAULT_HASH_ALGORITHM = 'sha256'
+
+def get_hash_algorithm(name):
+    """
+    Return the HashAlgorithm called name; ValueError if it is unknown or its package is not installed.
+    """
+    algo = HASH_ALGORITHMS.get(name)
+    if algo is None:
+        raise ValueError(f'Unknown hash algorithm: {name}')
+    if not algo.available():
+        raise ValueError(f'Hash algorithm {name} needs the {algo.module} package (pip install {algo.module})')
+    return algo
+
+def path_key(rel_path:bytes):
+    """
+    Key of a record path (utf-8 bytes) in the v2 index: its CRC-32, the cheapest stable
+    hash at hand. Paths sharing a key are told apart by lookups, which check every record of a key.
+    """
+    return zlib.crc32(rel_path)
+
+def shard_of(name:bytes, shard_count):
+    """
+    Shard of a top-level entry name (utf-8 bytes): the same on every host and run.
+    """
+    return path_key(name) % shard_count
+
+_PATH_SEP = os.sep.encode('utf-8')
+
+def path_sort_key(rel_path:bytes):
+    """
+    Canonical order key of a record path: byte order, component by component,
+    which is the pre-order of a walk visiting each directory's entries by name.
+    """
+    return rel_path.replace(_PATH_SEP, b'\x00')
+
+# Max records queued per worker while waiting for their hashes (parallel mode)
+PARALLEL_WINDOW_PER_JOB = 16
+
+# Records written between two calls of SnapshotWriter's progress callback
+PROGRESS_INTERVAL = 256
+# Files kept in WriteStats.slowest
+SLOWEST_FILES_KEPT = 10
+# Smaller files are not timed: their hashing is too quick for the timing to be worth its cost
+SLOWEST_FILES_MIN_SIZE = 1 << 18
+
+class DiffEvent:
+    """
+    One difference between two snapshots: kind is DIFF_ADDED, DIFF_REMOVED or DIFF_MODIFIED,
+    old/new are the entries in the first/second snapshot (None when absent).
+    changed_ranges lists the (start, end) byte ranges of a modified file that changed,
+    when both snapshots hold its chunk manifest; None otherwise.
+    """
+    __slots__ = ('kind', 'old', 'new', 'changed_ranges')
+
+    def __init__(this, kind, old, new):
+        this.kind = kind
+        this.old = old
+        this.new = new
+        this.changed_ranges = None
+
+    @property
+    def entry(this):
+        return this.new if this.new is not None else this.old
+
+class SnapshotInfo:
+    """
+    What the header (and footer) of a snapshot file says about its layout.
+    """
+    __slots__ = ('version', 'flags', 'records_start', 'records_end', 'index_offset', 'entry_count', 'hash_id', 'digest_size',
+                 'compression', 'shard_index', 'shard_count', 'extra_fields', 'chunks_offset', 'chunks_end')
+
+    def __init__(this, version, flags, records_start, records_end, index_offset=None, entry_count=None,
+                 hash_id=1, digest_size=32, compression=None,
+                 shard_index=None, shard_count=None, extra_fields=0, chunks_offset=None, chunks_end=None):
+        this.version = version
+        this.flags = flags
+        this.records_start = records_start
+        this.records_end = records_end
+        # None when the file has no index
+        this.index_offset = index_offset
+        this.entry_count = entry_count
+        this.hash_id = hash_id
+        this.digest_size = digest_size
+        # codec id of block files, None when records are stored one after the other
+        this.compression = compression
+        # None unless the file is a shard
+        this.shard_index = shard_index
+        this.shard_count = shard_count
+        # EXTRA_FIELD_* mask of the fields each record holds after its hash
+        this.extra_fields = extra_fields
+        # span of the chunk section, None when the file has none
+        this.chunks_offset = chunks_offset
+        this.chunks_end = chunks_end
+
+    @property
+    def fields_size(this):
+        """
+        Bytes of a record after its path.
+        """
+        return entry_file_struct(this.digest_size).size + extra_fields_struct(this.extra_fields).size
+
+    @property
+    def is_sorted(this):
+        return bool(this.flags & SNAPSHOT_FLAG_SORTED)
+
+    @property
+    def hash_name(this):
+        algo = HASH_ALGORITHM_IDS.get(this.hash_id)
+        return algo.name if algo is not None else f'unknown-{this.hash_id}'
+
+    @property
+    def codec(this):
+        """
+        CompressionCodec of the blocks, None when the records are not in blocks.
+        """
+        if this.compression is None:
+            return None
+        codec = COMPRESSION_CODEC_IDS.get(this.compression)
+        if codec is None:
+            raise ValueError(f'Unsupported snapshot compression (id {this.compression})')
+        return get_compression_codec(codec.name)
+
+class SnapshotRecord:
+    """
+    Read-only view of one record inside a mapped snapshot file.
+    Numeric fields are unpacked up front; path and hash are only sliced out
+    of the mapping (and the path decoded) when accessed.
+    The hash of a file recorded without hashing is b''.
+    Supports entry['key'] access like the dicts returned by read_snapshot.
+    """
+    __slots__ = ('_buf', '_start', '_path_start', '_path_end', '_hash_end', 'type', 'size', 'time')
+    _KEYS = ('type', 'path', 'size', 'time', 'hash')
+    # EXTRA_FIELD_* mask of the fields after the hash (see SnapshotExtraRecord)
+    extra_fields = 0
+
+    def __init__(this, buf, start, path_start, path_end, hash_end, entry_type, size, time):
+        this._buf = buf
+        # offset of the type byte
+        this._start = start
+        this._path_start = path_start
+        this._path_end = path_end
+        this._hash_end = hash_end
+        this.type = entry_type
+        this.size = size
+        this.time = time
+
+    @property
+    def path_bytes(this):
+        return this._buf[this._path_start:this._path_end]
+
+    @property
+    def path(this):
+        return this.path_bytes.decode('utf-8')
+
+    @property
+    def hash(this):
+        if this._buf[this._start] & ENTRY_FLAG_UNHASHED:
+            return b''
+        return this._buf[this._path_end + 16:this._hash_end]
+
+    @property
+    def extra(this):
+        """
+        {name: value} of the extra fields.
+        """
+        return {}
+
+    def __getitem__(this, key):
+        if key not in SnapshotRecord._KEYS:
+            raise KeyError(key)
+        return getattr(this, key)
+
+    def get(this, key, default=None):
+        return getattr(this, key) if key in SnapshotRecord._KEYS else this.extra.get(key, default)
+
+    @property
+    def raw_bytes(this):
+        """
+        The whole encoded record, in the v2 layout.
+        """
+        return this._buf[this._start:this._hash_end]
+
+    def to_dict(this):
+        return {'type': this.type, 'path': this.path, 'size': this.size, 'time': this.time, 'hash': this.hash}
+
+class SnapshotExtraRecord(SnapshotRecord):
+    """
+    SnapshotRecord of a file with extra fields (SNAPSHOT_FLAG_EXTRA_FIELDS), which are
+    unpacked when accessed and can be read as entry['name'] too.
+    """
+    __slots__ = ('_end', 'extra_fields')
+
+    def __init__(this, buf, start, path_start, path_end, hash_end, entry_type, size, time, end, extra_fields):
+        super().__init__(buf, start, path_start, path_end, hash_end, entry_type, size, time)
+        this._end = end
+        this.extra_fields = extra_fields
+
+    @property
+    def extra(this):
+        mask = this.extra_fields
+        return dict(zip(extra_field_names(mask), extra_fields_struct(mask).unpack_from(this._buf, this._hash_end)))
+
+    def __getitem__(this, key):
+        if key in SnapshotRecord._KEYS:
+            return getattr(this, key)
+        return this.extra[key]
+
+    @property
+    def raw_bytes(this):
+        return this._buf[this._start:this._end]
+
+    def to_dict(this):
+        entry = super().to_dict()
+        entry.update(this.extra)
+        return entry
+
+class _SnapshotV1Record(SnapshotRecord):
+    """
+    SnapshotRecord of a v1 file, whose raw_bytes are converted to the v2 layout.
+    """
+    __slots__ = ()
+
+    @property
+    def raw_bytes(this):
+        record = bytearray((this._buf[this._start],))
+        append_varint(record, this._path_end - this._path_start)
+        record += this._buf[this._path_start:this._hash_end]
+        return bytes(record)
+
+class SnapshotTable:
+    """
+    Columnar in-memory form of a snapshot: one array per numeric field, all
+    hashes in one buffer and all paths in one blob addressed by offsets.
+    Row i is the i-th record of the file. The GUI lists block-compressed files
+    through it (plain ones are viewed straight from the mapping, see RecordView)
+    and DiffView collects compared entries in one. Takes about a fifth of the
+    memory of read_snapshot's dicts; the columns support the buffer protocol
+    (e.g. numpy.frombuffer).
+    """
+    def __init__(this, hash_name=DEFAULT_HASH_ALGORITHM, digest_size=32):
+        this.hash_name = hash_name
+        this.digest_size = digest_size
+        this.types = array('B')
+        this.sizes = array('Q')
+        this.times = array('Q')
+        this.hashes = bytearray()
+        this.paths = bytearray()
+        # path of row i is paths[path_offsets[i]:path_offsets[i + 1]]
+        this.path_offsets = array('Q', [0])
+        # rows of files recorded without hashing
+        this._unhashed = set()
+
+    def __len__(this):
+        return len(this.types)
+
+    def path_bytes(this, row):
+        return bytes(this.paths[this.path_offsets[row]:this.path_offsets[row + 1]])
+
+    def path(this, row):
+        return this.path_bytes(row).decode('utf-8')
+
+    def hash(this, row):
+        if row in this._unhashed:
+            return b''
+        return bytes(this.hashes[row * this.digest_size:(row + 1) * this.digest_size])
+
+    def entry(this, row):
+        return {'type': this.types[row], 'path': this.path(row), 'size': this.sizes[row], 'time': this.times[row], 'hash': this.hash(row)}
+
+    def __getitem__(this, row):
+        return this.entry(row)
+
+    def append(this, entry_type, rel_path:bytes, size, time, hash_value):
+        this.types.append(entry_type)
+        this.sizes.append(size)
+        this.times.append(time)
+        if not hash_value and this.digest_size:
+            this._unhashed.add(len(this.types) - 1)
+            hash_value = bytes(this.digest_size)
+        this.hashes += hash_value
+        this.paths += rel_path
+        this.path_offsets.append(len(this.paths))
+
+class SnapshotFileWriter:
+    """
+    Encodes records into an open binary file: the header on creation, then
+    one record per write_record(), and the index and footer on finish().
+    Records are packed into a reusable WRITE_BUFFER_SIZE buffer that is
+    written out whenever the next record does not fit; finish() writes the rest.
+    With a compression codec, records are front-coded into blocks of about
+    block_size bytes instead, each compressed on its own (see SnapshotBlocks);
+    codec 'none' only front-codes them. Only block files front-code paths;
+    paths of v1 files are at most V1_MAX_PATH_SIZE bytes.
+    shard is the (index, count) recorded in the header of a partial snapshot.
+    With an extra_fields mask, records are (type, rel_path, size, time, hash, extra values)
+    tuples, the values in EXTRA_FIELDS order.
+    With a ContentChunker, the manifests given to add_chunk_manifest() are written
+    into a chunk section by finish().
+    Block compression is timed as the 'compress' phase of phase_stats when given.
+    """
+    def __init__(this, f:io.BufferedWriter, version=2, sort_paths=False, hash_name=DEFAULT_HASH_ALGORITHM,
+                 compression=None, block_size=DEFAULT_BLOCK_SIZE, shard=None, phase_stats:PhaseStats=None, extra_fields=0,
+                 chunker:ContentChunker=None):
+        this._f = f
+        this._phase_stats = phase_stats
+        this._codec = get_compression_codec(compression) if compression is not None else None
+        this._block_size = block_size
+        this._block = bytearray()
+        this._block_count = 0
+        this._block_prev = b''
+        algo = HASH_ALGORITHMS[hash_name]
+        if extra_fields & ~EXTRA_FIELDS_KNOWN:
+            raise ValueError(f'Unknown extra fields (0x{extra_fields:x})')
+        this._extra_fields = extra_fields
+        this._extra_struct = extra_fields_struct(extra_fields)
+        # The extra fields are packed after the hash, as if part of it
+        this._fields = entry_file_struct(algo.digest_size + this._extra_struct.size)
+        this._digest_size = algo.digest_size
+        # Grown for a record that does not fit on its own
+        this._buffer = bytearray(WRITE_BUFFER_SIZE)
+        this._buffer_pos = 0
+        # (path_key << 64 | offset) per record, sorted into the index by finish()
+        this._index = None
+        this._flags = None
+        this._chunker = chunker
+        # rel_path -> chunk manifest
+        this._manifests = {}
+        if version == 1:
+            if hash_name != 'sha256':
+                raise ValueError('Snapshot format version 1 only stores sha256 hashes')
+            if this._codec is not None:
+                raise ValueError('Snapshot format version 1 cannot be compressed')
+            if shard is not None:
+                raise ValueError('Snapshot format version 1 cannot be sharded')
+            if extra_fields:
+                raise ValueError('Snapshot format version 1 cannot record extra fields')
+            if chunker is not None:
+                raise ValueError('Snapshot format version 1 cannot hold chunk manifests')
+            f.write(SNAPSHOT_FILE_HEADER)
+            this._offset = len(SNAPSHOT_FILE_HEADER)
+            return
+        flags = SNAPSHOT_FLAG_INDEXED
+        if sort_paths:
+            flags |= SNAPSHOT_FLAG_SORTED
+        if hash_name != 'sha256':
+            flags |= SNAPSHOT_FLAG_HASH_ALGO
+        if chunker is not None:
+            if not algo.digest_size:
+                raise ValueError('Chunk manifests need a hash algorithm')
+            flags |= SNAPSHOT_FLAG_CHUNKS
+        f.write(SNAPSHOT_FILE_HEADER_V2)
+        compression, shard_index, shard_count = 0, 0, 0
+        if this._codec is not None:
+            flags |= SNAPSHOT_FLAG_BLOCKS
+            compression = this._codec.id
+        if shard is not None:
+            flags |= SNAPSHOT_FLAG_SHARD
+            shard_index, shard_count = shard
+        if extra_fields:
+            flags |= SNAPSHOT_FLAG_EXTRA_FIELDS
+        f.write(_SNAPSHOT_V2_HEADER_STRUCT.pack(_SNAPSHOT_V2_HEADER_STRUCT.size, flags, algo.id, algo.digest_size,
+                                                compression, shard_index, shard_count, extra_fields))
+        this._offset = len(SNAPSHOT_FILE_HEADER_V2) + _SNAPSHOT_V2_HEADER_STRUCT.size
+        this._index = []
+        this._flags = flags
+
+    def write_record(this, entry_type, rel_path:bytes, size, time, hash_value):
+        """
+        An empty hash_value records a file that was not hashed.
+        """
+        this.write_records(((entry_type, rel_path, size, time, hash_value),))
+
+    def write_records(this, records):
+        """
+        Write an iterable of (type, rel_path, size, time, hash) tuples, as write_record() does.
+        """
+        if this._extra_fields:
+            records = this._pack_extra_fields(records)
+        if this._codec is not None:
+            this._write_records_blocked(records)
+            return
+        buffer = this._buffer
+        buffer_size = len(buffer)
+        v1 = this._flags is None
+        pack_v1_header = _ENTRY_HEADER_STRUCT.pack_into
+        pack_fields = this._fields.pack_into
+        fields_size = this._fields.size
+        digest_size = this._digest_size
+        index_append = this._index.append if this._index is not None else None
+        # path_key() inlined: its call costs about as much as the rest of the record
+        crc32 = zlib.crc32
+        pos = this._buffer_pos
+        # file offset of buffer[0]
+        start = this._offset - pos
+        try:
+            for entry_type, rel_path, size, time, hash_value in records:
+                if not hash_value and digest_size:
+                    if this._flags is None:
+                        raise ValueError('Snapshot format version 1 cannot record files without their hash')
+                    entry_type |= ENTRY_FLAG_UNHASHED
+                    this._flags |= SNAPSHOT_FLAG_UNHASHED
+                path_len = len(rel_path)
+                if v1:
+                    if path_len > V1_MAX_PATH_SIZE:
+                        raise ValueError(f'Path too long for a version 1 snapshot ({path_len:,} bytes): {rel_path[:64]!r}...')
+                    header_size = 3
+                else:
+                    header_size = 2 if path_len < 0x80 else 1 + (path_len.bit_length() + 6) // 7
+                end = pos + header_size + path_len + fields_size
+                if end > buffer_size:
+                    this._f.write(memoryview(buffer)[:pos])
+                    start += pos
+                    end -= pos
+                    pos = 0
+                    if end > buffer_size:
+                        buffer = this._buffer = bytearray(end)
+                        buffer_size = end
+                if index_append is not None:
+                    index_append(crc32(rel_path) << 64 | (start + pos))
+                if path_len < 0x80 and not v1:
+                    buffer[pos] = entry_type
+                    buffer[pos + 1] = path_len
+                elif v1:
+                    pack_v1_header(buffer, pos, entry_type, path_len)
+                else:
+                    header = bytearray((entry_type,))
+                    append_varint(header, path_len)
+                    buffer[pos:pos + header_size] = header
+                pos += header_size
+                buffer[pos:pos + path_len] = rel_path
+                pack_fields(buffer, pos + path_len, size, time, hash_value)
+                pos = end
+        finally:
+            this._buffer_pos = pos
+            this._offset = start + pos
+
+    def _pack_extra_fields(this, records):
+        # Turn each record into one whose hash field carries the packed extra fields,
+        # zeros standing in for the hash of a file recorded without it
+        pack_extra = this._extra_struct.pack
+        digest_size = this._digest_size
+        null_hash = bytes(digest_size)
+        for entry_type, rel_path, size, time, hash_value, extra in records:
+            if not hash_value and digest_size:
+                if this._flags is None:
+                    raise ValueError('Snapshot format version 1 cannot record files without their hash')
+                entry_type |= ENTRY_FLAG_UNHASHED
+                this._flags |= SNAPSHOT_FLAG_UNHASHED
+                hash_value = null_hash
+            elif len(hash_value) != digest_size:
+                hash_value = hash_value[:digest_size].ljust(digest_size, b'\x00')
+            yield entry_type, rel_path, size, time, hash_value + pack_extra(*extra)
+
+    def _write_records_blocked(this, records):
+        block = this._block
+        block_size = this._block_size
+        append = block.append
+        pack_fields = this._fields.pack
+        digest_size = this._digest_size
+        index_append = this._index.append
+        crc32 = zlib.crc32
+        # Paths are front-coded against the previous one of the same block only
+        prev = this._block_prev
+        try:
+            for entry_type, rel_path, size, time, hash_value in records:
+                if not hash_value and digest_size:
+                    entry_type |= ENTRY_FLAG_UNHASHED
+                    this._flags |= SNAPSHOT_FLAG_UNHASHED
+                shared = shared_prefix_size(prev, rel_path) if prev else 0
+                suffix_len = len(rel_path) - shared
+                index_append(crc32(rel_path) << 64 | this._offset)
+                append(entry_type)
+                if shared < 0x80:
+                    append(shared)
+                else:
+                    append_varint(block, shared)
+                if suffix_len < 0x80:
+                    append(suffix_len)
+                else:
+                    append_varint(block, suffix_len)
+                block += rel_path[shared:]
+                block += pack_fields(size, time, hash_value)
+                this._block_count += 1
+                prev = rel_path
+                if len(block) >= block_size:
+                    this._write_block()
+                    prev = b''
+        finally:
+            this._block_prev = prev
+
+    def _write_block(this):
+        """
+        Compress the pending block and write it at this._offset, which the index entries of its records point to.
+        """
+        if not this._block_count:
+            return
+        if this._phase_stats is not None:
+            prev = this._phase_stats.switch('compress')
+            data = this._codec.compress(bytes(this._block))
+            this._phase_stats.switch(prev)
+        else:
+            data = this._codec.compress(bytes(this._block))
+        this._f.write(_BLOCK_HEADER_STRUCT.pack(len(this._block), len(data), this._block_count))
+        this._f.write(data)
+        this._offset += _BLOCK_HEADER_STRUCT.size + len(data)
+        this._block.clear()
+        this._block_count = 0
+        this._block_prev = b''
+
+    def _flush(this):
+        if this._buffer_pos:
+            this._f.write(memoryview(this._buffer)[:this._buffer_pos])
+            this._buffer_pos = 0
+
+    def write_entry(this, entry):
+        """
+        Write a SnapshotRecord or entry dict; extra fields it does not have are recorded as 0.
+        """
+        rel_path = entry.path_bytes if isinstance(entry, SnapshotRecord) else entry['path'].encode('utf-8')
+        record = (entry['type'], rel_path, entry['size'], entry['time'], entry['hash'])
+        if this._extra_fields:
+            record += (tuple(entry.get(name, 0) for name in extra_field_names(this._extra_fields)),)
+        this.write_records((record,))
+
+    def add_chunk_manifest(this, rel_path:bytes, manifest):
+        if this._chunker is None:
+            raise ValueError('Snapshot written without chunk manifests')
+        this._manifests[rel_path] = manifest
+
+    def finish(this):
+        this._flush()
+        if this._codec is not None:
+            this._write_block()
+        if this._index is None:
+            return
+        if this._flags & SNAPSHOT_FLAG_UNHASHED:
+            # Only known once records are written: patch the header
+            this._f.seek(_SNAPSHOT_V2_FLAGS_OFFSET)
+            this._f.write(struct.pack('<I', this._flags))
+            this._f.seek(this._offset)
+        index_offset = this._offset
+        this._index.sort()
+        # key, offset pairs interleaved in one array, written as a single block
+        mask = (1 << 64) - 1
+        index = array('Q', bytes(16 * len(this._index)))
+        index[0::2] = array('Q', (item >> 64 for item in this._index))
+        index[1::2] = array('Q', (item & mask for item in this._index))
+        if sys.byteorder != 'little':
+            index.byteswap()
+        this._f.write(index)
+        if this._chunker is not None:
+            write_chunk_section(this._f, this._chunker, sorted(this._manifests.items()), this._digest_size)
+            this._manifests = {}
+        this._f.write(struct.pack(SNAPSHOT_FOOTER_FORMAT, index_offset, len(this._index), SNAPSHOT_FOOTER_MAGIC))
+        this._index = None
+
+class _FileHasher:
+    """
+    Hashes files with one algorithm; each thread reads through its own reusable chunk_size buffer.
+    """
+    def __init__(this, algo:HashAlgorithm, chunk_size=DEFAULT_HASH_CHUNK_SIZE):
+        this._algo = algo
+        this._chunk_size = max(1, chunk_size)
+        this._buffers = threading.local()
+
+    def hash(this, path):
+        buffer = getattr(this._buffers, 'buffer', None)
+        if buffer is None:
+            buffer = this._buffers.buffer = bytearray(this._chunk_size)
+        return utils.hash_file(path, this._algo.new(), buffer).digest()
+
+class WriteStats:
+    """
+    Counters of a running SnapshotWriter, as handed to its progress callback.
+    bytes_seen adds up the size of every file recorded, bytes_hashed only of those read;
+    hashes_linked counts files given the hash of an earlier hard link to the same inode;
+    expected_entries and expected_bytes (None when unknown) estimate the totals for eta().
+    slowest holds (seconds, path) of the files that took longest to hash, as a heap
+    (only files of SLOWEST_FILES_MIN_SIZE bytes or more are timed).
+    """
+    __slots__ = ('start', 'elapsed', 'entries', 'files', 'bytes_seen', 'files_hashed', 'bytes_hashed', 'hashes_reused',
+                 'hashes_linked', 'slowest', 'path', 'expected_entries', 'expected_bytes')
+
+    def __init__(this, expected_entries=None, expected_bytes=None):
+        this.start = perf_counter()
+        this.elapsed = 0.0
+        this.entries = 0
+        this.files = 0
+        this.bytes_seen = 0
+        this.files_hashed = 0
+        this.bytes_hashed = 0
+        this.hashes_reused = 0
+        this.hashes_linked = 0
+        this.slowest = []
+        # last path written, None once the snapshot is complete
+        this.path = None
+        this.expected_entries = expected_entries
+        this.expected_bytes = expected_bytes
+
+    def files_per_second(this):
+        return this.files / this.elapsed if this.elapsed else 0.0
+
+    def bytes_per_second(this):
+        """
+        Hashing throughput over the wall time.
+        """
+        return this.bytes_hashed / this.elapsed if this.elapsed else 0.0
+
+    def eta(this):
+        """
+        Seconds left, extrapolated from the share of the expected bytes (or entries) done; None when unknown.
+        """
+        if this.expected_bytes and this.bytes_seen:
+            done = this.bytes_seen / this.expected_bytes
+        elif this.expected_entries and this.entries:
+            done = this.entries / this.expected_entries
+        else:
+            return None
+        return max(0.0, this.elapsed * (1 - done) / done) if done < 1 else 0.0
+
+    def slowest_files(this):
+        """
+        (seconds, path) of the slowest files to hash, slowest first.
+        """
+        return sorted(this.slowest, reverse=True)
+
+    def add(this, other):
+        """
+        Add the counters of another writer, e.g. of a shard.
+        """
+        for name in ('entries', 'files', 'bytes_seen', 'files_hashed', 'bytes_hashed', 'hashes_reused', 'hashes_linked'):
+            setattr(this, name, getattr(this, name) + getattr(other, name))
+        this.slowest = heapq.nlargest(SLOWEST_FILES_KEPT, this.slowest + other.slowest)
+        heapq.heapify(this.slowest)
 
 class SnapshotWriter:
-    def __init__(this, src_path, dest_file, ignore_hidden=False, ignore_symlinks=False, max_rec_depth=-1):
+    def __init__(this, src_path, dest_file, ignore_hidden=False, ignore_symlinks=False, max_rec_depth=-1, jobs=1, chunk_size=DEFAULT_HASH_CHUNK_SIZE,
+                 base_file=None, rehash=False, version=2, sort_paths=False, hash_name=DEFAULT_HASH_ALGORITHM, hash_files=True,
+                 compression=None, shard=None, progress=None, expected_totals=None, phase_stats:PhaseStats=None,
+                 extra_fields=0, chunk_min_file_size=None, chunk_avg_size=DEFAULT_CHUNK_AVG_SIZE, base_part=None):
         this._src_path = Path(src_path)
         this._output_file = Path(dest_file)
         this._ignore_hidden = ignore_hidden
         this._ignore_symlinks = ignore_symlinks
         this._max_rec_depth = max_rec_depth
-        this._write_lock = asyncio.Lock()
+        # jobs <= 0 means one worker per CPU
+        this._jobs = jobs if jobs > 0 else (os.cpu_count() or 1)
+        # Previous snapshot of the same tree: hashes of files whose size and time
+        # did not change are taken from it instead of reading the file again.
+        # With rehash, every file is read anyway and silent content changes are reported.
+        this._base_file = Path(base_file) if base_file else None
+        this._rehash = rehash
+        this._base = None
+        # (file records, chunk manifests) of base_file for this shard, from base_parts(): the parent
+        # ShardedSnapshotWriter reads the base once instead of every worker reading all of it
+        this._base_part = base_part
+        # st_<name> of the EXTRA_FIELDS_STAMP fields recorded by both the base and this snapshot
+        this._stamp_names = ()
+        # (st_dev, st_ino) -> hash (or Future of it) of files with several hard links,
+        # so that each inode is read once per run whatever the number of its links
+        this._link_hashes = {}
+        this.files_hashed = 0
+        this.hashes_reused = 0
+        this.hashes_linked = 0
+        # version 1 writes the legacy unindexed DISK01SNAP format
+        this._version = version
+        # Visit each directory's entries by name, so records come out in canonical path order
+        this._sort_paths = sort_paths
+        this._hash = get_hash_algorithm(hash_name)
+        this._hasher = _FileHasher(this._hash, chunk_size)
+        if version == 1 and hash_name != 'sha256':
+            raise ValueError('Snapshot format version 1 only stores sha256 hashes')
+        # Without hash_files only size and time are recorded (hashes from the base are
+        # still reused); fill-hashes can compute the missing hashes later
+        this._hash_files = hash_files
+        if version == 1 and not hash_files:
+            raise ValueError('Snapshot format version 1 cannot record files without their hash')
+        # Name of the block codec (SnapshotBlocks; 'none' front-codes paths without compressing),
+        # None to store records one after the other
+        if compression is not None:
+            if version == 1:
+                raise ValueError('Snapshot format version 1 cannot be compressed')
+            get_compression_codec(compression)
+        this._compression = compression
+        # (index, count): only record the root and the top-level entries shard_of assigns to index
+        if shard is not None:
+            if version == 1:
+                raise ValueError('Snapshot format version 1 cannot be sharded')
+            if not 0 <= shard[0] < shard[1] <= 0xffff:
+                raise ValueError(f'Invalid shard {shard[0]}/{shard[1]}')
+        this._shard = shard
+        # EXTRA_FIELD_* mask of the stat fields recorded with every entry (e.g. EXTRA_FIELDS_LINKS)
+        if extra_fields and version == 1:
+            raise ValueError('Snapshot format version 1 cannot record extra fields')
+        this._extra_fields = extra_fields
+        this._extra_names = tuple(f'st_{name}' for name in extra_field_names(extra_fields))
+        # Files of chunk_min_file_size bytes or more get a chunk manifest (see SnapshotChunks), None for none
+        this._chunker = None
+        if chunk_min_file_size is not None:
+            if version == 1:
+                raise ValueError('Snapshot format version 1 cannot hold chunk manifests')
+            if not this._hash.digest_size:
+                raise ValueError('Chunk manifests need a hash algorithm')
+            this._chunker = ContentChunker(chunk_avg_size)
+        this._chunk_min_file_size = chunk_min_file_size
+        this._chunk_read_size = chunk_size
+        # rel_path -> chunk manifest of the files hashed or reused so far
+        this._manifests = {}
+        this._base_manifests = {}
+        # (rel_path, rel_path of the first link) of chunked hard links given the hash of an earlier one
+        this._manifest_links = []
+        this._link_paths = {}
+        # Called as progress(stats) with the WriteStats every PROGRESS_INTERVAL records, and once more
+        # at the end with stats.path None; an exception raised by it aborts write_snapshot (e.g. to cancel)
+        this._progress = progress
+        # (entries, bytes) expected, e.g. from precount(); taken from the base snapshot when not given
+        this.expected_totals = expected_totals
+        this.stats = WriteStats()
+        this._stats_lock = threading.Lock()
+        # PhaseStats timing the walk, hash, encode, compress, write and index phases (--stats)
+        this.phase_stats = phase_stats
+
+    def read_base(this):
+        """
+        Take the file records and chunk manifests whose hashes write_snapshot() reuses from base_file,
+        in a single pass over its records. Return (entries, bytes of all files) of the base.
+        """
+        base = SnapshotReader(this._base_file)
+        base_info = base.read_info()
+        reuse = this._hash.digest_size and base_info.hash_name == this._hash.name
+        if this._hash.digest_size and not reuse:
+            logging.warning(f'Base snapshot holds {base_info.hash_name} hashes, not {this._hash.name}: its hashes are not reused')
+        names = this._set_stamp_fields(base_info)
+        records = {}
+        entries = total_size = 0
+        for r in base.iter_records():
+            entries += 1
+            if r.type != ENTRY_TYPE_FILE:
+                continue
+            total_size += r.size
+            if not reuse:
+                continue
+            if names:
+                records[r.path_bytes] = (r.size, r.time, r.hash, tuple(r.extra[name] for name in names))
+            else:
+                records[r.path_bytes] = (r.size, r.time, r.hash)
+        this._base = records if reuse else None
+        this._base_manifests = {}
+        if reuse and this._chunker is not None:
+            base_chunker, base_manifests = base.read_chunks()
+            # Manifests of other chunk sizes do not match: those files are read again
+            if base_chunker == this._chunker:
+                this._base_manifests = base_manifests
+        return entries, total_size
+
+    def _set_stamp_fields(this, base_info:SnapshotInfo):
+        """
+        Compare files with the base on the EXTRA_FIELDS_STAMP fields both snapshots record;
+        return their names.
+        """
+        names = extra_field_names(base_info.extra_fields & this._extra_fields & EXTRA_FIELDS_STAMP)
+        this._stamp_names = tuple(f'st_{name}' for name in names)
+        return names
+
+    def base_parts(this, shard_count):
+        """
+        Split what read_base() took into the (file records, chunk manifests) of each of shard_count
+        shards, by the top-level entry each path is under as the walk assigns them (see shard_of).
+        Return None when the hashes of the base are not reused.
+        """
+        if this._base is None:
+            return None
+        parts = [({}, {}) for _ in range(shard_count)]
+        # as _walk_entries names the entries below the root
+        prefix = b''
+        if os.path.dirname(this._src_path) != str(this._src_path):
+            prefix = str(this._src_path.relative_to(this._src_path.parent)).encode('utf-8') + _PATH_SEP
+        def shards_of(rel_path):
+            if not rel_path.startswith(prefix):
+                # the root itself is in every shard
+                return parts
+            return (parts[shard_of(rel_path[len(prefix):].split(_PATH_SEP, 1)[0], shard_count)],)
+        for rel_path, fields in this._base.items():
+            for records, _ in shards_of(rel_path):
+                records[rel_path] = fields
+        for rel_path, manifest in this._base_manifests.items():
+            for _, manifests in shards_of(rel_path):
+                manifests[rel_path] = manifest
+        return parts
 
     def write_snapshot(this):
-        with this._output_file.open('wb') as f:
-            f.write(SNAPSHOT_FILE_HEADER)
-            this._write_entry(f, this._src_path, 0)
+        this.files_hashed = 0
+        this.hashes_reused = 0
+        this.hashes_linked = 0
+        this._link_hashes = {}
+        this._manifests = {}
+        this._manifest_links = []
+        this._link_paths = {}
+        expected = this.expected_totals
+        phase_stats = this.phase_stats
+        if phase_stats is not None:
+            phase_stats.switch('base')
+        if this._base_file is not None:
+            if this._base_part is not None:
+                this._set_stamp_fields(SnapshotReader(this._base_file).read_info())
+                this._base, this._base_manifests = this._base_part
+            else:
+                totals = this.read_base()
+                if expected is None:
+                    expected = totals
+        this.stats = WriteStats(*(expected or ()))
+        try:
+            with this._output_file.open('wb') as f:
+                if phase_stats is not None:
+                    f = TimedFile(f, phase_stats)
+                    # Whatever the walk, hashing, compression and writes leave is record encoding
+                    phase_stats.switch('encode')
+                out = SnapshotFileWriter(f, this._version, this._sort_paths, this._hash.name, this._compression,
+                                         shard=this._shard, phase_stats=phase_stats, extra_fields=this._extra_fields,
+                                         chunker=this._chunker)
+                if this._jobs > 1:
+                    with ThreadPoolExecutor(max_workers=this._jobs) as executor:
+                        out.write_records(this._report_progress(this._iter_entries_parallel(executor)))
+                elif this._extra_fields:
+                    out.write_records(this._report_progress(
+                        (entry_type, rel_path, size, time,
+                         this._file_hash(rel_path, path, size, time, stat=stat) if entry_type == ENTRY_TYPE_FILE else NULL_HASH,
+                         this._extra_values(stat))
+                        for entry_type, rel_path, path, size, time, stat in this._iter_walk()))
+                else:
+                    out.write_records(this._report_progress(
+                        (entry_type, rel_path, size, time,
+                         this._file_hash(rel_path, path, size, time, stat=stat) if entry_type == ENTRY_TYPE_FILE else NULL_HASH)
+                        for entry_type, rel_path, path, size, time, stat in this._iter_walk()))
+                if phase_stats is not None:
+                    phase_stats.switch('index')
+                if this._chunker is not None:
+                    for rel_path, first in this._manifest_links:
+                        if first in this._manifests:
+                            this._manifests[rel_path] = this._manifests[first]
+                    for rel_path, manifest in this._manifests.items():
+                        out.add_chunk_manifest(rel_path, manifest)
+                out.finish()
+            this.stats.elapsed = perf_counter() - this.stats.start
+            if phase_stats is not None:
+                stats = this.stats
+                for name in ('entries', 'files', 'files_hashed', 'bytes_hashed', 'hashes_reused', 'hashes_linked'):
+                    phase_stats.count(name, getattr(stats, name))
+        except BaseException:
+            # A snapshot cut short has no index: do not leave it behind
+            this._output_file.unlink(missing_ok=True)
+            raise
+        finally:
+            this._base = None
+            this._base_manifests = {}
+            this._manifests = {}
 
-    def _write_entry(this, f:io.BufferedWriter, path:Path, depth):
-        if this._max_rec_depth != -1 and depth > this._max_rec_depth:
+    def write_update(this, changes):
+        """
+        Write the snapshot of base_file updated for changes, the (rel_path, recursive) pairs of the
+        paths (utf-8 bytes, as recorded) that may have changed since base_file was taken, as kept
+        by a ChangeJournal (SnapshotWatch). Only these entries, and everything below the recursive
+        ones, are looked at again, files hashed as write_snapshot() would with base_file as base;
+        every other record is copied from base_file, which must have been taken of the same source
+        with the same options. The update goes to a temporary file moved over dest_file at the end,
+        so dest_file may be base_file.
+        """
+        if this._base_file is None:
+            raise ValueError('A snapshot update needs a base snapshot')
+        if this._version == 1 or this._shard is not None or not this._sort_paths:
+            raise ValueError('Snapshot updates are written as sorted, unsharded version 2 snapshots')
+        base = SnapshotReader(this._base_file)
+        info = base.read_info()
+        if info.hash_name != this._hash.name or info.extra_fields != this._extra_fields:
+            raise ValueError('Base snapshot was taken with another hash algorithm or other extra fields')
+        this.files_hashed = 0
+        this.hashes_reused = 0
+        this.hashes_linked = 0
+        this._link_hashes = {}
+        this._manifests = {}
+        this._manifest_links = []
+        this._link_paths = {}
+        phase_stats = this.phase_stats
+        if phase_stats is not None:
+            phase_stats.switch('base')
+        changes = _reduce_changes(changes)
+        if this._hash.digest_size:
+            stamp_fields = info.extra_fields & EXTRA_FIELDS_STAMP
+            this._stamp_names = tuple(f'st_{name}' for name in extra_field_names(stamp_fields))
+            # A few lookups through the index instead of reading every record
+            this._base = _IndexedFileRecords(base, stamp_fields)
+        base_manifests = {}
+        if this._chunker is not None:
+            base_chunker, base_manifests = base.read_chunks()
+            if base_chunker != this._chunker:
+                base_manifests = {}
+            this._base_manifests = base_manifests
+        this.stats = WriteStats(info.entry_count)
+        fd, tmp_file = tempfile.mkstemp(prefix=f'.{this._output_file.name}.', dir=this._output_file.parent)
+        try:
+            with open(fd, 'wb') as f:
+                if phase_stats is not None:
+                    f = TimedFile(f, phase_stats)
+                    phase_stats.switch('encode')
+                out = SnapshotFileWriter(f, 2, True, this._hash.name, this._compression, phase_stats=phase_stats,
+                                         extra_fields=this._extra_fields, chunker=this._chunker)
+                with ThreadPoolExecutor(max_workers=this._jobs) if this._jobs > 1 else contextlib.nullcontext() as executor:
+                    fresh = this._walk_changes(changes, executor)
+                    out.write_records(this._report_progress(this._merge_changes(base.iter_sorted_records(), changes, fresh)))
+                if phase_stats is not None:
+                    phase_stats.switch('index')
+                if this._chunker is not None:
+                    for rel_path, first in this._manifest_links:
+                        if first in this._manifests:
+                            this._manifests[rel_path] = this._manifests[first]
+                    for rel_path, manifest in base_manifests.items():
+                        if rel_path not in this._manifests and not _covered_by_changes(rel_path, changes):
+                            out.add_chunk_manifest(rel_path, manifest)
+                    for rel_path, manifest in this._manifests.items():
+                        out.add_chunk_manifest(rel_path, manifest)
+                out.finish()
+            # mkstemp creates the file 0600; give it the mode the replaced snapshot had, or a new file would get
+            os.chmod(tmp_file, _replaced_file_mode(this._output_file))
+            os.replace(tmp_file, this._output_file)
+            this.stats.elapsed = perf_counter() - this.stats.start
+        except BaseException:
+            Path(tmp_file).unlink(missing_ok=True)
+            raise
+        finally:
+            this._base = None
+            this._base_manifests = {}
+            this._manifests = {}
+
+    def _walk_changes(this, changes, executor:ThreadPoolExecutor = None):
+        """
+        Records (hashes possibly Futures) of the entries changes cover, in canonical order.
+        """
+        parent = this._src_path.parent
+        rel_root = str(this._src_path.relative_to(parent)).encode('utf-8')
+        records = []
+        for rel_path, recursive in changes:
+            if rel_path != rel_root and not rel_path.startswith(rel_root + _PATH_SEP):
+                logging.warning(f'Change outside of the source ignored: {rel_path.decode("utf-8", "replace")}')
+                continue
+            path = parent / rel_path.decode('utf-8')
+            depth = rel_path.count(_PATH_SEP) - rel_root.count(_PATH_SEP)
+            if recursive:
+                items = this._walk_entries(path, depth, check_ancestors=True)
+            else:
+                item = this._classify_entry(path, rel_path.decode('utf-8'), depth, check_ancestors=True)
+                items = (item[:6],) if item is not None else ()
+            for entry_type, rel_path, path, size, time, stat in items:
+                hash_value = this._file_hash(rel_path, path, size, time, executor, stat) if entry_type == ENTRY_TYPE_FILE else NULL_HASH
+                if this._extra_fields:
+                    records.append((entry_type, rel_path, size, time, hash_value, this._extra_values(stat)))
+                else:
+                    records.append((entry_type, rel_path, size, time, hash_value))
+        return records
+
+    def _merge_changes(this, base_records, changes, fresh):
+        """
+        Yield the base records changes do not cover merged with the fresh ones, in canonical order.
+        """
+        keys = [path_sort_key(rel_path) for rel_path, _ in changes]
+        fresh_keys = [path_sort_key(record[1]) for record in fresh]
+        extra = this._extra_fields
+        i = f = 0
+        current = None
+        base_records = iter(base_records)
+        for r in base_records:
+            key = path_sort_key(r.path_bytes)
+            while f < len(fresh) and fresh_keys[f] <= key:
+                yield this._resolve_pending(fresh[f])
+                f += 1
+            while i < len(keys) and keys[i] <= key:
+                current = i
+                i += 1
+            if current is not None and (keys[current] == key or changes[current][1] and key.startswith(keys[current] + b'\x00')):
+                continue
+            if extra:
+                yield r.type, r.path_bytes, r.size, r.time, r.hash, tuple(r.extra.values())
+            else:
+                yield r.type, r.path_bytes, r.size, r.time, r.hash
+            if i == len(keys) and f == len(fresh):
+                # Past the last change: the rest is copied as it is
+                break
+        for r in base_records:
+            if extra:
+                yield r.type, r.path_bytes, r.size, r.time, r.hash, tuple(r.extra.values())
+            else:
+                yield r.type, r.path_bytes, r.size, r.time, r.hash
+        while f < len(fresh):
+            yield this._resolve_pending(fresh[f])
+            f += 1
+
+    def _report_progress(this, records):
+        # Records pass through in batches of PROGRESS_INTERVAL, so the only cost
+        # per record is the copy into the batch; files and bytes are counted by _file_hash
+        stats = this.stats
+        records = iter(records)
+        while batch := list(itertools.islice(records, PROGRESS_INTERVAL)):
+            stats.entries += len(batch)
+            this._publish_stats(batch[-1][1])
+            yield from batch
+        this._publish_stats(None)
+
+    def _publish_stats(this, rel_path):
+        stats = this.stats
+        stats.elapsed = perf_counter() - stats.start
+        stats.files_hashed, stats.hashes_reused, stats.hashes_linked = this.files_hashed, this.hashes_reused, this.hashes_linked
+        stats.path = rel_path.decode('utf-8', 'replace') if rel_path is not None else None
+        if this._progress is not None:
+            this._progress(stats)
+
+    def _iter_entries_parallel(this, executor:ThreadPoolExecutor):
+        # Files are hashed by the pool while the walk goes on; records are
+        # yielded strictly in walk order, so the output matches the serial writer.
+        # The window bounds how far the walk may run ahead of the writer.
+        window = this._jobs * PARALLEL_WINDOW_PER_JOB
+        pending = deque()
+        for entry_type, rel_path, path, size, time, stat in this._iter_walk():
+            if entry_type == ENTRY_TYPE_FILE:
+                hash_value = this._file_hash(rel_path, path, size, time, executor, stat)
+            else:
+                hash_value = NULL_HASH
+            if this._extra_fields:
+                pending.append((entry_type, rel_path, size, time, hash_value, this._extra_values(stat)))
+            else:
+                pending.append((entry_type, rel_path, size, time, hash_value))
+            while len(pending) > window:
+                yield this._resolve_pending(pending.popleft())
+        while pending:
+            yield this._resolve_pending(pending.popleft())
+
+    def _resolve_pending(this, item):
+        hash_value = item[4]
+        if isinstance(hash_value, Future):
+            if this.phase_stats is not None and not hash_value.done():
+                prev = this.phase_stats.switch('hash wait')
+                hash_value.result()
+                this.phase_stats.switch(prev)
+            return item[:4] + (hash_value.result(),) + item[5:]
+        return item
+
+    def _extra_values(this, stat):
+        return tuple(getattr(stat, name) for name in this._extra_names)
+
+    def _iter_walk(this):
+        walk = this._walk_entries(this._src_path, 0)
+        return this.phase_stats.timed_iter('walk', walk) if this.phase_stats is not None else walk
+
+    def _file_hash(this, rel_path, path, size, time, executor:ThreadPoolExecutor = None, stat=None):
+        """
+        Return the file's hash, or a Future of it when an executor is given.
+        """
+        stats = this.stats
+        stats.files += 1
+        stats.bytes_seen += size
+        if not this._hash.digest_size:
+            return b''
+        # st_ino is 0 where the platform does not report it (os.DirEntry on Windows)
+        # Large files get a chunk manifest, made by the same read as their hash
+        chunked = this._chunker is not None and size >= this._chunk_min_file_size
+        link = None
+        if stat is not None and stat.st_nlink > 1 and stat.st_ino:
+            link = (stat.st_dev, stat.st_ino)
+            hash_value = this._link_hashes.get(link)
+            if hash_value is not None:
+                this.hashes_linked += 1
+                if chunked:
+                    this._manifest_links.append((rel_path, this._link_paths[link]))
+                return hash_value
+        known_hash = None
+        prev = None
+        if this._base is not None:
+            prev = this._base.get(rel_path)
+            if prev is not None and prev[0] == size and prev[1] == time and prev[2]:
+                if not this._stamp_names or prev[3] == tuple(getattr(stat, name) for name in this._stamp_names):
+                    known_hash = prev[2]
+        reuse = known_hash is not None and not this._rehash
+        if reuse and chunked:
+            # Without the manifest the file is read again (and checked against the known hash)
+            manifest = this._base_manifests.get(rel_path)
+            if manifest is not None:
+                this._manifests[rel_path] = manifest
+            else:
+                reuse = False
+        if reuse:
+            this.hashes_reused += 1
+            hash_value = known_hash
+        elif not this._hash_files:
+            return b''
+        else:
+            this.files_hashed += 1
+            stats.bytes_hashed += size
+            if chunked:
+                # A file that grew may only have been appended to: its chunks are not all made again
+                prefix = None
+                if prev is not None and prev[2] and prev[0] < size and not this._rehash:
+                    manifest = this._base_manifests.get(rel_path)
+                    if manifest is not None:
+                        prefix = (prev[0], prev[2], manifest)
+                args = (this._hash_file_chunks, path, size, rel_path, known_hash, prefix)
+            elif known_hash is None:
+                args = (this._hash_file, path, size)
+            else:
+                args = (this._verify_hash, path, size, known_hash)
+            hash_value = executor.submit(*args) if executor is not None else args[0](*args[1:])
+        if link is not None:
+            this._link_hashes[link] = hash_value
+            if chunked:
+                this._link_paths[link] = rel_path
+        return hash_value
+
+    def _verify_hash(this, path, size, known_hash):
+        hash_value = this._hash_file(path, size)
+        if hash_value != known_hash:
+            logging.warning(f'Content changed without size/time change: {path}')
+        return hash_value
+
+    def _hash_file_chunks(this, path, size, rel_path, known_hash=None, prefix=None):
+        hash_value, this._manifests[rel_path] = this._timed_hash(path, size, lambda path: this._chunk_file(path, prefix))
+        if known_hash is not None and hash_value != known_hash:
+            logging.warning(f'Content changed without size/time change: {path}')
+        return hash_value
+
+    def _chunk_file(this, path, prefix=None):
+        return this._chunker.hash_file(path, this._hash.new, this._chunk_read_size, prefix)
+
+    def _hash_file(this, path, size=0):
+        if size < SLOWEST_FILES_MIN_SIZE and this.phase_stats is None:
+            return this._hasher.hash(path)
+        return this._timed_hash(path, size, this._hasher.hash)
+
+    def _timed_hash(this, path, size, hash_path):
+        """
+        Return hash_path(path), timed for phase_stats and WriteStats.slowest.
+        """
+        phase_stats = this.phase_stats
+        # Hashing is a phase of the main thread when it is done there, worker time otherwise
+        in_main = phase_stats is not None and this._jobs == 1
+        if in_main:
+            prev = phase_stats.switch('hash')
+        start = perf_counter()
+        hash_value = hash_path(path)
+        seconds = perf_counter() - start
+        if in_main:
+            phase_stats.switch(prev)
+        elif phase_stats is not None:
+            phase_stats.add_worker('hash', seconds)
+        if size < SLOWEST_FILES_MIN_SIZE:
+            return hash_value
+        slowest = this.stats.slowest
+        # The lock is only taken by files that make the list
+        if len(slowest) < SLOWEST_FILES_KEPT or seconds > slowest[0][0]:
+            with this._stats_lock:
+                if len(slowest) < SLOWEST_FILES_KEPT:
+                    heapq.heappush(slowest, (seconds, path))
+                elif seconds > slowest[0][0]:
+                    heapq.heapreplace(slowest, (seconds, path))
+        return hash_value
+
+    def precount(this):
+        """
+        Walk the source without hashing; return the (entries, file bytes) a snapshot of it would record.
+        """
+        entries = total_size = 0
+        for entry_type, _, _, size, _, _ in this._walk_entries(this._src_path, 0):
+            entries += 1
+            if entry_type == ENTRY_TYPE_FILE:
+                total_size += size
+        return entries, total_size
+
+    def _walk_entries(this, path:Path, depth, check_ancestors=False):
+        """
+        Yield (type, rel_path, path, size, time, stat) for every entry to record, in snapshot order;
+        stat is the entry's stat result, or None for a symlink unless extra fields are recorded.
+        check_ancestors is passed to _classify_entry for path.
+        """
+        # Iterative pre-order walk over os.scandir: the stack holds the not yet
+        # visited entries of each open directory, so tree depth is not bounded by
+        # the recursion limit and no directory handle stays open while descending.
+        # DirEntry answers the type checks from readdir and caches its lstat, so a
+        # plain file or directory costs a single stat call.
+        rel_root = str(path.relative_to(this._src_path.parent))
+        root = this._classify_entry(path, rel_root, depth, check_ancestors)
+        if root is None:
             return
-        if this._ignore_hidden and utils.is_hidden(path):
+        yield root[:6]
+        if root[6] is None:
             return
         
-        rel_path = str(path.relative_to(this._src_path.parent)).encode('utf-8')
-        path_len = len(rel_path)
-        if path.is_file():
-            entry_type = ENTRY_TYPE_FILE
-            size = path.stat().st_size
-            time = int(path.stat().st_mtime)
-            hash_value = hashlib.sha256(path.read_bytes()).digest()
-            header = struct.pack(ENTRY_HEADER_FORMAT, entry_type, path_len)
-            f.write(header)
-            f.write(rel_path)
-            f.write(struct.pack(ENTRY_FILE_FORMAT, size, time, hash_value))
-        elif path.is_symlink():
+        # scandir builds child paths as parent + os.sep + name, so the relative
+        # path of every entry below the root is rel_root + its path after the root
+        path_start = len(str(path))
+        if os.path.dirname(path) == str(path):  # the filesystem root, whose path ends with a separator
+            rel_root = ''
+        stack = [(root[6], depth + 1)]
+        shard = this._shard
+        while stack:
+            entries, depth = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                stack.pop()
+                continue
+            if shard is not None and len(stack) == 1 and shard_of(entry.name.encode('utf-8'), shard[1]) != shard[0]:
+                continue
+            item = this._classify_entry(entry, rel_root + entry.path[path_start:], depth)
+            if item is None:
+                continue
+            yield item[:6]
+            if item[6] is not None:
+                stack.append((item[6], depth + 1))
+
+    def _classify_entry(this, entry, rel_path:str, depth, check_ancestors=False):
+        """
+        entry is the root Path or an os.DirEntry below it.
+        Return (type, rel_path, path, size, time, stat, children) or None if the entry is skipped;
+        children is an iterator over a directory's entries when it has to be descended.
+        With check_ancestors, entry is a Path depth levels below the source root, reached without
+        a walk: it is also skipped when the walk would not descend one of the directories above it.
+        """
+        if this._max_rec_depth != -1 and depth > this._max_rec_depth:
+            return None
+        if this._ignore_hidden and utils.is_hidden(entry):
+            return None
+        if check_ancestors:
+            # parents[depth - 1] is the root: hidden roots and symlinks are not descended either
+            for ancestor in itertools.islice(entry.parents, depth):
+                if this._ignore_hidden and utils.is_hidden(ancestor) or ancestor.is_symlink():
+                    return None
+        
+        # is_file() and stat() follow symlinks: a link to a file is recorded as the file
+        rel_path = rel_path.encode('utf-8')
+        if entry.is_file():
+            stat = entry.stat()
+            return ENTRY_TYPE_FILE, rel_path, os.fspath(entry), stat.st_size, int(stat.st_mtime), stat, None
+        elif entry.is_symlink():
             if this._ignore_symlinks: 
-                return
-            entry_type = ENTRY_TYPE_SYMLINK
-            header = struct.pack(ENTRY_HEADER_FORMAT, entry_type, path_len)
-            f.write(header)
-            f.write(rel_path)
+                return None
             # symlink: size=0, time=0, hash=None
-            f.write(struct.pack(ENTRY_FILE_FORMAT, 0, 0, b'\x00' * 32))
-        elif path.is_dir():
-            entry_type = ENTRY_TYPE_DIR
-            header = struct.pack(ENTRY_HEADER_FORMAT, entry_type, path_len)
-            f.write(header)
-            f.write(rel_path)
+            stat = os.lstat(entry) if this._extra_fields else None
+            return ENTRY_TYPE_SYMLINK, rel_path, os.fspath(entry), 0, 0, stat, None
+        elif entry.is_dir():
             # dir: size=0, time=time, hash=None
-            time = int(path.stat().st_mtime)
-            f.write(struct.pack(ENTRY_FILE_FORMAT, 0, time, b'\x00' * 32))
-            for entry in path.iterdir():
-                this._write_entry(f, entry, depth+1)
-
-    # async def _write_entry(this, f: io.BufferedWriter, path: Path, depth, executor: Optional[ThreadPoolExecutor] = None):
-    #     if executor is None:
-    #         executor = ThreadPoolExecutor()
-    #     loop = asyncio.get_running_loop()
-        
-    #     if this._max_rec_depth != -1 and depth > this._max_rec_depth:
-    #         return
-    #     if this._ignore_hidden:
-    #         is_hidden = await loop.run_in_executor(executor, utils.is_hidden, path)
-    #         if is_hidden:
-    #             return
-        
-    #     rel_path = str(path.relative_to(this._src_path.parent)).encode('utf-8')
-    #     path_len = len(rel_path)
-        
-    #     stat = await loop.run_in_executor(executor, path.stat)
-        
-    #     if path.is_file():
-    #         entry_type = ENTRY_TYPE_FILE
-    #         size = stat.st_size
-    #         time = int(stat.st_mtime)
-            
-    #         file_bytes = await loop.run_in_executor(executor, path.read_bytes)
-    #         hash_value = hashlib.sha256(file_bytes).digest()
-            
-    #         header = struct.pack(ENTRY_HEADER_FORMAT, entry_type, path_len)
-    #         async with this._write_lock:
-    #             f.write(header)
-    #             f.write(rel_path)
-    #             f.write(struct.pack(ENTRY_FILE_FORMAT, size, time, hash_value))
-                
-    #     elif path.is_symlink():
-    #         if this._ignore_symlinks:
-    #             return
-    #         entry_type = ENTRY_TYPE_SYMLINK
-    #         header = struct.pack(ENTRY_HEADER_FORMAT, entry_type, path_len)
-    #         async with this._write_lock:
-    #             f.write(header)
-    #             f.write(rel_path)
-    #             f.write(struct.pack(ENTRY_FILE_FORMAT, 0, 0, b'\x00' * 32))
-                
-    #     elif path.is_dir():
-    #         entry_type = ENTRY_TYPE_DIR
-    #         header = struct.pack(ENTRY_HEADER_FORMAT, entry_type, path_len)
-    #         time = int(stat.st_mtime)
-    #         async with this._write_lock:
-    #             f.write(header)
-    #             f.write(rel_path)
-    #             f.write(struct.pack(ENTRY_FILE_FORMAT, 0, time, b'\x00' * 32))
-            
-    #         entries = await loop.run_in_executor(executor, list, path.iterdir())
-    #         await asyncio.gather(*[
-    #             this._write_entry(f, entry, depth+1, executor)
-    #             for entry in entries
-    #         ])
+            stat = entry.stat()
+            time = int(stat.st_mtime)
+            children = None
+            if this._max_rec_depth == -1 or depth < this._max_rec_depth:
+                with os.scandir(entry) as it:
+                    children = list(it)
+                if this._sort_paths:
+                    children.sort(key=lambda child: child.name)
+                children = iter(children)
+            return ENTRY_TYPE_DIR, rel_path, os.fspath(entry), 0, time, stat, children
+        return None
 
 class SnapshotReader:
     @staticmethod
@@ -134,28 +1452,57 @@ class SnapshotReader:
     
     @staticmethod
     def _get_entry_type_string(entry):
-        return {ENTRY_TYPE_FILE: 'FILE', ENTRY_TYPE_DIR: 'DIR', ENTRY_TYPE_SYMLINK: 'SYMLINK'}.get(entry['type'], 'UNKNOWN')
+        return ENTRY_TYPE_NAMES.get(entry['type'], 'UNKNOWN')
     
+    @staticmethod
+    def _get_extra(entry):
+        """
+        {name: value} of the extra fields of a SnapshotRecord or entry dict.
+        """
+        if isinstance(entry, SnapshotRecord):
+            return entry.extra
+        return {name: entry[name] for _, name, _, _ in EXTRA_FIELDS if name in entry}
+
+    @staticmethod
+    def _get_extra_string(name, value, human=False):
+        if name == 'mode':
+            return f'{value:o}'
+        if human and name.endswith('_ns'):
+            seconds, ns = divmod(value, 1000000000)
+            return f'{utils.time_to_string_human(seconds)}.{ns:09}'
+        return str(value)
+
     @staticmethod
     def _get_entry_string(entry, human=False):
         parts = [
             f"{SnapshotReader._get_entry_type_string(entry)}: {entry['path']}"
         ]
         if entry['type'] not in (ENTRY_TYPE_DIR, ENTRY_TYPE_SYMLINK):
-            parts.append(f"hash=\"{entry['hash'].hex()}\"")
+            if entry['hash']:
+                parts.append(f"hash=\"{entry['hash'].hex()}\"")
             parts.append(f"size=\"{SnapshotReader._get_size_string(entry['size'], human)}\"")
         parts.append(f"time=\"{SnapshotReader._get_time_string(entry['time'], human)}\"")
+        for name, value in SnapshotReader._get_extra(entry).items():
+            parts.append(f"{name}=\"{SnapshotReader._get_extra_string(name, value, human)}\"")
         return ' '.join(parts)
 
+    @staticmethod
+    def _get_ranges_string(ranges, human=False):
+        size = SnapshotReader._get_size_string(sum(end - start for start, end in ranges), human)
+        shown = ''.join(f' {start}-{end}' for start, end in ranges[:CHANGED_RANGES_SHOWN])
+        more = ' ...' if len(ranges) > CHANGED_RANGES_SHOWN else ''
+        return f"{size} in {len(ranges)} ranges{shown}{more}"
+
     @staticmethod
     def _get_diff_entry_string(entry1, entry2, human=False):
         parts = [
             f"{SnapshotReader._get_entry_type_string(entry1)}: {entry1['path']}"
         ]
         if entry1['type'] not in (ENTRY_TYPE_DIR, ENTRY_TYPE_SYMLINK):
-            parts.append(
-                f"hash=\"{entry1['hash'].hex()} -> {entry2['hash'].hex()}\""
-            )
+            if entry1['hash'] or entry2['hash']:
+                parts.append(
+                    f"hash=\"{entry1['hash'].hex()} -> {entry2['hash'].hex()}\""
+                )
             parts.append(
                 f"size=\"{SnapshotReader._get_size_string(entry1['size'], human)} "
                 f"-> {SnapshotReader._get_size_string(entry2['size'], human)}\""
@@ -164,82 +1511,657 @@ class SnapshotReader:
             f"time=\"{SnapshotReader._get_time_string(entry1['time'], human)} "
             f"-> {SnapshotReader._get_time_string(entry2['time'], human)}\""
         )
+        # Extra fields only when they changed
+        extra2 = SnapshotReader._get_extra(entry2)
+        for name, value1 in SnapshotReader._get_extra(entry1).items():
+            if name in extra2 and value1 != extra2[name]:
+                parts.append(f"{name}=\"{SnapshotReader._get_extra_string(name, value1, human)} "
+                             f"-> {SnapshotReader._get_extra_string(name, extra2[name], human)}\"")
         return ' '.join(parts)
     
     
-    def __init__(this, snap_file):
+    def __init__(this, snap_file, phase_stats:PhaseStats=None):
         this._snap_file = Path(snap_file)
+        # PhaseStats timing the read, decompress and decode phases (--stats)
+        this.phase_stats = phase_stats
+
+    def _map(this):
+        """
+        Map the snapshot file read-only. Mappings that records escape with live as long as those
+        records; the others are closed by a with block.
+        """
+        with this._snap_file.open('rb') as f:
+            try:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise ValueError('Invalid snapshot file')
+
+    @staticmethod
+    def _parse_header(buf):
+        """
+        Check the file header and return its SnapshotInfo.
+        """
+        magic = buf[:len(SNAPSHOT_FILE_HEADER)]
+        if magic == SNAPSHOT_FILE_HEADER:
+            return SnapshotInfo(1, 0, len(magic), len(buf))
+        if magic != SNAPSHOT_FILE_HEADER_V2:
+            raise ValueError('Invalid snapshot file')
+        
+        if len(buf) < len(magic) + _SNAPSHOT_V2_HEADER_STRUCT.size:
+            raise ValueError('Invalid snapshot file')
+        (header_size, flags, hash_id, digest_size, compression, shard_index, shard_count,
+         extra_fields) = _SNAPSHOT_V2_HEADER_STRUCT.unpack_from(buf, len(magic))
+        if header_size != _SNAPSHOT_V2_HEADER_STRUCT.size:
+            raise ValueError('Invalid snapshot file')
+        if flags & ~SNAPSHOT_KNOWN_FLAGS:
+            raise ValueError(f'Unsupported snapshot features (flags=0x{flags:x})')
+        if not flags & SNAPSHOT_FLAG_BLOCKS:
+            compression = None
+        if not flags & SNAPSHOT_FLAG_SHARD:
+            shard_index = shard_count = None
+        if not flags & SNAPSHOT_FLAG_EXTRA_FIELDS:
+            extra_fields = 0
+        elif extra_fields & ~EXTRA_FIELDS_KNOWN:
+            raise ValueError(f'Unsupported snapshot extra fields (0x{extra_fields:x})')
+        records_start = len(magic) + header_size
+        if not flags & SNAPSHOT_FLAG_INDEXED:
+            return SnapshotInfo(2, flags, records_start, len(buf), hash_id=hash_id, digest_size=digest_size,
+                                compression=compression,
+                                shard_index=shard_index, shard_count=shard_count, extra_fields=extra_fields)
+        
+        footer_size = struct.calcsize(SNAPSHOT_FOOTER_FORMAT)
+        index_offset, entry_count, footer_magic = struct.unpack_from(SNAPSHOT_FOOTER_FORMAT, buf, len(buf) - footer_size)
+        if footer_magic != SNAPSHOT_FOOTER_MAGIC:
+            raise ValueError('Invalid snapshot file (index footer missing)')
+        chunks_offset = chunks_end = None
+        if flags & SNAPSHOT_FLAG_CHUNKS:
+            chunks_offset, chunks_end = index_offset + entry_count * _INDEX_ENTRY_STRUCT.size, len(buf) - footer_size
+        return SnapshotInfo(2, flags, records_start, index_offset, index_offset, entry_count, hash_id, digest_size,
+                            compression, shard_index, shard_count, extra_fields, chunks_offset, chunks_end)
+
+    def read_info(this):
+        with this._map() as buf:
+            return this._parse_header(buf)
+
+    @staticmethod
+    def _iter_buffer(buf, pos, end, digest_size=32, extra_fields=0, version=2):
+        unpack_fields = _ENTRY_SIZE_TIME_STRUCT.unpack_from
+        fields_size = entry_file_struct(digest_size).size
+        if version == 1:
+            unpack_header = _ENTRY_HEADER_STRUCT.unpack_from
+            header_size = _ENTRY_HEADER_STRUCT.size
+            while pos < end:
+                entry_type, path_len = unpack_header(buf, pos)
+                path_start = pos + header_size
+                path_end = path_start + path_len
+                if path_end + fields_size > end:
+                    raise ValueError('Invalid snapshot file (truncated record)')
+                size, time = unpack_fields(buf, path_end)
+                yield _SnapshotV1Record(buf, pos, path_start, path_end, path_end + fields_size, entry_type & ENTRY_TYPE_MASK,
+                                        size, time)
+                pos = path_end + fields_size
+            return
+        extra_size = extra_fields_struct(extra_fields).size if extra_fields else 0
+        while pos < end:
+            entry_type, path_len = buf[pos], buf[pos + 1]
+            if path_len < 0x80:
+                path_start = pos + 2
+            else:
+                path_len, path_start = read_varint(buf, pos + 1)
+            path_end = path_start + path_len
+            hash_end = path_end + fields_size
+            if hash_end + extra_size > end:
+                raise ValueError('Invalid snapshot file (truncated record)')
+            size, time = unpack_fields(buf, path_end)
+            if extra_fields:
+                yield SnapshotExtraRecord(buf, pos, path_start, path_end, hash_end, entry_type & ENTRY_TYPE_MASK,
+                                          size, time, hash_end + extra_size, extra_fields)
+            else:
+                yield SnapshotRecord(buf, pos, path_start, path_end, hash_end, entry_type & ENTRY_TYPE_MASK, size, time)
+            pos = hash_end + extra_size
+
+    def _iter_segments(this, buf, info:SnapshotInfo):
+        """
+        Yield (buffer, start, end) spans of plain records: the mapped records region itself,
+        or each block of a block file, decoded.
+        """
+        if info.compression is None:
+            yield buf, info.records_start, info.records_end
+            return
+        for data, count, _ in this._timed_blocks(buf, info):
+            records = this._decode_block(data, count, info)
+            yield records, 0, len(records)
+
+    def _timed_blocks(this, buf, info:SnapshotInfo):
+        blocks = this._iter_blocks(buf, info)
+        return this.phase_stats.timed_iter('decompress', blocks) if this.phase_stats is not None else blocks
+
+    @staticmethod
+    def _iter_blocks(buf, info:SnapshotInfo):
+        """
+        Yield (payload, record count, offset) of every block of a block file.
+        """
+        codec = info.codec
+        pos = info.records_start
+        while pos < info.records_end:
+            data, count, next_pos = SnapshotReader._decompress_block(buf, pos, codec)
+            yield data, count, pos
+            pos = next_pos
+
+    @staticmethod
+    def _iter_block_entries(data, count, info:SnapshotInfo):
+        """
+        Walk a front-coded block payload: yield (type byte, shared, path, fields offset) per record,
+        where path shares its first `shared` bytes with the previous one.
+        """
+        fields_size = info.fields_size
+        prev = b''
+        at = 0
+        for _ in range(count):
+            entry_type, shared, suffix_len = data[at], data[at + 1], data[at + 2]
+            at += 3
+            if shared > 0x7f:
+                shared, at = read_varint(data, at - 2)
+                suffix_len = data[at]
+                at += 1
+            if suffix_len > 0x7f:
+                suffix_len, at = read_varint(data, at - 1)
+            path = prev[:shared] + data[at:at + suffix_len] if shared else data[at:at + suffix_len]
+            at += suffix_len
+            yield entry_type, shared, path, at
+            at += fields_size
+            prev = path
+        if at != len(data):
+            raise ValueError('Invalid snapshot file (corrupt block)')
+
+    @staticmethod
+    def _decode_block(data, count, info:SnapshotInfo):
+        """
+        Expand a front-coded block payload into plain records.
+        """
+        fields_size = info.fields_size
+        records = bytearray()
+        append = records.append
+        for entry_type, _, path, at in SnapshotReader._iter_block_entries(data, count, info):
+            append(entry_type)
+            if len(path) < 0x80:
+                append(len(path))
+            else:
+                append_varint(records, len(path))
+            records += path
+            records += data[at:at + fields_size]
+        return bytes(records)
+
+    @staticmethod
+    def _decompress_block(buf, pos, codec:CompressionCodec):
+        """
+        Return the front-coded payload of the block at pos, its record count and the offset of the next block.
+        """
+        raw_size, stored_size, count = _BLOCK_HEADER_STRUCT.unpack_from(buf, pos)
+        pos += _BLOCK_HEADER_STRUCT.size
+        data = codec.decompress(buf[pos:pos + stored_size])
+        if len(data) != raw_size:
+            raise ValueError('Invalid snapshot file (corrupt block)')
+        return data, count, pos + stored_size
+
+    @staticmethod
+    def _find_in_block(data, count, info:SnapshotInfo, rel_path:bytes):
+        """
+        Scan a front-coded block payload for rel_path; only the matching record is decoded.
+        """
+        fields_size = info.fields_size
+        for entry_type, _, path, at in SnapshotReader._iter_block_entries(data, count, info):
+            if path == rel_path:
+                record = bytearray((entry_type,))
+                append_varint(record, len(path))
+                record += path
+                record += data[at:at + fields_size]
+                return next(SnapshotReader._iter_buffer(bytes(record), 0, len(record), info.digest_size, info.extra_fields))
+        return None
+
+    def iter_records(this):
+        """
+        Yield a SnapshotRecord for every entry, in file order, without copying the file into memory
+        (block files are decoded one block at a time).
+        """
+        buf = this._map()
+        info = this._parse_header(buf)
+        if info.compression is None:
+            records = this._iter_buffer(buf, info.records_start, info.records_end, info.digest_size, info.extra_fields,
+                                        info.version)
+        else:
+            records = itertools.chain.from_iterable(this._iter_buffer(data, start, end, info.digest_size, info.extra_fields)
+                                                    for data, start, end in this._iter_segments(buf, info))
+        return this.phase_stats.timed_iter('read', records) if this.phase_stats is not None else records
 
     def read_snapshot(this):
+        """
+        Return every entry as a dict, in file order. Plain records are read with the old
+        per-field f.read() loop: building the dicts costs the same whichever way the bytes
+        come in. iter_records() and read_table() are the fast, low-memory ways through a snapshot.
+        """
+        phase_stats = this.phase_stats
+        if phase_stats is None:
+            return this._read_snapshot()
+        prev = phase_stats.switch('decode')
+        try:
+            entries = this._read_snapshot()
+        finally:
+            phase_stats.switch(prev)
+        phase_stats.count('entries', len(entries))
+        return entries
+
+    def _read_snapshot(this):
+        with this._map() as buf:
+            info = this._parse_header(buf)
+            if info.extra_fields:
+                return [r.to_dict() for data, start, end in this._iter_segments(buf, info)
+                        for r in this._iter_buffer(data, start, end, info.digest_size, info.extra_fields)]
+            if info.compression is not None:
+                return this._read_blocks_snapshot(buf, info)
+        # Plain records: the old read loop, through the buffered file
+        unpack_fields = entry_file_struct(info.digest_size).unpack
+        fields_size = info.fields_size
         entries = []
+        append = entries.append
         with this._snap_file.open('rb') as f:
-            magic = f.read(len(SNAPSHOT_FILE_HEADER))
-            if magic != SNAPSHOT_FILE_HEADER:
-                raise ValueError('Invalid snapshot file')
-            while True:
-                header = f.read(struct.calcsize(ENTRY_HEADER_FORMAT))
-                if not header:
-                    break
-                entry_type, path_len = struct.unpack(ENTRY_HEADER_FORMAT, header)
-                rel_path = f.read(path_len).decode('utf-8')
-                size, time, hash_value = struct.unpack(ENTRY_FILE_FORMAT, f.read(struct.calcsize(ENTRY_FILE_FORMAT)))
-                entries.append({'type': entry_type, 'path': rel_path, 'size': size, 'time': time, 'hash': hash_value})
+            f.seek(info.records_start)
+            read = f.read
+            try:
+                if info.version == 1:
+                    # the records run to the end of the file
+                    unpack_header = _ENTRY_HEADER_STRUCT.unpack
+                    while header := read(3):
+                        entry_type, path_len = unpack_header(header)
+                        path = read(path_len)
+                        size, time, hash_value = unpack_fields(read(fields_size))
+                        if entry_type & ENTRY_FLAG_UNHASHED:
+                            entry_type, hash_value = entry_type & ENTRY_TYPE_MASK, b''
+                        append({'type': entry_type, 'path': path.decode('utf-8'), 'size': size, 'time': time, 'hash': hash_value})
+                    left = 0
+                else:
+                    left = info.records_end - info.records_start
+                    while left > 0:
+                        header = read(2)
+                        entry_type, path_len = header[0], header[1]
+                        left -= 2
+                        if path_len > 0x7f:
+                            path_len &= 0x7f
+                            shift = 7
+                            while True:
+                                byte = read(1)[0]
+                                left -= 1
+                                path_len |= (byte & 0x7f) << shift
+                                if byte < 0x80:
+                                    break
+                                shift += 7
+                        path = read(path_len)
+                        size, time, hash_value = unpack_fields(read(fields_size))
+                        left -= path_len + fields_size
+                        if entry_type & ENTRY_FLAG_UNHASHED:
+                            entry_type, hash_value = entry_type & ENTRY_TYPE_MASK, b''
+                        append({'type': entry_type, 'path': path.decode('utf-8'), 'size': size, 'time': time, 'hash': hash_value})
+            except (IndexError, struct.error):
+                left = -1
+        if left:
+            raise ValueError('Invalid snapshot file (truncated record)')
         return entries
 
-    def print_snapshot(this, easy = False, human = False):
-        entries = this.read_snapshot()
+    def _read_blocks_snapshot(this, buf, info:SnapshotInfo):
+        # Straight from the front-coded payload: while paths are ASCII, only the suffix
+        # that differs from the previous path is decoded and no path bytes are rebuilt
+        fields = entry_file_struct(info.digest_size)
+        unpack_fields = fields.unpack_from
+        fields_size = fields.size
+        entries = []
+        append = entries.append
+        for data, count, _ in this._timed_blocks(buf, info):
+            prev, prev_bytes, prev_ascii = '', None, True
+            at = 0
+            for _ in range(count):
+                entry_type, shared, suffix_len = data[at], data[at + 1], data[at + 2]
+                at += 3
+                if shared > 0x7f:
+                    shared, at = read_varint(data, at - 2)
+                    suffix_len = data[at]
+                    at += 1
+                if suffix_len > 0x7f:
+                    suffix_len, at = read_varint(data, at - 1)
+                if shared and prev_ascii:
+                    # the prefix of an ASCII path is the same in bytes and characters
+                    suffix = data[at:at + suffix_len].decode('utf-8')
+                    path = prev[:shared] + suffix
+                    prev_ascii = suffix.isascii()
+                else:
+                    # a shared prefix may end inside a multi-byte character
+                    path_bytes = prev_bytes[:shared] + data[at:at + suffix_len] if shared else data[at:at + suffix_len]
+                    path = path_bytes.decode('utf-8')
+                    prev_ascii = path.isascii()
+                if not prev_ascii:
+                    prev_bytes = path.encode('utf-8')
+                at += suffix_len
+                size, time, hash_value = unpack_fields(data, at)
+                at += fields_size
+                if entry_type & ENTRY_FLAG_UNHASHED:
+                    entry_type, hash_value = entry_type & ENTRY_TYPE_MASK, b''
+                prev = path
+                append({'type': entry_type, 'path': path, 'size': size, 'time': time, 'hash': hash_value})
+            if at != len(data):
+                raise ValueError('Invalid snapshot file (corrupt block)')
+        return entries
+
+    def read_table(this):
+        """
+        Load the snapshot as a SnapshotTable.
+        """
+        with this._map() as buf:
+            info = this._parse_header(buf)
+            fields = entry_file_struct(info.digest_size)
+            fields_size = info.fields_size
+            unpack_fields = fields.unpack_from
+            v1 = info.version == 1
+            table = SnapshotTable(info.hash_name, info.digest_size)
+            for data, pos, end in this._iter_segments(buf, info):
+                while pos < end:
+                    entry_type, path_len = data[pos], data[pos + 1]
+                    if v1:
+                        path_len |= data[pos + 2] << 8
+                        pos += 3
+                    elif path_len < 0x80:
+                        pos += 2
+                    else:
+                        path_len, pos = read_varint(data, pos + 1)
+                    pos += path_len
+                    if pos + fields_size > end:
+                        raise ValueError('Invalid snapshot file (truncated record)')
+                    size, time, hash_value = unpack_fields(data, pos)
+                    if entry_type & ENTRY_FLAG_UNHASHED:
+                        entry_type, hash_value = entry_type & ENTRY_TYPE_MASK, b''
+                    table.append(entry_type, data[pos - path_len:pos], size, time, hash_value)
+                    pos += fields_size
+        return table
+
+    def lookup(this, rel_path):
+        """
+        Return the entry recorded for rel_path (as stored, e.g. 'src/dir/file'), or None.
+        Indexed snapshots are searched by binary search over the index; others are scanned.
+        """
+        with this._map() as buf:
+            record = this._find_record(buf, this._parse_header(buf), str(rel_path).encode('utf-8'))
+            return record.to_dict() if record is not None else None
+
+    @staticmethod
+    def _find_record(buf, info:SnapshotInfo, rel_path:bytes):
+        records_start, records_end, index_offset, entry_count = info.records_start, info.records_end, info.index_offset, info.entry_count
+        if index_offset is None:
+            return next((r for r in SnapshotReader._iter_buffer(buf, records_start, records_end, info.digest_size,
+                                                                info.extra_fields, info.version)
+                         if r.path_bytes == rel_path), None)
+        block_offset = None
         
-        entry_strings = []
+        key = path_key(rel_path)
+        unpack_item = _INDEX_ENTRY_STRUCT.unpack_from
+        item_size = _INDEX_ENTRY_STRUCT.size
+        lo, hi = 0, entry_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if unpack_item(buf, index_offset + mid * item_size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        # Keys may collide: check every record with the same key
+        while lo < entry_count:
+            item_key, offset = unpack_item(buf, index_offset + lo * item_size)
+            if item_key != key:
+                break
+            if info.compression is not None:
+                # The index points to the block holding the record
+                if offset != block_offset:
+                    block_offset = offset
+                    data, count, _ = SnapshotReader._decompress_block(buf, offset, info.codec)
+                    record = SnapshotReader._find_in_block(data, count, info, rel_path)
+                    if record is not None:
+                        return record
+            else:
+                record = next(SnapshotReader._iter_buffer(buf, offset, records_end, info.digest_size, info.extra_fields))
+                if record.path_bytes == rel_path:
+                    return record
+            lo += 1
+        return None
+
+    def totals(this):
+        """
+        Return (entries, bytes of all files) of the snapshot.
+        """
+        entries = total_size = 0
+        for r in this.iter_records():
+            entries += 1
+            if r.type == ENTRY_TYPE_FILE:
+                total_size += r.size
+        return entries, total_size
+
+    def read_file_records(this, stamp_fields=0):
+        """
+        Map each file path (utf-8 bytes) to its (size, time, hash), followed by the tuple
+        of its stamp_fields values (an EXTRA_FIELD_* mask of fields the snapshot records) if any.
+        """
+        if stamp_fields:
+            names = extra_field_names(stamp_fields)
+            return {r.path_bytes: (r.size, r.time, r.hash, tuple(r.extra[name] for name in names))
+                    for r in this.iter_records() if r.type == ENTRY_TYPE_FILE}
+        return {r.path_bytes: (r.size, r.time, r.hash)
+                for r in this.iter_records() if r.type == ENTRY_TYPE_FILE}
+
+    def read_chunks(this):
+        """
+        Return (ContentChunker, {path (utf-8 bytes): chunk manifest}) of a snapshot
+        written with chunk manifests, (None, {}) otherwise.
+        """
+        with this._map() as buf:
+            info = this._parse_header(buf)
+            if info.chunks_offset is None:
+                return None, {}
+            return read_chunk_section(buf, info.chunks_offset, info.chunks_end, info.digest_size)
+
+    def print_snapshot(this, easy = False, human = False, out = None):
+        # Counting only touches the fixed fields, so the summary is a cheap first
+        # pass and entries are printed by a second one instead of being buffered
         _files_count = 0
         _dirs_count = 0
         _unknown_count = 0
         
-        for e in entries:
-            if e['type'] == ENTRY_TYPE_FILE:
+        for e in this.iter_records():
+            if e.type == ENTRY_TYPE_FILE:
                 _files_count += 1
-            elif e['type'] == ENTRY_TYPE_DIR:
+            elif e.type == ENTRY_TYPE_DIR:
                 _dirs_count += 1
             else:
                 _unknown_count += 1
             
-            if not easy:
-                entry_strings.append(SnapshotReader._get_entry_string(e, human))
-            
-        print(f"Snapshot Summary:")
-        print(f"Contains: {_files_count:,} Files, {_dirs_count:,} Directories, {_unknown_count:,} Others")
+        print(f"Snapshot Summary:", file=out)
+        print(f"Contains: {_files_count:,} Files, {_dirs_count:,} Directories, {_unknown_count:,} Others", file=out)
         if easy:
             return
         
-        print()
-        for entry_string in entry_strings:
-            print(entry_string)
+        print(file=out)
+        write = (out or sys.stdout).write
+        lines = []
+        for e in this.iter_records():
+            lines.append(SnapshotReader._get_entry_string(e, human))
+            if len(lines) >= PRINT_BATCH_LINES:
+                write('\n'.join(lines) + '\n')
+                lines.clear()
+        if lines:
+            write('\n'.join(lines) + '\n')
     
     
+    def iter_sorted_records(this):
+        """
+        Yield the records in canonical path order. Snapshots written sorted are
+        streamed as they are; others go through an external merge sort of
+        EXTERNAL_SORT_RUN_SIZE-record runs spilled to temporary files.
+        """
+        info = this.read_info()
+        records = this.iter_records()
+        if info.is_sorted:
+            yield from records
+            return
+        
+        tmp_dir = None
+        try:
+            runs = []
+            while True:
+                run = [(path_sort_key(r.path_bytes), r) for r in itertools.islice(records, EXTERNAL_SORT_RUN_SIZE)]
+                if not run:
+                    break
+                run.sort(key=lambda item: item[0])
+                if not runs and len(run) < EXTERNAL_SORT_RUN_SIZE:
+                    # Fits in a single run: no need to spill it
+                    runs.append(iter(run))
+                    break
+                if tmp_dir is None:
+                    tmp_dir = tempfile.mkdtemp(prefix='snapsort-')
+                run_file = Path(tmp_dir) / f'run{len(runs)}.snap'
+                with run_file.open('wb') as f:
+                    # Unindexed v2 file with the records copied as they are
+                    f.write(SNAPSHOT_FILE_HEADER_V2)
+                    run_flags = SNAPSHOT_FLAG_HASH_ALGO | (SNAPSHOT_FLAG_EXTRA_FIELDS if info.extra_fields else 0)
+                    f.write(_SNAPSHOT_V2_HEADER_STRUCT.pack(_SNAPSHOT_V2_HEADER_STRUCT.size, run_flags, info.hash_id,
+                                                            info.digest_size, 0, 0, 0, info.extra_fields))
+                    for _, r in run:
+                        f.write(r.raw_bytes)
+                runs.append((path_sort_key(r.path_bytes), r) for r in SnapshotReader(run_file).iter_records())
+            for _, r in heapq.merge(*runs, key=lambda item: item[0]):
+                yield r
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
     @staticmethod
-    def compare_snapshots(snap_file_a, snap_file_b):
+    def _merge_diff(records_a, records_b, compare_hashes=True, compare_extra=()):
         """
-        Compare two snapshot files and print added, removed, and modified entries.
+        Merge-join two record streams in canonical path order and yield a
+        DiffEvent for each difference, keyed by (type, path).
+        Without compare_hashes, or when either side was not hashed, entries are
+        modified when their size or time differ. Entries are modified as well when
+        one of the compare_extra fields differs, e.g. their inode or link count.
         """
-        reader_a = SnapshotReader(snap_file_a)
-        reader_b = SnapshotReader(snap_file_b)
-        entries_a = reader_a.read_snapshot()
-        entries_b = reader_b.read_snapshot()
+        a = next(records_a, None)
+        b = next(records_b, None)
+        key_a = path_sort_key(a.path_bytes) if a is not None else None
+        key_b = path_sort_key(b.path_bytes) if b is not None else None
+        while a is not None or b is not None:
+            if b is None or (a is not None and key_a < key_b):
+                yield DiffEvent(DIFF_REMOVED, a, None)
+                a = next(records_a, None)
+                key_a = path_sort_key(a.path_bytes) if a is not None else None
+                continue
+            if a is None or key_b < key_a:
+                yield DiffEvent(DIFF_ADDED, None, b)
+                b = next(records_b, None)
+                key_b = path_sort_key(b.path_bytes) if b is not None else None
+                continue
+            
+            if a.type != b.type:
+                yield DiffEvent(DIFF_REMOVED, a, None)
+                yield DiffEvent(DIFF_ADDED, None, b)
+            elif (a.size != b.size or a.time != b.time or (compare_hashes and a.hash != b.hash and a.hash and b.hash)
+                  or (compare_extra and any(a[name] != b[name] for name in compare_extra))):
+                yield DiffEvent(DIFF_MODIFIED, a, b)
+            a = next(records_a, None)
+            b = next(records_b, None)
+            key_a = path_sort_key(a.path_bytes) if a is not None else None
+            key_b = path_sort_key(b.path_bytes) if b is not None else None
 
-        def entry_key(e):
-            return (e['type'], e['path'])
+    @staticmethod
+    def iter_diff(snap_file_a, snap_file_b, compare_hashes=None, phase_stats:PhaseStats=None):
+        """
+        Lazily yield a DiffEvent for every entry added, removed or modified from
+        snapshot a to snapshot b, in canonical path order.
+        By default hashes are compared when both snapshots have them, and snapshots
+        hashed with different algorithms are refused (ValueError); with
+        compare_hashes=False they are compared by size and time only.
+        Extra fields both snapshots record (see EXTRA_FIELDS) are compared too, and modified
+        files with a chunk manifest in both get their changed_ranges.
+        phase_stats times the read, sort and diff phases of the consumer's iteration.
+        """
+        reader_a, reader_b = SnapshotReader(snap_file_a, phase_stats), SnapshotReader(snap_file_b, phase_stats)
+        info_a, info_b = reader_a.read_info(), reader_b.read_info()
+        hashed = info_a.digest_size > 0 and info_b.digest_size > 0
+        if compare_hashes is None:
+            if hashed and info_a.hash_id != info_b.hash_id:
+                raise ValueError(f'Snapshots use different hash algorithms ({info_a.hash_name}, {info_b.hash_name}); '
+                                 'they can only be compared by size and time')
+            compare_hashes = hashed
+        common = info_a.extra_fields & info_b.extra_fields
+        compare_extra = tuple(name for bit, name, _, compared in EXTRA_FIELDS if common & bit and compared)
+        manifests = None
+        if compare_hashes and info_a.chunks_offset is not None and info_b.chunks_offset is not None:
+            chunker_a, manifests_a = reader_a.read_chunks()
+            chunker_b, manifests_b = reader_b.read_chunks()
+            # Chunks of other sizes share no digests
+            if chunker_a == chunker_b and manifests_a and manifests_b:
+                manifests = (manifests_a, manifests_b)
+        records_a, records_b = reader_a.iter_sorted_records(), reader_b.iter_sorted_records()
+        if phase_stats is not None:
+            records_a, records_b = phase_stats.timed_iter('sort', records_a), phase_stats.timed_iter('sort', records_b)
+        events = SnapshotReader._merge_diff(records_a, records_b, compare_hashes, compare_extra)
+        if manifests is not None:
+            events = SnapshotReader._add_changed_ranges(events, *manifests, info_b.digest_size)
+        if phase_stats is None:
+            return events
+        return phase_stats.timed_iter('diff', events)
 
-        dict_a = {entry_key(e): e for e in entries_a}
-        dict_b = {entry_key(e): e for e in entries_b}
+    @staticmethod
+    def _add_changed_ranges(events, manifests_a, manifests_b, digest_size):
+        for event in events:
+            if event.kind == DIFF_MODIFIED:
+                path = event.new.path_bytes
+                old, new = manifests_a.get(path), manifests_b.get(path)
+                if old is not None and new is not None:
+                    event.changed_ranges = changed_ranges(old, new, digest_size)
+            yield event
 
-        added = [e for k, e in dict_b.items() if k not in dict_a]
-        removed = [e for k, e in dict_a.items() if k not in dict_b]
-        modified = []
-        for k in dict_a.keys() & dict_b.keys():
-            ea, eb = dict_a[k], dict_b[k]
-            if ea['hash'] != eb['hash'] or ea['size'] != eb['size'] or ea['time'] != eb['time']:
-                modified.append((ea, eb))
-        
+    @staticmethod
+    def compare_snapshots(snap_file_a, snap_file_b, compare_hashes=None, phase_stats:PhaseStats=None):
+        """
+        Compare two snapshot files and return the added, removed, and modified entries.
+        """
+        added, removed, modified = [], [], []
+        for event in SnapshotReader.iter_diff(snap_file_a, snap_file_b, compare_hashes, phase_stats):
+            if event.kind == DIFF_ADDED:
+                added.append(event.new)
+            elif event.kind == DIFF_REMOVED:
+                removed.append(event.old)
+            else:
+                modified.append((event.old, event.new))
         return added, removed, modified
+
+    @staticmethod
+    def print_diff(events, human = False, out = None):
+        """
+        Print diff events as they arrive, writing in batches, and return the
+        number of events of each kind as {DIFF_ADDED: n, DIFF_REMOVED: n, DIFF_MODIFIED: n}.
+        """
+        out = out if out is not None else sys.stdout
+        counts = {DIFF_ADDED: 0, DIFF_REMOVED: 0, DIFF_MODIFIED: 0}
+        lines = []
+        for event in events:
+            counts[event.kind] += 1
+            if event.kind == DIFF_MODIFIED:
+                line = f"* {SnapshotReader._get_diff_entry_string(event.old, event.new, human)}"
+                if event.changed_ranges is not None:
+                    line += f' changed="{SnapshotReader._get_ranges_string(event.changed_ranges, human)}"'
+                lines.append(line)
+            else:
+                lines.append(f"{event.kind} {SnapshotReader._get_entry_string(event.entry, human)}")
+            if len(lines) >= PRINT_BATCH_LINES:
+                out.write('\n'.join(lines) + '\n')
+                lines.clear()
+        if lines:
+            out.write('\n'.join(lines) + '\n')
+        out.flush()
+        return counts
         
     @staticmethod
     def print_snapshot_comparisons(added = None, removed = None, modified = None, human = False):
@@ -258,3 +2180,179 @@ class SnapshotReader:
             for ea, eb in modified:
                 print(f"* {SnapshotReader._get_diff_entry_string(ea, eb, human)}")
             print()
+
+def _reduce_changes(changes):
+    """
+    Sort (rel_path, recursive) changes in canonical order, dropping duplicates and those
+    under a recursive one.
+    """
+    reduced = {}
+    for rel_path, recursive in changes:
+        rel_path = bytes(rel_path)
+        reduced[rel_path] = reduced.get(rel_path, False) or bool(recursive)
+    result = []
+    tree_key = None
+    for rel_path, recursive in sorted(reduced.items(), key=lambda item: path_sort_key(item[0])):
+        key = path_sort_key(rel_path)
+        if tree_key is not None and key.startswith(tree_key):
+            continue
+        result.append((rel_path, recursive))
+        if recursive:
+            tree_key = key + b'\x00'
+    return result
+
+def _covered_by_changes(rel_path, changes):
+    for changed, recursive in changes:
+        if rel_path == changed or recursive and rel_path.startswith(changed + _PATH_SEP):
+            return True
+    return False
+
+def _replaced_file_mode(path:Path):
+    """
+    Permission bits for a file written over path: those of path, or the umask default for a new file.
+    """
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+class _IndexedFileRecords:
+    """
+    read_file_records() stand-in looking paths up through the index of the snapshot,
+    for a few lookups in a large snapshot.
+    """
+    def __init__(this, reader:SnapshotReader, stamp_fields=0):
+        this._buf = reader._map()
+        this._info = SnapshotReader._parse_header(this._buf)
+        this._stamp_names = extra_field_names(stamp_fields)
+
+    def get(this, rel_path, default=None):
+        r = SnapshotReader._find_record(this._buf, this._info, rel_path)
+        if r is None or r.type != ENTRY_TYPE_FILE:
+            return default
+        if this._stamp_names:
+            extra = r.extra
+            return r.size, r.time, r.hash, tuple(extra[name] for name in this._stamp_names)
+        return r.size, r.time, r.hash
+
+class SnapshotHashFiller:
+    """
+    Computes hashes left out by generate --no-hash and writes them into the
+    snapshot file in place: a record keeps its size, so each hash goes into its
+    slot, then the record's unhashed flag is cleared. An interrupted fill leaves
+    every record either hashed or still unhashed.
+    """
+    def __init__(this, snap_file, src_path, jobs=1, chunk_size=DEFAULT_HASH_CHUNK_SIZE):
+        this._snap_file = Path(snap_file)
+        # Recorded paths start with the name of the source directory
+        this._src_path = Path(src_path).resolve()
+        this._jobs = jobs if jobs > 0 else (os.cpu_count() or 1)
+        this._chunk_size = chunk_size
+        this.files_hashed = 0
+        this.hashes_reused = 0
+        # files whose size or time changed since the snapshot: left unhashed
+        this.files_skipped = 0
+
+    def fill(this, paths=None, min_size=0, changed_from=None):
+        """
+        Hash the unhashed files selected by all the given criteria: paths (as recorded,
+        found through the index), at least min_size bytes, and, with changed_from, files
+        that are new or have another size or time in that snapshot. Unchanged files
+        take their hash from changed_from instead when it has one.
+        """
+        this.files_hashed = this.hashes_reused = this.files_skipped = 0
+        with this._snap_file.open('r+b') as f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+            except ValueError:  # empty file
+                raise ValueError('Invalid snapshot file')
+        try:
+            this._fill(buf, paths, min_size, changed_from)
+            buf.flush()
+        finally:
+            buf.close()
+
+    def _fill(this, buf, paths, min_size, changed_from):
+        info = SnapshotReader._parse_header(buf)
+        if info.version == 1 or not info.flags & SNAPSHOT_FLAG_UNHASHED:
+            return
+        if info.compression is not None:
+            raise ValueError('Hashes can only be filled in snapshots without blocks (--compress)')
+        hasher = _FileHasher(get_hash_algorithm(info.hash_name), this._chunk_size)
+        records = SnapshotReader._iter_buffer(buf, info.records_start, info.records_end, info.digest_size, info.extra_fields,
+                                              info.version)
+        root = next(records, None)
+        if root is not None and this._src_path.name and root.path != this._src_path.name:
+            raise ValueError(f'Snapshot was not taken from {this._src_path}')
+        if paths:
+            records = []
+            for rel_path in paths:
+                record = SnapshotReader._find_record(buf, info, str(rel_path).encode('utf-8'))
+                if record is None:
+                    raise ValueError(f'Path not found in snapshot: {rel_path}')
+                records.append(record)
+        else:
+            records = itertools.chain([root], records) if root is not None else records
+        
+        base, base_hashes = None, False
+        if changed_from is not None:
+            base_reader = SnapshotReader(changed_from)
+            base_hashes = base_reader.read_info().hash_name == info.hash_name
+            base = base_reader.read_file_records()
+        
+        selected = []
+        left = 0
+        for r in records:
+            if r.type != ENTRY_TYPE_FILE or r.hash:
+                continue
+            if r.size < min_size:
+                left += 1
+                continue
+            if base is not None:
+                prev = base.get(r.path_bytes)
+                if prev is not None and prev[0] == r.size and prev[1] == r.time:
+                    if base_hashes and prev[2]:
+                        this._write_hash(buf, r, prev[2])
+                        this.hashes_reused += 1
+                    else:
+                        left += 1
+                    continue
+            selected.append(r)
+        
+        root_dir = this._src_path.parent
+        # Nanosecond times and inode, when recorded, tell rewrites within the same second
+        stamp_names = extra_field_names(info.extra_fields & EXTRA_FIELDS_STAMP)
+        def hash_record(r):
+            path = root_dir / r.path
+            try:
+                stat = path.stat()
+            except OSError:
+                return None
+            if stat.st_size != r.size or int(stat.st_mtime) != r.time:
+                return None
+            if stamp_names:
+                extra = r.extra
+                if any(getattr(stat, f'st_{name}') != extra[name] for name in stamp_names):
+                    return None
+            return hasher.hash(path)
+        with ThreadPoolExecutor(max_workers=this._jobs) as executor:
+            for r, hash_value in zip(selected, executor.map(hash_record, selected)):
+                if hash_value is None:
+                    logging.warning(f'Changed since the snapshot, not hashed: {r.path}')
+                    this.files_skipped += 1
+                    left += 1
+                    continue
+                this._write_hash(buf, r, hash_value)
+                this.files_hashed += 1
+        
+        if not paths and not left:
+            flags = info.flags & ~SNAPSHOT_FLAG_UNHASHED
+            buf[_SNAPSHOT_V2_FLAGS_OFFSET:_SNAPSHOT_V2_FLAGS_OFFSET + 4] = struct.pack('<I', flags)
+
+    @staticmethod
+    def _write_hash(buf, record:SnapshotRecord, hash_value):
+        hash_start = record._path_end + 16
+        buf[hash_start:record._hash_end] = hash_value
+        buf[record._start] &= ENTRY_TYPE_MASK
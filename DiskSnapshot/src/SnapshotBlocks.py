@@ -0,0 +1,99 @@
+import zlib
+import lzma
+import importlib
+import importlib.util
+
+# Front-coded snapshots keep their records in blocks that decode on their own:
+# block: raw_size(4) | stored_size(4) | record_count(4) | payload compressed with the file's codec
+# payload record: type(1) | shared | suffix_len | path suffix | size(8) | time(8) | hash(digest_size)
+# with shared and suffix_len as unsigned LEB128 varints, one byte each for most paths;
+# the path is the first `shared` bytes of the previous path in the block followed by the suffix.
+# Records come in walk (or canonical) order, where a directory precedes its entries,
+# so consecutive paths mostly share their directory. Only block files are front-coded;
+# plain v1/v2 records keep the full path after its length (see Snapshot.ENTRY_HEADER_FORMAT).
+BLOCK_HEADER_FORMAT = '<I I I'
+
+# Uncompressed bytes of records gathered per block
+DEFAULT_BLOCK_SIZE = 1 << 15
+
+class CompressionCodec:
+    """
+    Block compression of snapshot files. id is stored in the v2 header;
+    module names the optional package the codec comes from.
+    """
+    __slots__ = ('name', 'id', 'module', 'compress', 'decompress')
+
+    def __init__(this, name, codec_id, compress, decompress, module=None):
+        this.name = name
+        this.id = codec_id
+        this.module = module
+        this.compress = compress
+        this.decompress = decompress
+
+    def available(this):
+        return this.module is None or importlib.util.find_spec(this.module) is not None
+
+# Raw LZMA2 streams: the .xz container would add its headers to every block
+_LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6}]
+
+def _zstd_compress(data):
+    return importlib.import_module('zstandard').ZstdCompressor(level=3).compress(data)
+
+def _zstd_decompress(data):
+    return importlib.import_module('zstandard').ZstdDecompressor().decompress(data)
+
+COMPRESSION_CODECS = {codec.name: codec for codec in (
+    # Front-coded blocks stored as they are
+    CompressionCodec('none', 0, bytes, bytes),
+    CompressionCodec('zlib', 1, lambda data: zlib.compress(data, 6), zlib.decompress),
+    CompressionCodec('lzma', 2, lambda data: lzma.compress(data, lzma.FORMAT_RAW, filters=_LZMA_FILTERS),
+                     lambda data: lzma.decompress(data, lzma.FORMAT_RAW, filters=_LZMA_FILTERS)),
+    CompressionCodec('zstd', 3, _zstd_compress, _zstd_decompress, 'zstandard'),
+)}
+COMPRESSION_CODEC_IDS = {codec.id: codec for codec in COMPRESSION_CODECS.values()}
+
+def get_compression_codec(name):
+    """
+    Return the CompressionCodec called name; ValueError if it is unknown or its package is not installed.
+    """
+    codec = COMPRESSION_CODECS.get(name)
+    if codec is None:
+        raise ValueError(f'Unknown compression: {name}')
+    if not codec.available():
+        raise ValueError(f'Compression {name} needs the {codec.module} package (pip install {codec.module})')
+    return codec
+
+def shared_prefix_size(a:bytes, b:bytes):
+    """
+    Length of the common prefix of a and b, found by bisecting slice comparisons.
+    """
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]:
+        return n
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def append_varint(out:bytearray, value):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, pos):
+    """
+    Return the varint at pos and the position after it.
+    """
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
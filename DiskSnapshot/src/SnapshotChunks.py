@@ -0,0 +1,225 @@
+import zlib
+import struct
+import hashlib
+from SnapshotBlocks import append_varint, read_varint
+
+# Chunk manifests: generate --chunks splits large files into content-defined chunks
+# and records the length and digest of each one, so that compare can tell which
+# byte ranges of a modified file changed. Boundaries depend on the bytes around
+# them only, so an insertion moves the chunks after it instead of changing them all.
+#
+# Boundary search, in two stages running mostly in C:
+#  1. bytes are marked by CHUNK_MARKS (32 of the 256 byte values are), and every run of
+#     CHUNK_RUN or more marked bytes is a candidate, cut after its first CHUNK_RUN bytes:
+#     translate() and find() locate them, and the search goes on after the end of the
+#     run, so even crafted data gives at most one candidate per CHUNK_RUN + 1 bytes;
+#  2. a candidate is kept when the crc32 of the CHUNK_WINDOW bytes before the cut is
+#     below the threshold that gives the average chunk size.
+# Chunks are at least min_size and at most max_size bytes; the last one ends with the file.
+
+# Section between the index and the footer of files with SNAPSHOT_FLAG_CHUNKS:
+# avg_size(4) | min_size(4) | max_size(4) | manifest_count(8), then per file:
+# path_len (varint, as in records) | path(utf8) | chunk_count(4) | chunk_count x (length(4) | digest(digest_size))
+CHUNK_SECTION_HEADER_FORMAT = '<I I I Q'
+CHUNK_COUNT_FORMAT = '<I'
+
+CHUNK_RUN = 4
+CHUNK_WINDOW = 64
+# The byte values whose digest sorts first are marked: a fixed, spread out choice
+_MARKED = sorted(range(256), key=lambda value: hashlib.sha256(bytes([value])).digest())[:32]
+CHUNK_MARKS = bytes(1 if value in _MARKED else 0 for value in range(256))
+# share of random data where a candidate ends, about 1 in 4700 bytes
+_CANDIDATE_RATE = (7 / 8) * (1 / 8) ** CHUNK_RUN
+_CANDIDATE = b'\x01' * CHUNK_RUN
+
+DEFAULT_CHUNK_AVG_SIZE = 1 << 20
+# Files smaller than this get no manifest with a bare --chunks
+DEFAULT_CHUNK_MIN_FILE_SIZE = 64 << 20
+# Changed ranges listed per file by the text output of compare
+CHANGED_RANGES_SHOWN = 8
+
+_SECTION_HEADER_STRUCT = struct.Struct(CHUNK_SECTION_HEADER_FORMAT)
+_COUNT_STRUCT = struct.Struct(CHUNK_COUNT_FORMAT)
+_LENGTH_STRUCT = struct.Struct('<I')
+
+class ContentChunker:
+    """
+    Content-defined chunking parameters: chunks of about avg_size bytes on random data,
+    between avg_size / 4 and avg_size * 4. Files chunked with the same parameters
+    get the same boundaries around the same content.
+    """
+    __slots__ = ('avg_size', 'min_size', 'max_size', '_threshold')
+
+    def __init__(this, avg_size=DEFAULT_CHUNK_AVG_SIZE, min_size=None, max_size=None):
+        if avg_size < CHUNK_WINDOW * 4 or avg_size > 1 << 30:
+            raise ValueError(f'Invalid average chunk size: {avg_size}')
+        this.avg_size = avg_size
+        this.min_size = min_size if min_size is not None else avg_size // 4
+        this.max_size = max_size if max_size is not None else avg_size * 4
+        if not CHUNK_WINDOW <= this.min_size <= avg_size <= this.max_size < 1 << 32:
+            raise ValueError(f'Invalid chunk sizes: {this.min_size}, {avg_size}, {this.max_size}')
+        # Keeping this share of the candidates puts the first kept one about avg_size - min_size bytes in
+        this._threshold = min(1 << 32, int((1 << 32) / (_CANDIDATE_RATE * (avg_size - this.min_size))))
+
+    def params(this):
+        return this.avg_size, this.min_size, this.max_size
+
+    def __eq__(this, other):
+        return isinstance(other, ContentChunker) and this.params() == other.params()
+
+    def __hash__(this):
+        return hash(this.params())
+
+    def find_cut(this, data, marks, start, end, at_eof):
+        """
+        Return where the chunk starting at start ends, given data up to end and its marks;
+        None when more data is needed to tell.
+        """
+        if end - start <= this.max_size and not at_eof:
+            return None
+        limit = min(end, start + this.max_size)
+        pos = start + this.min_size - CHUNK_RUN
+        threshold = this._threshold
+        find = marks.find
+        view = memoryview(data)
+        while (i := find(_CANDIDATE, pos, limit)) != -1:
+            cut = i + CHUNK_RUN
+            if zlib.crc32(view[cut - CHUNK_WINDOW:cut]) < threshold:
+                return cut
+            # on to the end of the run
+            pos = find(b'\x00', cut, limit)
+            if pos == -1:
+                break
+        return limit
+
+    def hash_file(this, path, new_hasher, read_size=None, prefix=None):
+        """
+        Read the file at path once; return (digest of the whole file, manifest) with
+        digests made by new_hasher(). The manifest is the packed (length, digest) of each chunk.
+        prefix is the (size, digest, manifest) of an earlier, shorter version of the file: when the
+        file still starts with it, as a log or database that was appended to, the chunks of the
+        prefix are kept and only its last chunk and the bytes after it are chunked again; otherwise
+        the prefix is read a second time.
+        """
+        read_size = max(read_size or 0, this.max_size)
+        with open(path, 'rb', buffering=0) as f:
+            if prefix is not None:
+                result = this._hash_appended(f, new_hasher, read_size, *prefix)
+                if result is not None:
+                    return result
+                f.seek(0)
+            return this._hash_chunks(f, new_hasher, new_hasher(), bytearray(), read_size)
+
+    def _hash_appended(this, f, new_hasher, read_size, size, digest, manifest):
+        file_hasher = new_hasher()
+        entry_size = _LENGTH_STRUCT.size + file_hasher.digest_size
+        if not manifest or len(manifest) % entry_size:
+            return None
+        left = size
+        while left:
+            block = f.read(min(read_size, left))
+            if not block:
+                return None
+            file_hasher.update(block)
+            left -= len(block)
+        if file_hasher.copy().digest() != digest:
+            return None
+        # Every cut but the end of the file depends on the bytes before it only
+        last_length = _LENGTH_STRUCT.unpack_from(manifest, len(manifest) - entry_size)[0]
+        f.seek(size - last_length)
+        return this._hash_chunks(f, new_hasher, file_hasher, bytearray(manifest[:-entry_size]), read_size, last_length)
+
+    def _hash_chunks(this, f, new_hasher, file_hasher, manifest, read_size, hashed=0):
+        """
+        Chunk the rest of f into manifest; the first hashed bytes of it are already in file_hasher.
+        """
+        data = bytearray()
+        marks = bytearray()
+        start = 0
+        while True:
+            block = f.read(read_size)
+            at_eof = not block
+            if block:
+                if hashed < len(block):
+                    file_hasher.update(memoryview(block)[hashed:])
+                hashed = max(hashed - len(block), 0)
+                data += block
+                marks += block.translate(CHUNK_MARKS)
+            while start < len(data):
+                cut = this.find_cut(data, marks, start, len(data), at_eof)
+                if cut is None:
+                    break
+                chunk_hasher = new_hasher()
+                chunk_hasher.update(memoryview(data)[start:cut])
+                manifest += _LENGTH_STRUCT.pack(cut - start)
+                manifest += chunk_hasher.digest()
+                start = cut
+            if at_eof:
+                break
+            # Keep only the pending chunk
+            del data[:start]
+            del marks[:start]
+            start = 0
+        return file_hasher.digest(), bytes(manifest)
+
+def iter_manifest(manifest, digest_size):
+    """
+    Yield (offset, length, digest) of every chunk of a manifest.
+    """
+    entry_size = _LENGTH_STRUCT.size + digest_size
+    offset = 0
+    for pos in range(0, len(manifest), entry_size):
+        length = _LENGTH_STRUCT.unpack_from(manifest, pos)[0]
+        yield offset, length, manifest[pos + _LENGTH_STRUCT.size:pos + entry_size]
+        offset += length
+
+def changed_ranges(old_manifest, new_manifest, digest_size):
+    """
+    Return the (start, end) byte ranges of the new file holding chunks the old one did not have,
+    adjacent ranges merged.
+    """
+    old_digests = {digest for _, _, digest in iter_manifest(old_manifest, digest_size)}
+    ranges = []
+    for offset, length, digest in iter_manifest(new_manifest, digest_size):
+        if digest in old_digests:
+            continue
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], offset + length)
+        else:
+            ranges.append((offset, offset + length))
+    return ranges
+
+def write_chunk_section(f, chunker:ContentChunker, manifests, digest_size):
+    """
+    Write the chunk section of (rel_path, manifest) pairs, in the order given.
+    """
+    entry_size = _LENGTH_STRUCT.size + digest_size
+    f.write(_SECTION_HEADER_STRUCT.pack(*chunker.params(), len(manifests)))
+    for rel_path, manifest in manifests:
+        header = bytearray()
+        append_varint(header, len(rel_path))
+        f.write(header + rel_path + _COUNT_STRUCT.pack(len(manifest) // entry_size))
+        f.write(manifest)
+
+def read_chunk_section(buf, start, end, digest_size):
+    """
+    Return the ContentChunker and {rel_path: manifest} of the chunk section in buf[start:end].
+    """
+    if end - start < _SECTION_HEADER_STRUCT.size:
+        raise ValueError('Invalid snapshot file (chunk section missing)')
+    avg_size, min_size, max_size, count = _SECTION_HEADER_STRUCT.unpack_from(buf, start)
+    chunker = ContentChunker(avg_size, min_size, max_size)
+    entry_size = _LENGTH_STRUCT.size + digest_size
+    manifests = {}
+    pos = start + _SECTION_HEADER_STRUCT.size
+    for _ in range(count):
+        path_len, pos = read_varint(buf, pos)
+        rel_path = bytes(buf[pos:pos + path_len])
+        pos += path_len
+        chunk_count = _COUNT_STRUCT.unpack_from(buf, pos)[0]
+        pos += _COUNT_STRUCT.size
+        manifests[rel_path] = bytes(buf[pos:pos + chunk_count * entry_size])
+        pos += chunk_count * entry_size
+        if pos > end:
+            raise ValueError('Invalid snapshot file (truncated chunk section)')
+    return chunker, manifests
@@ -0,0 +1,286 @@
+import io
+import csv
+import json
+import mmap
+import struct
+from pathlib import Path
+from Snapshot import (SnapshotReader, SnapshotRecord, SnapshotFileWriter, DiffEvent, path_sort_key, entry_file_struct,
+                      extra_fields_struct, extra_field_names, DIFF_ADDED, DIFF_REMOVED, DIFF_MODIFIED, ENTRY_TYPE_NAMES,
+                      ENTRY_TYPE_MASK, ENTRY_FLAG_UNHASHED, EXTRA_FIELDS_KNOWN, HASH_ALGORITHMS,
+                      HASH_ALGORITHM_IDS, DEFAULT_HASH_ALGORITHM, PRINT_BATCH_LINES)
+from SnapshotBlocks import append_varint
+
+EXPORT_FORMATS = ('text', 'jsonl', 'csv', 'bin')
+
+# Binary diff: magic | header_size(2) | flags(4) | hash_algo(1) | digest_size(1) | extra_fields(4) | events...
+# event: kind(1, b'+' b'-' b'*') | record, as in snapshot files with the extra fields of the header's
+#        EXTRA_FIELD_* mask (the new entry, or the removed one)
+#        | for b'*' only: old type(1) | old size(8) | old time(8) | old hash(digest_size) | old extra fields,
+#        the type carrying ENTRY_FLAG_UNHASHED when the old file was not hashed
+DIFF_FILE_HEADER = b'DISKDIFF01'
+DIFF_HEADER_FORMAT = '<H I B B I'
+
+_KIND_CODES = {DIFF_ADDED: ord(DIFF_ADDED), DIFF_REMOVED: ord(DIFF_REMOVED), DIFF_MODIFIED: ord(DIFF_MODIFIED)}
+_CODE_KINDS = {code: kind for kind, code in _KIND_CODES.items()}
+
+CSV_COLUMNS = ('op', 'type', 'path', 'size', 'time', 'hash', 'old_size', 'old_time', 'old_hash')
+
+def _count(events, counts):
+    for event in events:
+        counts[event.kind] += 1
+        yield event
+
+def write_diff_jsonl(events, out:io.TextIOBase):
+    """
+    Write one JSON object per line; modified entries carry the new fields plus old_size, old_time and old_hash
+    (and old_<name> of the extra fields, e.g. old_nlink), and changed_ranges ([[start, end], ...]) when
+    the snapshots hold chunk manifests of the file. Return the count of each kind of event.
+    """
+    counts = {DIFF_ADDED: 0, DIFF_REMOVED: 0, DIFF_MODIFIED: 0}
+    lines = []
+    for event in _count(events, counts):
+        e = event.entry
+        line = '{"op":"%s","type":"%s","path":%s,"size":%d,"time":%d,"hash":"%s"' % (
+            event.kind, ENTRY_TYPE_NAMES.get(e['type'], 'UNKNOWN'), json.dumps(e['path'], ensure_ascii=False),
+            e['size'], e['time'], e['hash'].hex())
+        for name, value in SnapshotReader._get_extra(e).items():
+            line += ',"%s":%d' % (name, value)
+        if event.kind == DIFF_MODIFIED:
+            old = event.old
+            line += ',"old_size":%d,"old_time":%d,"old_hash":"%s"' % (old['size'], old['time'], old['hash'].hex())
+            for name, value in SnapshotReader._get_extra(old).items():
+                line += ',"old_%s":%d' % (name, value)
+            if event.changed_ranges is not None:
+                line += ',"changed_ranges":%s' % json.dumps(event.changed_ranges, separators=(',', ':'))
+        lines.append(line + '}\n')
+        if len(lines) >= PRINT_BATCH_LINES:
+            out.write(''.join(lines))
+            lines.clear()
+    out.write(''.join(lines))
+    out.flush()
+    return counts
+
+def csv_columns(extra_fields=0):
+    """
+    CSV_COLUMNS with a column per extra field of the EXTRA_FIELD_* mask after the hash and after
+    the old hash (old_<name>), then changed_ranges.
+    """
+    names = extra_field_names(extra_fields)
+    return CSV_COLUMNS[:6] + names + CSV_COLUMNS[6:] + tuple(f'old_{name}' for name in names) + ('changed_ranges',)
+
+def write_diff_csv(events, out:io.TextIOBase, extra_fields=0):
+    """
+    Write a CSV table with csv_columns(extra_fields); the old_* columns are only filled for modified entries,
+    extra fields only for entries that have them, and changed_ranges ([[start, end], ...]) as in write_diff_jsonl.
+    Return the count of each kind of event.
+    """
+    counts = {DIFF_ADDED: 0, DIFF_REMOVED: 0, DIFF_MODIFIED: 0}
+    names = extra_field_names(extra_fields)
+    writer = csv.writer(out)
+    writer.writerow(csv_columns(extra_fields))
+    rows = []
+    for event in _count(events, counts):
+        e = event.entry
+        row = [event.kind, ENTRY_TYPE_NAMES.get(e['type'], 'UNKNOWN'), e['path'], e['size'], e['time'], e['hash'].hex()]
+        extra = SnapshotReader._get_extra(e)
+        row += (extra.get(name, '') for name in names)
+        if event.kind == DIFF_MODIFIED:
+            old = event.old
+            row += (old['size'], old['time'], old['hash'].hex())
+            extra = SnapshotReader._get_extra(old)
+            row += (extra.get(name, '') for name in names)
+            row.append(json.dumps(event.changed_ranges, separators=(',', ':')) if event.changed_ranges is not None else '')
+        else:
+            row += ('',) * (4 + len(names))
+        rows.append(row)
+        if len(rows) >= PRINT_BATCH_LINES:
+            writer.writerows(rows)
+            rows.clear()
+    writer.writerows(rows)
+    out.flush()
+    return counts
+
+def write_diff_bin(events, out:io.BufferedIOBase, hash_name=DEFAULT_HASH_ALGORITHM, extra_fields=0):
+    """
+    Write the binary diff format read by DiffReader and apply_diff.
+    Both snapshots must hold hash_name hashes; extra_fields is the EXTRA_FIELD_* mask recorded
+    for every entry, those an entry does not have being recorded as 0.
+    Return the count of each kind of event.
+    """
+    counts = {DIFF_ADDED: 0, DIFF_REMOVED: 0, DIFF_MODIFIED: 0}
+    algo = HASH_ALGORITHMS[hash_name]
+    fields = entry_file_struct(algo.digest_size)
+    names = extra_field_names(extra_fields)
+    pack_extra = extra_fields_struct(extra_fields).pack
+
+    def pack_fields(e):
+        # type byte with ENTRY_FLAG_UNHASHED for a file that was not hashed, then size, time, hash and extra fields
+        entry_type, hash_value = e['type'], e['hash']
+        if not hash_value:
+            entry_type |= ENTRY_FLAG_UNHASHED if algo.digest_size else 0
+            hash_value = bytes(algo.digest_size)
+        return entry_type, fields.pack(e['size'], e['time'], hash_value) + pack_extra(*(e.get(name, 0) for name in names))
+
+    out.write(DIFF_FILE_HEADER)
+    out.write(struct.pack(DIFF_HEADER_FORMAT, struct.calcsize(DIFF_HEADER_FORMAT), 0, algo.id, algo.digest_size, extra_fields))
+    block = bytearray()
+    for event in _count(events, counts):
+        block.append(_KIND_CODES[event.kind])
+        e = event.entry
+        if isinstance(e, SnapshotRecord) and e.extra_fields == extra_fields:
+            block += e.raw_bytes
+        else:
+            rel_path = e.path_bytes if isinstance(e, SnapshotRecord) else e['path'].encode('utf-8')
+            entry_type, packed = pack_fields(e)
+            block.append(entry_type)
+            append_varint(block, len(rel_path))
+            block += rel_path
+            block += packed
+        if event.kind == DIFF_MODIFIED:
+            entry_type, packed = pack_fields(event.old)
+            block.append(entry_type)
+            block += packed
+        if len(block) >= 1 << 20:
+            out.write(block)
+            block.clear()
+    out.write(block)
+    out.flush()
+    return counts
+
+DIFF_WRITERS = {'jsonl': write_diff_jsonl, 'csv': write_diff_csv, 'bin': write_diff_bin}
+
+class DiffReader:
+    """
+    Reads the binary diff format. Events come back in the canonical path order they were written in.
+    """
+    def __init__(this, diff_file):
+        this._diff_file = Path(diff_file)
+
+    def _map(this):
+        """
+        Map the diff file and return (buf, events_start, hash_id, digest_size, extra_fields).
+        """
+        with this._diff_file.open('rb') as f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise ValueError('Invalid diff file')
+        header_size = struct.calcsize(DIFF_HEADER_FORMAT)
+        if buf[:len(DIFF_FILE_HEADER)] != DIFF_FILE_HEADER or len(buf) < len(DIFF_FILE_HEADER) + header_size:
+            buf.close()
+            raise ValueError('Invalid diff file')
+        size, _, hash_id, digest_size, extra_fields = struct.unpack_from(DIFF_HEADER_FORMAT, buf, len(DIFF_FILE_HEADER))
+        if size != header_size or extra_fields & ~EXTRA_FIELDS_KNOWN:
+            buf.close()
+            raise ValueError('Invalid diff file')
+        return buf, len(DIFF_FILE_HEADER) + header_size, hash_id, digest_size, extra_fields
+
+    def _read_header(this):
+        buf, _, hash_id, _, extra_fields = this._map()
+        buf.close()
+        return hash_id, extra_fields
+
+    def hash_name(this):
+        hash_id = this._read_header()[0]
+        algo = HASH_ALGORITHM_IDS.get(hash_id)
+        return algo.name if algo is not None else f'unknown-{hash_id}'
+
+    def extra_fields(this):
+        """
+        EXTRA_FIELD_* mask of the fields recorded for every entry.
+        """
+        return this._read_header()[1]
+
+    def iter_events(this, path_prefix = None):
+        """
+        Yield DiffEvents; only those whose path starts with path_prefix when given.
+        The new entry (or the removed one) is a SnapshotRecord view; the old side of a
+        modified entry is a dict.
+        """
+        buf, pos, _, digest_size, extra_fields = this._map()
+        fields = entry_file_struct(digest_size)
+        extra_struct = extra_fields_struct(extra_fields)
+        names = extra_field_names(extra_fields)
+        old_size = 1 + fields.size + extra_struct.size
+        prefix = path_prefix.encode('utf-8') if path_prefix else None
+
+        end = len(buf)
+        while pos < end:
+            kind = _CODE_KINDS.get(buf[pos])
+            if kind is None:
+                raise ValueError('Invalid diff file (unknown event)')
+            record = next(SnapshotReader._iter_buffer(buf, pos + 1, end, digest_size, extra_fields))
+            pos += 1 + len(record.raw_bytes)
+            old = None
+            if kind == DIFF_MODIFIED:
+                if pos + old_size > end:
+                    raise ValueError('Invalid diff file (truncated event)')
+                entry_type = buf[pos]
+                size, time, hash_value = fields.unpack_from(buf, pos + 1)
+                if entry_type & ENTRY_FLAG_UNHASHED:
+                    entry_type, hash_value = entry_type & ENTRY_TYPE_MASK, b''
+                old = {'type': entry_type, 'path': None, 'size': size, 'time': time, 'hash': hash_value}
+                old.update(zip(names, extra_struct.unpack_from(buf, pos + 1 + fields.size)))
+                pos += old_size
+            if prefix is not None and not record.path_bytes.startswith(prefix):
+                continue
+            if kind == DIFF_ADDED:
+                yield DiffEvent(kind, None, record)
+            elif kind == DIFF_REMOVED:
+                yield DiffEvent(kind, record, None)
+            else:
+                old['path'] = record.path
+                yield DiffEvent(kind, old, record)
+
+def apply_diff(snap_file, diff_file, dest_file):
+    """
+    Write to dest_file the snapshot obtained by applying a binary diff to snap_file.
+    Removed and modified entries must match the snapshot, otherwise ValueError is raised.
+    The result is a sorted, indexed v2 snapshot with the snapshot's extra fields, which
+    the diff must record too. Diffs do not carry chunk manifests: snapshots holding them are refused.
+    """
+    def plain_hash(hash_value):
+        # Files recorded without hashing, and entries without content, compare as having no hash
+        return hash_value if hash_value.strip(b'\0') else b''
+
+    def same(entry, expected):
+        return (entry['type'] == expected['type'] and entry['size'] == expected['size']
+                and entry['time'] == expected['time'] and plain_hash(entry['hash']) == plain_hash(expected['hash']))
+
+    reader, diff = SnapshotReader(snap_file), DiffReader(diff_file)
+    info = reader.read_info()
+    hash_name = info.hash_name
+    if diff.hash_name() != hash_name:
+        raise ValueError(f'Diff does not apply: it holds {diff.hash_name()} hashes, the snapshot {hash_name} hashes')
+    if diff.extra_fields() != info.extra_fields:
+        raise ValueError(f'Diff does not apply: it records extra fields 0x{diff.extra_fields():x}, '
+                         f'the snapshot 0x{info.extra_fields:x}')
+    if info.chunks_offset is not None:
+        raise ValueError('Diffs cannot be applied to snapshots with chunk manifests')
+    records = reader.iter_sorted_records()
+    events = diff.iter_events()
+    with Path(dest_file).open('wb') as f:
+        out = SnapshotFileWriter(f, sort_paths=True, hash_name=hash_name, extra_fields=info.extra_fields)
+        r = next(records, None)
+        e = next(events, None)
+        while r is not None or e is not None:
+            key_r = path_sort_key(r.path_bytes) if r is not None else None
+            key_e = path_sort_key(e.entry.path_bytes) if e is not None else None
+            if e is None or (r is not None and key_r < key_e):
+                out.write_entry(r)
+                r = next(records, None)
+            elif r is None or key_e < key_r:
+                if e.kind != DIFF_ADDED:
+                    raise ValueError(f'Diff does not apply: {e.entry.path} is not in the snapshot')
+                out.write_entry(e.new)
+                e = next(events, None)
+            elif e.kind == DIFF_ADDED:
+                raise ValueError(f'Diff does not apply: {e.entry.path} is already in the snapshot')
+            else:
+                if not same(r, e.old):
+                    raise ValueError(f'Diff does not apply: {r.path} differs from the snapshot')
+                if e.kind == DIFF_MODIFIED:
+                    out.write_entry(e.new)
+                r = next(records, None)
+                e = next(events, None)
+        out.finish()
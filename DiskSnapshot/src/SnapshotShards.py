@@ -0,0 +1,166 @@
+import os
+import time
+import heapq
+import shutil
+import itertools
+import tempfile
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from Snapshot import SnapshotReader, SnapshotWriter, SnapshotFileWriter, WriteStats, SNAPSHOT_FLAG_SHARD, path_sort_key
+
+# Sharded snapshots: generate --shard i/N records the root of the source and the
+# top-level entries shard_of() assigns to shard i. Shards can be taken by several
+# processes or hosts mounting the same tree; merge_snapshots() combines them.
+
+# Shards per worker process of ShardedSnapshotWriter: top-level entries are assigned
+# by name, so more shards than workers evens out the work
+SHARDS_PER_PROCESS = 4
+
+def merge_snapshots(shard_files, dest_file, compression=None):
+    """
+    Combine the shards of one snapshot into dest_file in a single pass over their records.
+    Sorted shards are merged into canonical order, others are concatenated by shard index.
+    Return the number of entries written.
+    """
+    shards = []
+    for snap_file in shard_files:
+        reader = SnapshotReader(snap_file)
+        info = reader.read_info()
+        if info.version != 2 or not info.flags & SNAPSHOT_FLAG_SHARD:
+            raise ValueError(f'Not a snapshot shard: {snap_file}')
+        shards.append((info.shard_index, info, reader, snap_file))
+    if not shards:
+        raise ValueError('No snapshot shards to merge')
+    shards.sort(key=lambda shard: shard[0])
+
+    shard_count = shards[0][1].shard_count
+    indexes = [index for index, *_ in shards]
+    if any(info.shard_count != shard_count for _, info, *_ in shards) or indexes != list(range(shard_count)):
+        raise ValueError(f'Shards {indexes} do not make up a snapshot of {shard_count} shards')
+    hash_names = {info.hash_name for _, info, *_ in shards}
+    if len(hash_names) != 1:
+        raise ValueError(f'Shards are hashed with different algorithms ({", ".join(sorted(hash_names))})')
+    extra_fields = {info.extra_fields for _, info, *_ in shards}
+    if len(extra_fields) != 1:
+        raise ValueError('Shards record different extra fields')
+    extra_fields = extra_fields.pop()
+    chunks = [reader.read_chunks() for _, _, reader, _ in shards]
+    if len({chunker for chunker, _ in chunks}) != 1:
+        raise ValueError('Shards were chunked differently (--chunks, --chunk-average)')
+    chunker = chunks[0][0]
+
+    # Every shard starts with the root record; the first one is kept
+    streams = []
+    root = None
+    for _, _, reader, snap_file in shards:
+        records = reader.iter_records()
+        first = next(records, None)
+        if first is None:
+            raise ValueError(f'Empty snapshot shard: {snap_file}')
+        if root is None:
+            root = first
+        elif (first.type, first.path_bytes) != (root.type, root.path_bytes):
+            raise ValueError(f'Shard {snap_file} was taken from another source ({first.path})')
+        streams.append(records)
+
+    sort_paths = all(info.is_sorted for _, info, *_ in shards)
+    if sort_paths:
+        records = heapq.merge(*streams, key=lambda r: path_sort_key(r.path_bytes))
+    else:
+        records = itertools.chain.from_iterable(streams)
+    with Path(dest_file).open('wb') as f:
+        out = SnapshotFileWriter(f, 2, sort_paths, hash_names.pop(), compression, extra_fields=extra_fields,
+                                 chunker=chunker)
+        records = itertools.chain([root], records)
+        if extra_fields:
+            out.write_records((r.type, r.path_bytes, r.size, r.time, r.hash, tuple(r.extra.values())) for r in records)
+        else:
+            out.write_records((r.type, r.path_bytes, r.size, r.time, r.hash) for r in records)
+        for _, manifests in chunks:
+            for rel_path, manifest in manifests.items():
+                out.add_chunk_manifest(rel_path, manifest)
+        out.finish()
+    return SnapshotReader(dest_file).read_info().entry_count
+
+def _write_shard(src_path, dest_file, shard, writer_args):
+    writer = SnapshotWriter(src_path, dest_file, shard=shard, **writer_args)
+    writer.write_snapshot()
+    return writer.stats
+
+class ShardedSnapshotWriter:
+    """
+    Takes a snapshot of src_path with one worker process per CPU (or processes):
+    shards are written by the workers into a temporary directory next to
+    dest_file, then merged into it. writer_args are passed to each SnapshotWriter.
+    progress is called with the WriteStats of the shards done so far as each one completes;
+    phase_stats times the 'base', 'shards' and 'merge' phases.
+    """
+    def __init__(this, src_path, dest_file, processes=0, compression=None, progress=None, phase_stats=None, **writer_args):
+        this._src_path = Path(src_path)
+        this._output_file = Path(dest_file)
+        this._processes = processes if processes > 0 else (os.cpu_count() or 1)
+        this._compression = compression
+        this._writer_args = writer_args
+        this._progress = progress
+        this.phase_stats = phase_stats
+        # (entries, bytes) expected, as for SnapshotWriter
+        this.expected_totals = None
+        this.files_hashed = 0
+        this.hashes_reused = 0
+        # Hard links are only shared within a shard: links in two shards are each hashed
+        this.hashes_linked = 0
+        this.stats = WriteStats()
+        # Fail here rather than in every worker
+        SnapshotWriter(src_path, dest_file, compression=compression, shard=(0, 1), **writer_args)
+
+    def precount(this):
+        return SnapshotWriter(this._src_path, this._output_file, **this._writer_args).precount()
+
+    def write_snapshot(this):
+        this.files_hashed = 0
+        this.hashes_reused = 0
+        this.hashes_linked = 0
+        expected = this.expected_totals
+        shard_count = min(this._processes * SHARDS_PER_PROCESS, 0xffff)
+        shard_args = [this._writer_args] * shard_count
+        if this._writer_args.get('base_file') is not None:
+            # The base is read once here and each worker given the records of its shard
+            if this.phase_stats is not None:
+                this.phase_stats.switch('base')
+            writer = SnapshotWriter(this._src_path, this._output_file, **this._writer_args)
+            totals = writer.read_base()
+            if expected is None:
+                expected = totals
+            parts = writer.base_parts(shard_count)
+            if parts is None:
+                shard_args = [dict(this._writer_args, base_file=None)] * shard_count
+            else:
+                shard_args = [dict(this._writer_args, base_part=part) for part in parts]
+        this.stats = stats = WriteStats(*(expected or ()))
+        tmp_dir = tempfile.mkdtemp(prefix=f'.{this._output_file.name}.', dir=this._output_file.parent)
+        if this.phase_stats is not None:
+            this.phase_stats.switch('shards')
+        try:
+            shard_files = [Path(tmp_dir) / f'{i}.snap' for i in range(shard_count)]
+            with ProcessPoolExecutor(max_workers=this._processes) as executor:
+                futures = [executor.submit(_write_shard, this._src_path, shard_file, (i, shard_count), shard_args[i])
+                           for i, shard_file in enumerate(shard_files)]
+                for future in futures:
+                    shard_stats = future.result()
+                    # Every shard records the root
+                    shard_stats.entries -= bool(stats.entries)
+                    stats.add(shard_stats)
+                    stats.elapsed = time.perf_counter() - stats.start
+                    if this._progress is not None:
+                        this._progress(stats)
+            this.files_hashed, this.hashes_reused, this.hashes_linked = stats.files_hashed, stats.hashes_reused, stats.hashes_linked
+            if this.phase_stats is not None:
+                this.phase_stats.switch('merge')
+            merge_snapshots(shard_files, this._output_file, this._compression)
+            stats.path = None
+            stats.elapsed = time.perf_counter() - stats.start
+            if this.phase_stats is not None:
+                for name in ('entries', 'files', 'files_hashed', 'bytes_hashed', 'hashes_reused', 'hashes_linked'):
+                    this.phase_stats.count(name, getattr(stats, name))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
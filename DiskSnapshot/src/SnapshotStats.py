@@ -0,0 +1,109 @@
+import json
+import itertools
+import threading
+from time import perf_counter
+
+# Phase timers of generate, view and compare (--stats): the main thread is always
+# in exactly one phase, so its phase times add up to the wall time; work done by
+# worker threads (parallel hashing) is summed apart, as it overlaps the main thread.
+
+class PhaseStats:
+    """
+    Time spent per phase and counters of one operation. Instrumented code switches
+    the current phase around the work it does and switches back afterwards, which
+    makes nested phases (reading inside sorting inside diffing) count exclusively.
+    """
+    def __init__(this, operation, phase='setup'):
+        this.operation = operation
+        this.seconds = {}
+        # phase -> seconds summed over worker threads
+        this.worker_seconds = {}
+        this.counters = {}
+        this.current = phase
+        this.start = this._since = perf_counter()
+        this.total = 0.0
+        this._lock = threading.Lock()
+
+    def switch(this, phase):
+        """
+        Make phase the current one; return the phase left, to switch back to.
+        """
+        now = perf_counter()
+        prev = this.current
+        this.seconds[prev] = this.seconds.get(prev, 0.0) + now - this._since
+        this.current, this._since = phase, now
+        return prev
+
+    def add_worker(this, phase, seconds):
+        with this._lock:
+            this.worker_seconds[phase] = this.worker_seconds.get(phase, 0.0) + seconds
+
+    def count(this, name, value=1):
+        this.counters[name] = this.counters.get(name, 0) + value
+
+    def timed_iter(this, phase, iterable):
+        """
+        Yield the items of iterable, counting the time spent producing each one to phase.
+        """
+        it = iter(iterable)
+        switch = this.switch
+        while True:
+            prev = switch(phase)
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                switch(prev)
+            yield item
+
+    def finish(this):
+        this.switch(this.current)
+        this.total = perf_counter() - this.start
+        return this
+
+    def to_dict(this):
+        return {
+            'operation': this.operation,
+            'total_seconds': this.total,
+            'phases': this.seconds,
+            'worker_phases': this.worker_seconds,
+            'counters': this.counters,
+        }
+
+    def write_json(this, out):
+        json.dump(this.to_dict(), out, indent=2)
+        out.write('\n')
+
+    def summary_lines(this):
+        total = this.total or 1e-9
+        lines = [f'{this.operation}: {this.total:.3f}s']
+        width = max(map(len, itertools.chain(this.seconds, this.worker_seconds)), default=0)
+        for phase, seconds in sorted(this.seconds.items(), key=lambda item: -item[1]):
+            lines.append(f'  {phase:<{width}}  {seconds:9.3f}s  {100 * seconds / total:5.1f}%')
+        for phase, seconds in sorted(this.worker_seconds.items(), key=lambda item: -item[1]):
+            lines.append(f'  {phase:<{width}}  {seconds:9.3f}s  in worker threads')
+        for name, value in this.counters.items():
+            lines.append(f'  {name}: {value:,}')
+        return lines
+
+class TimedFile:
+    """
+    File object wrapper counting the time spent in write() to a phase of stats, and the bytes written.
+    """
+    def __init__(this, f, stats:PhaseStats, phase='write'):
+        this._f = f
+        this._stats = stats
+        this._phase = phase
+
+    def write(this, data):
+        stats = this._stats
+        prev = stats.switch(this._phase)
+        try:
+            return this._f.write(data)
+        finally:
+            stats.switch(prev)
+            stats.count('bytes_written', len(data))
+
+    def __getattr__(this, name):
+        return getattr(this._f, name)
@@ -0,0 +1,243 @@
+import copy
+import struct
+from array import array
+from Snapshot import (SnapshotReader, SnapshotRecord, SnapshotTable, path_sort_key, ENTRY_TYPE_MASK,
+                      DIFF_ADDED, DIFF_REMOVED, DIFF_MODIFIED)
+from SnapshotBlocks import read_varint
+
+_SIZE_TIME_STRUCT = struct.Struct('<Q Q')
+
+def _row_typecode(count):
+    return 'I' if count < 1 << 32 else 'Q'
+
+class TableView:
+    """
+    Sorted and filtered window onto a SnapshotTable, for list widgets showing
+    millions of entries: the current order is a single array of table rows, so
+    sorting and filtering build no per-entry objects, and entries are only
+    materialized for the page a widget asks for.
+    """
+    SORT_KEYS = ('type', 'path', 'size', 'time')
+
+    def __init__(this, table:SnapshotTable):
+        this.table = table
+        this._init_rows(len(table))
+
+    def _init_rows(this, total):
+        # rows in the snapshot, shown or not
+        this.total = total
+        this.sort_key = None
+        this.reverse = False
+        this.prefix = ''
+        # every row, in sort order
+        this._order = array(_row_typecode(total), range(total))
+        # the rows of _order whose path starts with prefix
+        this._rows = this._order
+
+    def __len__(this):
+        return len(this._rows)
+
+    def copy(this):
+        """
+        View of the same table in the same order. sort() and filter() build new row arrays,
+        so sorting or filtering the copy leaves this view as it is.
+        """
+        return copy.copy(this)
+
+    def entry(this, index):
+        return this._row_entry(this._rows[index])
+
+    def _row_entry(this, row):
+        return this.table.entry(row)
+
+    def page(this, start, count):
+        """
+        Entries of the rows start to start + count in the current order.
+        """
+        return [this.entry(index) for index in range(max(0, start), min(start + count, len(this)))]
+
+    def _sort_key(this, key):
+        table = this.table
+        if key == 'path':
+            return lambda row: path_sort_key(table.path_bytes(row))
+        if key == 'size':
+            return table.sizes.__getitem__
+        if key == 'time':
+            return table.times.__getitem__
+        if key == 'type':
+            return table.types.__getitem__
+        raise ValueError(f'Unknown sort key: {key}')
+
+    def sort(this, key=None, reverse=False):
+        """
+        Order rows by one of SORT_KEYS (ties keep file order), or in file order when key is None.
+        """
+        rows = range(this.total)
+        if key is not None:
+            rows = sorted(rows, key=this._sort_key(key), reverse=reverse)
+        elif reverse:
+            rows = reversed(rows)
+        this._order = array(_row_typecode(this.total), rows)
+        this.sort_key, this.reverse = key, reverse
+        this._apply_filter()
+
+    def filter(this, prefix=''):
+        """
+        Only keep the rows whose path, as recorded, starts with prefix.
+        """
+        this.prefix = prefix
+        this._apply_filter()
+
+    def _apply_filter(this):
+        prefix = this.prefix.encode('utf-8')
+        if not prefix:
+            this._rows = this._order
+            return
+        # Compare in place in the path blob; the length check keeps a short
+        # path from matching through the bytes of the next one
+        paths, offsets = this.table.paths, this.table.path_offsets
+        size = len(prefix)
+        this._rows = array(this._order.typecode,
+                           (row for row in this._order
+                            if offsets[row + 1] - offsets[row] >= size and paths[offsets[row]:offsets[row] + size] == prefix))
+
+class RecordView(TableView):
+    """
+    TableView reading a snapshot file in place: rows are the offsets of its records in the
+    mapped file, and each entry is decoded when a page asks for it, so the snapshot is never
+    loaded. Block files hold no record offsets; open_view() loads those into a table instead.
+    """
+    def __init__(this, snap_file):
+        reader = SnapshotReader(snap_file)
+        buf = reader._map()
+        info = SnapshotReader._parse_header(buf)
+        if info.compression is not None:
+            raise ValueError('Records of block snapshots cannot be read in place')
+        this._buf = buf
+        this._info = info
+        fields_size = info.fields_size
+        v1 = info.version == 1
+        offsets = array('Q')
+        pos, end = info.records_start, info.records_end
+        while pos < end:
+            offsets.append(pos)
+            path_len = buf[pos + 1]
+            if v1:
+                path_len |= buf[pos + 2] << 8
+                pos += 3
+            elif path_len < 0x80:
+                pos += 2
+            else:
+                path_len, pos = read_varint(buf, pos + 1)
+            pos += path_len + fields_size
+        if pos != end:
+            raise ValueError('Invalid snapshot file (truncated record)')
+        this._offsets = offsets
+        this._init_rows(len(offsets))
+
+    def _record(this, row):
+        info = this._info
+        return next(SnapshotReader._iter_buffer(this._buf, this._offsets[row], info.records_end,
+                                                info.digest_size, info.extra_fields, info.version))
+
+    def _row_entry(this, row):
+        record = this._record(row)
+        return {'type': record.type, 'path': record.path, 'size': record.size, 'time': record.time, 'hash': record.hash}
+
+    def _path_span(this, row):
+        buf, pos = this._buf, this._offsets[row]
+        path_len = buf[pos + 1]
+        if this._info.version == 1:
+            path_len |= buf[pos + 2] << 8
+            pos += 3
+        elif path_len < 0x80:
+            pos += 2
+        else:
+            path_len, pos = read_varint(buf, pos + 1)
+        return pos, pos + path_len
+
+    def _sort_key(this, key):
+        buf = this._buf
+        if key == 'path':
+            def path_key(row):
+                start, end = this._path_span(row)
+                return path_sort_key(buf[start:end])
+            return path_key
+        if key in ('size', 'time'):
+            field = 0 if key == 'size' else 1
+            return lambda row: _SIZE_TIME_STRUCT.unpack_from(buf, this._path_span(row)[1])[field]
+        if key == 'type':
+            return lambda row: buf[this._offsets[row]] & ENTRY_TYPE_MASK
+        raise ValueError(f'Unknown sort key: {key}')
+
+    def _apply_filter(this):
+        prefix = this.prefix.encode('utf-8')
+        if not prefix:
+            this._rows = this._order
+            return
+        buf, size = this._buf, len(prefix)
+        def matches(row):
+            start, end = this._path_span(row)
+            return end - start >= size and buf[start:start + size] == prefix
+        this._rows = array(this._order.typecode, filter(matches, this._order))
+
+def open_view(snap_file):
+    """
+    View of a snapshot file: a RecordView, or a TableView of the loaded records for block files.
+    """
+    reader = SnapshotReader(snap_file)
+    if reader.read_info().compression is not None:
+        return TableView(reader.read_table())
+    return RecordView(snap_file)
+
+def _fields(entry, digest_size):
+    rel_path = entry.path_bytes if isinstance(entry, SnapshotRecord) else entry['path'].encode('utf-8')
+    hash_value = entry['hash']
+    # Snapshots compared without their hashes may hold digests of another size
+    if len(hash_value) != digest_size:
+        hash_value = b''
+    return entry['type'], rel_path, entry['size'], entry['time'], hash_value
+
+class DiffView(TableView):
+    """
+    TableView of the differences between two snapshots: each entry is the one of
+    the event (see DiffEvent.entry) with its 'op', and 'old' holds the previous
+    entry of modified ones (None for the others).
+    """
+    SORT_KEYS = ('op',) + TableView.SORT_KEYS
+
+    def __init__(this, events, hash_name, digest_size):
+        table = SnapshotTable(hash_name, digest_size)
+        # previous entries of modified rows, row -> row of old_table
+        this._old_table = SnapshotTable(hash_name, digest_size)
+        this._old_rows = {}
+        this.kinds = array('B')
+        this.counts = {DIFF_ADDED: 0, DIFF_REMOVED: 0, DIFF_MODIFIED: 0}
+        for event in events:
+            if event.kind == DIFF_MODIFIED:
+                this._old_rows[len(table)] = len(this._old_table)
+                this._old_table.append(*_fields(event.old, digest_size))
+            table.append(*_fields(event.entry, digest_size))
+            this.kinds.append(ord(event.kind))
+            this.counts[event.kind] += 1
+        super().__init__(table)
+
+    @classmethod
+    def from_snapshots(cls, snap_file_a, snap_file_b, compare_hashes=None):
+        info_a, info_b = SnapshotReader(snap_file_a).read_info(), SnapshotReader(snap_file_b).read_info()
+        events = SnapshotReader.iter_diff(snap_file_a, snap_file_b, compare_hashes)
+        # Unhashed entries have no hash: the wider digest holds both sides
+        return cls(events, info_b.hash_name, max(info_a.digest_size, info_b.digest_size))
+
+    def entry(this, index):
+        row = this._rows[index]
+        entry = this.table.entry(row)
+        entry['op'] = chr(this.kinds[row])
+        old_row = this._old_rows.get(row)
+        entry['old'] = this._old_table.entry(old_row) if old_row is not None else None
+        return entry
+
+    def _sort_key(this, key):
+        if key == 'op':
+            return this.kinds.__getitem__
+        return super()._sort_key(key)
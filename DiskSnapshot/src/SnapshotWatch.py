@@ -0,0 +1,400 @@
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import logging
+import threading
+import ctypes
+import ctypes.util
+from pathlib import Path
+from Snapshot import SnapshotWriter
+import utils
+
+# Watch mode: after one full snapshot, only the paths changes are reported for are looked
+# at again. An InotifyWatcher (Linux) turns filesystem events into (rel_path, recursive)
+# changes, a ChangeJournal keeps them on disk next to the snapshot, and
+# SnapshotWriter.write_update() applies them to it, reading only touched files.
+# Where inotify is missing (or out of watches), the tree is polled: each update is a full
+# walk with the snapshot as base, which still only reads files whose size or time changed.
+
+# Journal: magic, then per change: recursive(1) | path_len(2) | path (utf-8, as recorded)
+JOURNAL_MAGIC = b'DSNAPJNL'
+JOURNAL_ENTRY_FORMAT = '<B H'
+_JOURNAL_ENTRY_STRUCT = struct.Struct(JOURNAL_ENTRY_FORMAT)
+
+# Seconds between two updates of the snapshot (or polls), when there are changes
+DEFAULT_WATCH_INTERVAL = 60
+# Longest wait for events, so that stop and update requests are seen in time
+WATCH_WAKEUP_INTERVAL = 1.0
+
+# inotify(7)
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONTFOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                      | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONTFOLLOW)
+_INOTIFY_EVENT_STRUCT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 1 << 16
+
+class ChangeJournal:
+    """
+    On-disk list of the paths changed since the snapshot it goes with, as (rel_path, recursive)
+    pairs: recursive when everything below the path may have changed too. Each path is
+    written once (again if it becomes recursive), so the journal grows with the number
+    of paths touched, not of events.
+    """
+    def __init__(this, journal_file):
+        this._journal_file = Path(journal_file)
+        this._changes = {}
+        this._f = None
+
+    @staticmethod
+    def read(journal_file):
+        """
+        Return the changes of a journal file as {rel_path: recursive}.
+        """
+        data = Path(journal_file).read_bytes()
+        if data[:len(JOURNAL_MAGIC)] != JOURNAL_MAGIC:
+            raise ValueError('Invalid change journal')
+        changes = {}
+        pos = len(JOURNAL_MAGIC)
+        while pos + _JOURNAL_ENTRY_STRUCT.size <= len(data):
+            recursive, path_len = _JOURNAL_ENTRY_STRUCT.unpack_from(data, pos)
+            pos += _JOURNAL_ENTRY_STRUCT.size
+            if pos + path_len > len(data):
+                # Cut short by a crash while appending
+                break
+            rel_path = data[pos:pos + path_len]
+            changes[rel_path] = changes.get(rel_path, False) or bool(recursive)
+            pos += path_len
+        return changes
+
+    def open(this):
+        """
+        Open the journal, taking over the changes of an existing one.
+        """
+        if this._journal_file.exists():
+            this._changes = ChangeJournal.read(this._journal_file)
+            this._f = this._journal_file.open('ab')
+        else:
+            this._changes = {}
+            this._f = this._journal_file.open('wb')
+            this._f.write(JOURNAL_MAGIC)
+            this._f.flush()
+
+    def close(this):
+        if this._f is not None:
+            this._f.close()
+            this._f = None
+
+    def add(this, rel_path:bytes, recursive=False):
+        known = this._changes.get(rel_path)
+        if known is not None and (known or not recursive):
+            return
+        this._changes[rel_path] = recursive
+        this._f.write(_JOURNAL_ENTRY_STRUCT.pack(recursive, len(rel_path)) + rel_path)
+
+    def flush(this):
+        this._f.flush()
+
+    def changes(this):
+        return list(this._changes.items())
+
+    def clear(this):
+        """
+        Forget every change, once the snapshot is updated.
+        """
+        this._f.seek(len(JOURNAL_MAGIC))
+        this._f.truncate()
+        this._f.flush()
+        this._changes = {}
+
+    def __len__(this):
+        return len(this._changes)
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not available')
+    libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+    return libc
+
+class InotifyWatcher:
+    """
+    inotify watches on every directory of src_path the snapshot descends into (Linux);
+    read_changes() turns the pending events into (rel_path, recursive) changes, rel_path
+    as a snapshot records it (utf-8 str). OSError when inotify is missing or out of watches
+    (see fs.inotify.max_user_watches).
+    """
+    def __init__(this, src_path, ignore_hidden=False, max_rec_depth=-1):
+        this._src_path = Path(src_path)
+        this._ignore_hidden = ignore_hidden
+        this._max_rec_depth = max_rec_depth
+        this._rel_root = str(this._src_path.relative_to(this._src_path.parent))
+        this._libc = _load_libc()
+        this._fd = this._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if this._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # wd -> (rel_path, depth) of the watched directory, and rel_path -> wd
+        this._dirs = {}
+        this._wds = {}
+
+    def fileno(this):
+        return this._fd
+
+    def close(this):
+        if this._fd >= 0:
+            os.close(this._fd)
+            this._fd = -1
+
+    def _path(this, rel_path):
+        return this._src_path.parent / rel_path
+
+    def _add_watch(this, rel_path, depth):
+        wd = this._libc.inotify_add_watch(this._fd, os.fsencode(this._path(rel_path)), INOTIFY_WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # Gone or replaced by a file meanwhile: its parent's events cover it
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, f'inotify_add_watch: {os.strerror(err)}', str(this._path(rel_path)))
+        this._dirs[wd] = (rel_path, depth)
+        this._wds[rel_path] = wd
+
+    def add_tree(this, rel_path=None, depth=0):
+        """
+        Watch the directory rel_path (the root by default) and every directory below it
+        the snapshot descends into.
+        """
+        stack = [(rel_path if rel_path is not None else this._rel_root, depth)]
+        while stack:
+            rel_path, depth = stack.pop()
+            this._add_watch(rel_path, depth)
+            if this._max_rec_depth != -1 and depth >= this._max_rec_depth:
+                continue
+            try:
+                with os.scandir(this._path(rel_path)) as it:
+                    for entry in it:
+                        if this._ignore_hidden and utils.is_hidden(entry):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((os.path.join(rel_path, entry.name), depth + 1))
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def remove_tree(this, rel_path):
+        prefix = rel_path + os.sep
+        for path in [path for path in this._wds if path == rel_path or path.startswith(prefix)]:
+            wd = this._wds.pop(path)
+            del this._dirs[wd]
+            # Fails when the kernel already dropped it
+            this._libc.inotify_rm_watch(this._fd, wd)
+
+    def watch_count(this):
+        return len(this._dirs)
+
+    def read_changes(this):
+        """
+        Read the pending events; return the changes they report.
+        """
+        changes = []
+        while True:
+            try:
+                data = os.read(this._fd, INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, name_len = _INOTIFY_EVENT_STRUCT.unpack_from(data, pos)
+                pos += _INOTIFY_EVENT_STRUCT.size
+                name = os.fsdecode(data[pos:pos + name_len].rstrip(b'\0'))
+                pos += name_len
+                this._on_event(wd, mask, name, changes)
+        return changes
+
+    def _on_event(this, wd, mask, name, changes):
+        if mask & IN_Q_OVERFLOW:
+            logging.warning('Watch: inotify event queue overflowed, the whole tree will be looked at again')
+            changes.append((this._rel_root, True))
+            return
+        if mask & IN_IGNORED:
+            item = this._dirs.pop(wd, None)
+            if item is not None and this._wds.get(item[0]) == wd:
+                del this._wds[item[0]]
+            return
+        item = this._dirs.get(wd)
+        if item is None:
+            return
+        rel_path, depth = item
+        if not name:
+            # the watched directory itself
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # Reported by its parent, unless it is the root
+                if rel_path == this._rel_root:
+                    changes.append((rel_path, True))
+            elif mask & IN_ATTRIB:
+                changes.append((rel_path, False))
+            return
+        if this._ignore_hidden and name.startswith('.'):
+            return
+        if this._max_rec_depth != -1 and depth >= this._max_rec_depth:
+            # Only the directory is recorded, not what it holds
+            if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                changes.append((rel_path, False))
+            return
+        child = os.path.join(rel_path, name)
+        if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+            changes.append((rel_path, False))
+            changes.append((child, True))
+            if mask & IN_ISDIR:
+                this.remove_tree(child)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    this.add_tree(child, depth + 1)
+        elif mask & (IN_MODIFY | IN_ATTRIB):
+            changes.append((child, False))
+
+class SnapshotWatcher:
+    """
+    Keeps dest_file an up-to-date snapshot of src_path: a full snapshot first (with the
+    existing dest_file as base, so unchanged files are not read), then, every interval seconds
+    when there were changes, on request_update() and when stopped, an update of it for the
+    changes journaled meanwhile (dest_file + '.journal'). Without inotify, or with poll,
+    each update is a full walk instead. writer_args are passed to every SnapshotWriter;
+    snapshots are written sorted.
+    """
+    def __init__(this, src_path, dest_file, interval=DEFAULT_WATCH_INTERVAL, poll=False, **writer_args):
+        this._src_path = Path(src_path)
+        this._output_file = Path(dest_file)
+        this._interval = interval
+        this._poll = poll
+        this._writer_args = dict(writer_args, sort_paths=True)
+        this._journal = ChangeJournal(this._output_file.with_name(this._output_file.name + '.journal'))
+        this._stop = threading.Event()
+        this._update_requested = False
+        # Called with the writer after each snapshot written, e.g. to report it
+        this.on_update = None
+        this.updates = 0
+        # Fail here rather than after the first snapshot
+        SnapshotWriter(this._src_path, this._output_file, **this._writer_args)
+
+    def stop(this):
+        """
+        Stop run() after a last update; may be called from a signal handler or another thread.
+        """
+        this._stop.set()
+
+    def request_update(this):
+        this._update_requested = True
+
+    def _watch_tree(this):
+        if this._poll:
+            return None
+        try:
+            watcher = InotifyWatcher(this._src_path, this._writer_args.get('ignore_hidden', False),
+                                     this._writer_args.get('max_rec_depth', -1))
+        except OSError as e:
+            logging.warning(f'Watch: inotify unavailable ({e}), polling every {this._interval}s')
+            return None
+        try:
+            watcher.add_tree()
+        except OSError as e:
+            watcher.close()
+            logging.warning(f'Watch: cannot watch every directory ({e}; see fs.inotify.max_user_watches), '
+                            f'polling every {this._interval}s')
+            return None
+        logging.info(f'Watch: {watcher.watch_count():,} directories watched')
+        return watcher
+
+    def run(this):
+        # Watches first: changes made while the first snapshot is taken are journaled
+        watcher = this._watch_tree()
+        this._journal.open()
+        try:
+            this._write_full()
+            next_update = time.monotonic() + this._interval
+            while not this._stop.is_set():
+                timeout = max(0.0, min(WATCH_WAKEUP_INTERVAL, next_update - time.monotonic()))
+                if watcher is not None:
+                    try:
+                        ready, _, _ = select.select([watcher], [], [], timeout)
+                    except InterruptedError:
+                        ready = ()
+                    if ready:
+                        for rel_path, recursive in watcher.read_changes():
+                            this._journal.add(rel_path.encode('utf-8'), recursive)
+                        this._journal.flush()
+                else:
+                    this._stop.wait(timeout)
+                if this._update_requested or time.monotonic() >= next_update:
+                    this._update_requested = False
+                    next_update = time.monotonic() + this._interval
+                    try:
+                        this._update(watcher)
+                    except OSError as e:
+                        # e.g. a file removed while being hashed: the journal is kept for the next try
+                        logging.warning(f'Watch: update failed ({e}), trying again in {this._interval}s')
+            if watcher is not None:
+                for rel_path, recursive in watcher.read_changes():
+                    this._journal.add(rel_path.encode('utf-8'), recursive)
+                this._journal.flush()
+                try:
+                    this._update(watcher)
+                except Exception as e:
+                    # The journal is not cleared: the next run applies it
+                    logging.warning(f'Watch: last update failed ({e}), its changes are kept in the journal')
+        finally:
+            if watcher is not None:
+                watcher.close()
+            this._journal.close()
+
+    def _update(this, watcher):
+        if watcher is None:
+            this._write_full()
+        elif len(this._journal):
+            changes = this._journal.changes()
+            writer = SnapshotWriter(this._src_path, this._output_file, base_file=this._output_file, **this._writer_args)
+            writer.write_update(changes)
+            logging.info(f'Watch: {len(changes):,} changed paths applied, {writer.files_hashed:,} files hashed '
+                         f'in {writer.stats.elapsed:.2f}s')
+            this._journal.clear()
+            this._updated(writer)
+
+    def _write_full(this):
+        """
+        Take a full snapshot, with the current one as base; the journal is then empty.
+        """
+        base_file = this._output_file if this._output_file.exists() else None
+        tmp_file = this._output_file.with_name(f'.{this._output_file.name}.new')
+        writer = SnapshotWriter(this._src_path, tmp_file, base_file=base_file, **this._writer_args)
+        try:
+            writer.write_snapshot()
+            os.replace(tmp_file, this._output_file)
+        except BaseException:
+            tmp_file.unlink(missing_ok=True)
+            raise
+        logging.info(f'Watch: full snapshot of {writer.stats.entries:,} entries, {writer.files_hashed:,} files hashed '
+                     f'in {writer.stats.elapsed:.2f}s')
+        this._journal.clear()
+        this._updated(writer)
+
+    def _updated(this, writer):
+        this.updates += 1
+        if this.on_update is not None:
+            this.on_update(writer)
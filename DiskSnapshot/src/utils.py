@@ -15,12 +15,30 @@ def time_to_string_human(time):
     import datetime
     return datetime.datetime.fromtimestamp(time).strftime('%Y-%m-%d %H:%M:%S')
 
+def hash_file(path, hasher, buffer):
+    """
+    Feed the file at path into hasher through the preallocated buffer.
+    Memory use is bounded by len(buffer) no matter how big the file is.
+    """
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while n := f.readinto(view):
+            hasher.update(view[:n])
+    return hasher
+
 def is_hidden(path):
-    path = Path(path)
-    if path.name.startswith('.') and path.name not in ('.', '..'):
+    """
+    path may be a str, a Path or an os.DirEntry; a DirEntry is answered
+    from its cached stat, so no extra syscall is made while walking.
+    """
+    name = path.name if isinstance(path, (Path, os.DirEntry)) else os.path.basename(path)
+    if name.startswith('.') and name not in ('.', '..'):
         return True
     # Windows
-    if path.name.startswith('.') or \
-       (path.exists() and bool(os.stat(path).st_file_attributes & stat.FILE_ATTRIBUTE_HIDDEN)):
-        return True
+    if os.name == 'nt':
+        try:
+            st = path.stat(follow_symlinks=False) if isinstance(path, os.DirEntry) else os.lstat(path)
+        except OSError:
+            return False
+        return bool(st.st_file_attributes & stat.FILE_ATTRIBUTE_HIDDEN)
     return False
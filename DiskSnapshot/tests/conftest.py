@@ -0,0 +1,139 @@
+import os
+import sys
+import random
+import hashlib
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+from Snapshot import (SnapshotWriter, SnapshotReader, HASH_ALGORITHMS, ENTRY_TYPE_FILE, ENTRY_TYPE_DIR, ENTRY_TYPE_SYMLINK,
+                      SNAPSHOT_FLAG_INDEXED, path_sort_key)
+
+# Chunking parameters small enough for the big file of the test tree to get a manifest
+CHUNK_ARGS = dict(chunk_min_file_size=64 << 10, chunk_avg_size=4096)
+
+def make_tree(root:Path):
+    rnd = random.Random(0)
+    (root / 'sub' / 'deep').mkdir(parents=True)
+    (root / 'empty').mkdir()
+    (root / 'a.txt').write_bytes(b'hello\n')
+    (root / 'zero.bin').write_bytes(b'')
+    (root / 'ünïcöde.txt').write_bytes('été'.encode('utf-8'))
+    (root / 'sub' / 'b.bin').write_bytes(rnd.randbytes(10000))
+    (root / 'sub' / 'deep' / 'c.txt').write_bytes(b'c' * 3000)
+    (root / 'sub' / 'big.bin').write_bytes(rnd.randbytes(300 << 10))
+    for i in range(40):
+        (root / 'sub' / f'f{i:02}.dat').write_bytes(rnd.randbytes(i * 37))
+    if hasattr(os, 'symlink'):
+        try:
+            os.symlink(os.path.join('sub', 'b.bin'), root / 'link')
+            os.symlink('nowhere', root / 'broken')
+        except OSError:  # e.g. Windows without the privilege
+            pass
+    return root
+
+@pytest.fixture
+def tree(tmp_path):
+    return make_tree(tmp_path / 'tree')
+
+def take(src, dest, **writer_args):
+    """
+    Write a snapshot of src to dest and return dest.
+    """
+    SnapshotWriter(src, dest, **writer_args).write_snapshot()
+    return dest
+
+def expected_entries(tree:Path):
+    """
+    {path: (type, size, time, sha256 or None)} of tree, walked with pathlib as the old recursive writer did.
+    """
+    entries = {}
+    def walk(path):
+        rel_path = path.relative_to(tree.parent).as_posix().replace('/', os.sep)
+        if path.is_file():
+            st = path.stat()
+            entries[rel_path] = (ENTRY_TYPE_FILE, st.st_size, int(st.st_mtime), hashlib.sha256(path.read_bytes()).digest())
+        elif path.is_symlink():
+            entries[rel_path] = (ENTRY_TYPE_SYMLINK, 0, 0, None)
+        elif path.is_dir():
+            entries[rel_path] = (ENTRY_TYPE_DIR, 0, int(path.stat().st_mtime), None)
+            for child in path.iterdir():
+                walk(child)
+    walk(tree)
+    return entries
+
+def change_tree(tree:Path):
+    """
+    Add, remove and modify entries of a tree made by make_tree, in the middle of big.bin too.
+    Return the changes as a ChangeJournal records them: (rel_path as utf-8 bytes, recursive) pairs.
+    """
+    def rel(path):
+        return str(path.relative_to(tree.parent)).encode('utf-8')
+    # Times far from those of make_tree, so that no change hides within a second
+    later = (2_000_000_000, 2_000_000_000)
+    changes = []
+    (tree / 'a.txt').write_bytes(b'hello, world\n')
+    os.utime(tree / 'a.txt', later)
+    changes.append((rel(tree / 'a.txt'), False))
+    big = tree / 'sub' / 'big.bin'
+    data = bytearray(big.read_bytes())
+    data[150000:150100] = bytes(100)
+    big.write_bytes(data)
+    os.utime(big, later)
+    changes.append((rel(big), False))
+    (tree / 'sub' / 'f03.dat').unlink()
+    changes.append((rel(tree / 'sub' / 'f03.dat'), False))
+    for path in sorted((tree / 'sub' / 'deep').iterdir()):
+        path.unlink()
+    (tree / 'sub' / 'deep').rmdir()
+    changes.append((rel(tree / 'sub' / 'deep'), True))
+    (tree / 'new' / 'inner').mkdir(parents=True)
+    (tree / 'new' / 'inner' / 'x.txt').write_bytes(b'x')
+    changes.append((rel(tree / 'new'), True))
+    for path in (tree / 'sub', tree):
+        os.utime(path, later)
+        changes.append((rel(path), False))
+    return changes
+
+def entries_by_path(snap_file):
+    return {e['path']: e for e in SnapshotReader(snap_file).read_snapshot()}
+
+def check_roundtrip(tree:Path, snap_file, writer_args, flags):
+    """
+    Check that snap_file, taken of tree with writer_args, reads back as expected_entries(tree), the
+    same through read_snapshot, iter_records and read_table. flags are the header flags it must have
+    besides SNAPSHOT_FLAG_INDEXED, None for a version 1 file. Return the entries read.
+    """
+    reader = SnapshotReader(snap_file)
+    info = reader.read_info()
+    if flags is None:
+        assert info.version == 1
+    else:
+        assert info.version == 2 and info.flags == SNAPSHOT_FLAG_INDEXED | flags
+
+    algo = HASH_ALGORITHMS[writer_args.get('hash_name', 'sha256')]
+    expected = expected_entries(tree)
+    entries = reader.read_snapshot()
+    assert sorted(e['path'] for e in entries) == sorted(expected)
+    for e in entries:
+        entry_type, size, time, sha256 = expected[e['path']]
+        assert (e['type'], e['size'], e['time']) == (entry_type, size, time)
+        if entry_type != ENTRY_TYPE_FILE:
+            continue
+        if not writer_args.get('hash_files', True):
+            assert e['hash'] == b''
+        elif algo.name == 'sha256':
+            assert e['hash'] == sha256
+        else:
+            assert len(e['hash']) == algo.digest_size
+    if writer_args.get('sort_paths'):
+        keys = [path_sort_key(e['path'].encode('utf-8')) for e in entries]
+        assert keys == sorted(keys)
+
+    # Every reader agrees
+    assert [r.to_dict() for r in reader.iter_records()] == entries
+    table = reader.read_table()
+    assert [{k: table.entry(row)[k] for k in ('type', 'path', 'size', 'time')} for row in range(len(table))] == \
+           [{k: e[k] for k in ('type', 'path', 'size', 'time')} for e in entries]
+    return entries
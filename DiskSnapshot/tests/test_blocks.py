@@ -0,0 +1,28 @@
+import pytest
+
+from conftest import take, check_roundtrip
+from Snapshot import SnapshotReader, SnapshotFileWriter, SNAPSHOT_FLAG_BLOCKS, SNAPSHOT_FLAG_SORTED
+from SnapshotBlocks import COMPRESSION_CODECS
+
+@pytest.mark.parametrize('compression', [name for name, codec in COMPRESSION_CODECS.items() if codec.available()])
+@pytest.mark.parametrize('sort_paths', [False, True])
+def test_blocks_roundtrip(tree, tmp_path, compression, sort_paths):
+    writer_args = dict(compression=compression, sort_paths=sort_paths)
+    snap_file = take(tree, tmp_path / f'{compression}.snap', **writer_args)
+    check_roundtrip(tree, snap_file, writer_args, SNAPSHOT_FLAG_BLOCKS | (SNAPSHOT_FLAG_SORTED if sort_paths else 0))
+    assert SnapshotReader(snap_file).read_info().codec.name == compression
+
+def test_small_blocks(tree, tmp_path):
+    # A few records per block: front-coding starts again with each block
+    plain = take(tree, tmp_path / 'plain.snap')
+    blocked = tmp_path / 'blocked.snap'
+    with blocked.open('wb') as f:
+        out = SnapshotFileWriter(f, compression='zlib', block_size=64)
+        for r in SnapshotReader(plain).iter_records():
+            out.write_entry(r)
+        out.finish()
+    reader = SnapshotReader(blocked)
+    assert sum(1 for _ in SnapshotReader._iter_blocks(reader._map(), reader.read_info())) > 10
+    assert reader.read_snapshot() == SnapshotReader(plain).read_snapshot()
+    for e in reader.read_snapshot():
+        assert reader.lookup(e['path']) == e
@@ -0,0 +1,72 @@
+import io
+import os
+import json
+import random
+import hashlib
+
+from conftest import CHUNK_ARGS, take, change_tree, check_roundtrip
+from Snapshot import SnapshotReader, SNAPSHOT_FLAG_CHUNKS
+from SnapshotChunks import ContentChunker
+from SnapshotDiff import write_diff_jsonl
+
+def rel(*parts):
+    return os.path.join('tree', *parts)
+
+def test_chunks_roundtrip(tree, tmp_path):
+    check_roundtrip(tree, take(tree, tmp_path / 'chunks.snap', **CHUNK_ARGS), CHUNK_ARGS, SNAPSHOT_FLAG_CHUNKS)
+
+def test_chunk_manifests(tree, tmp_path):
+    snap_file = take(tree, tmp_path / 'chunks.snap', **CHUNK_ARGS)
+    chunker, manifests = SnapshotReader(snap_file).read_chunks()
+    assert chunker.avg_size == CHUNK_ARGS['chunk_avg_size']
+    big = next(path for path in manifests if path.endswith(b'big.bin'))
+    assert list(manifests) == [big]
+    # length(4) | digest(32) per chunk, the lengths adding up to the file
+    manifest = manifests[big]
+    lengths = [int.from_bytes(manifest[i:i + 4], 'little') for i in range(0, len(manifest), 36)]
+    assert sum(lengths) == (tree.parent / big.decode('utf-8')).stat().st_size
+    assert len(lengths) > 1
+
+def test_changed_ranges(tree, tmp_path):
+    a = take(tree, tmp_path / 'a.snap', **CHUNK_ARGS)
+    change_tree(tree)
+    b = take(tree, tmp_path / 'b.snap', **CHUNK_ARGS)
+    events = {e.entry['path']: e for e in SnapshotReader.iter_diff(a, b)}
+    ranges = events[rel('sub', 'big.bin')].changed_ranges
+    # The zeroed bytes lie in the changed ranges, which leave most of the file alone
+    assert ranges and any(start <= 150000 and 150100 <= end for start, end in ranges)
+    assert sum(end - start for start, end in ranges) < 64 << 10
+    assert events[rel('a.txt')].changed_ranges is None
+
+    out = io.StringIO()
+    write_diff_jsonl(SnapshotReader.iter_diff(a, b), out)
+    lines = {line['path']: line for line in map(json.loads, out.getvalue().splitlines())}
+    assert lines[rel('sub', 'big.bin')]['changed_ranges'] == [list(r) for r in ranges]
+
+def test_appended_file(tree, tmp_path):
+    chunker = ContentChunker(CHUNK_ARGS['chunk_avg_size'])
+    big = tree / 'sub' / 'big.bin'
+    old_size = big.stat().st_size
+    old = chunker.hash_file(big, hashlib.sha256)
+    base = take(tree, tmp_path / 'base.snap', **CHUNK_ARGS)
+    with big.open('ab') as f:
+        f.write(random.Random(1).randbytes(100 << 10))
+    new = chunker.hash_file(big, hashlib.sha256)
+
+    hashers = []
+    def new_hasher():
+        hashers.append(hashlib.sha256())
+        return hashers[-1]
+    assert chunker.hash_file(big, new_hasher, prefix=(old_size, *old)) == new
+    # The file and the chunks from the last one of the prefix on
+    assert len(hashers) == 1 + len(new[1]) // 36 - (len(old[1]) // 36 - 1)
+
+    # Later runs with --base chunk the same way
+    assert SnapshotReader(take(tree, tmp_path / 'appended.snap', base_file=base, **CHUNK_ARGS)).read_chunks() == \
+           SnapshotReader(take(tree, tmp_path / 'full.snap', **CHUNK_ARGS)).read_chunks()
+
+    # A file that does not start with the prefix any more is read again
+    data = bytearray(big.read_bytes())
+    data[1000] ^= 1
+    big.write_bytes(data)
+    assert chunker.hash_file(big, hashlib.sha256, prefix=(old_size, *old)) == chunker.hash_file(big, hashlib.sha256)
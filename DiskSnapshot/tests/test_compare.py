@@ -0,0 +1,26 @@
+import os
+
+from conftest import take, change_tree
+from Snapshot import SnapshotReader, DIFF_ADDED, DIFF_REMOVED, DIFF_MODIFIED
+
+def rel(*parts):
+    return os.path.join('tree', *parts)
+
+def test_diff_events(tree, tmp_path):
+    a = take(tree, tmp_path / 'a.snap')
+    change_tree(tree)
+    b = take(tree, tmp_path / 'b.snap', compression='zlib')
+    events = {e.entry['path']: e.kind for e in SnapshotReader.iter_diff(a, b)}
+    assert events == {
+        rel('a.txt'): DIFF_MODIFIED,
+        rel('sub', 'big.bin'): DIFF_MODIFIED,
+        rel('sub', 'f03.dat'): DIFF_REMOVED,
+        rel('sub', 'deep'): DIFF_REMOVED,
+        rel('sub', 'deep', 'c.txt'): DIFF_REMOVED,
+        rel('new'): DIFF_ADDED,
+        rel('new', 'inner'): DIFF_ADDED,
+        rel('new', 'inner', 'x.txt'): DIFF_ADDED,
+        rel('sub'): DIFF_MODIFIED,
+        rel(): DIFF_MODIFIED,
+    }
+    assert SnapshotReader.compare_snapshots(b, take(tree, tmp_path / 'c.snap', version=1)) == ([], [], [])
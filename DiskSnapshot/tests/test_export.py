@@ -0,0 +1,67 @@
+import io
+import csv
+import json
+
+import pytest
+
+from conftest import CHUNK_ARGS, take, change_tree, entries_by_path
+from Snapshot import SnapshotReader, DIFF_ADDED, DIFF_REMOVED, DIFF_MODIFIED, EXTRA_FIELDS_STAT
+from SnapshotDiff import write_diff_bin, write_diff_csv, write_diff_jsonl, apply_diff, csv_columns, DiffReader
+
+@pytest.mark.parametrize('writer_args', [dict(), dict(sort_paths=True), dict(compression='zlib'), dict(hash_name='blake2b'),
+                                         dict(hash_files=False), dict(sort_paths=True, extra_fields=EXTRA_FIELDS_STAT)])
+def test_apply_binary_diff(tree, tmp_path, writer_args):
+    a = take(tree, tmp_path / 'a.snap', **writer_args)
+    change_tree(tree)
+    b = take(tree, tmp_path / 'b.snap', **writer_args)
+    diff_file = tmp_path / 'a-b.diff'
+    info = SnapshotReader(a).read_info()
+    with diff_file.open('wb') as f:
+        counts = write_diff_bin(SnapshotReader.iter_diff(a, b), f, info.hash_name, info.extra_fields)
+    assert counts == {DIFF_ADDED: 3, DIFF_REMOVED: 3, DIFF_MODIFIED: 4}
+    assert sum(1 for _ in DiffReader(diff_file).iter_events()) == 10
+
+    applied = tmp_path / 'applied.snap'
+    apply_diff(a, diff_file, applied)
+    assert entries_by_path(applied) == entries_by_path(b)
+    if writer_args.get('sort_paths'):
+        assert applied.read_bytes() == b.read_bytes()
+
+    # The diff only applies to the snapshot it was taken from
+    with pytest.raises(ValueError):
+        apply_diff(b, diff_file, tmp_path / 'wrong.snap')
+
+def test_apply_needs_matching_snapshot(tree, tmp_path):
+    a = take(tree, tmp_path / 'a.snap', extra_fields=EXTRA_FIELDS_STAT)
+    change_tree(tree)
+    b = take(tree, tmp_path / 'b.snap', extra_fields=EXTRA_FIELDS_STAT)
+    diff_file = tmp_path / 'a-b.diff'
+    with diff_file.open('wb') as f:
+        write_diff_bin(SnapshotReader.iter_diff(a, b), f)
+    # The diff does not record the extra fields of the snapshot
+    with pytest.raises(ValueError):
+        apply_diff(a, diff_file, tmp_path / 'applied.snap')
+    # Nor the chunk manifests
+    chunked = take(tree, tmp_path / 'c.snap', **CHUNK_ARGS)
+    with diff_file.open('wb') as f:
+        write_diff_bin(SnapshotReader.iter_diff(chunked, chunked), f)
+    with pytest.raises(ValueError):
+        apply_diff(chunked, diff_file, tmp_path / 'applied.snap')
+
+def test_csv_matches_jsonl(tree, tmp_path):
+    writer_args = dict(extra_fields=EXTRA_FIELDS_STAT, **CHUNK_ARGS)
+    a = take(tree, tmp_path / 'a.snap', **writer_args)
+    change_tree(tree)
+    b = take(tree, tmp_path / 'b.snap', **writer_args)
+    out = io.StringIO()
+    write_diff_jsonl(SnapshotReader.iter_diff(a, b), out)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    out = io.StringIO()
+    write_diff_csv(SnapshotReader.iter_diff(a, b), out, EXTRA_FIELDS_STAT)
+    rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+    assert tuple(rows[0]) == csv_columns(EXTRA_FIELDS_STAT)
+    assert len(rows) == len(lines) == 10
+    for row, line in zip(rows, lines):
+        assert {k: v for k, v in row.items() if v != ''} == \
+               {k: json.dumps(v, separators=(',', ':')) if k == 'changed_ranges' else str(v) for k, v in line.items()}
+    assert any(line.get('changed_ranges') for line in lines)
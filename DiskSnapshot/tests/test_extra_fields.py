@@ -0,0 +1,12 @@
+from conftest import take, check_roundtrip
+from Snapshot import SnapshotReader, ENTRY_TYPE_FILE, EXTRA_FIELDS_STAT, SNAPSHOT_FLAG_EXTRA_FIELDS
+
+def test_extra_fields_roundtrip(tree, tmp_path):
+    writer_args = dict(extra_fields=EXTRA_FIELDS_STAT)
+    snap_file = take(tree, tmp_path / 'extra.snap', **writer_args)
+    for e in check_roundtrip(tree, snap_file, writer_args, SNAPSHOT_FLAG_EXTRA_FIELDS):
+        if e['type'] != ENTRY_TYPE_FILE:
+            continue
+        st = (tree.parent / e['path']).stat()
+        assert (e['ino'], e['nlink'], e['mtime_ns'], e['mode']) == (st.st_ino, st.st_nlink, st.st_mtime_ns, st.st_mode)
+    assert SnapshotReader(snap_file).read_info().extra_fields == EXTRA_FIELDS_STAT
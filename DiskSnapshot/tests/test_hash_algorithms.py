@@ -0,0 +1,28 @@
+import pytest
+
+from conftest import take, check_roundtrip
+from Snapshot import SnapshotReader, HASH_ALGORITHMS, SNAPSHOT_FILE_HEADER_V2, SNAPSHOT_FLAG_HASH_ALGO
+
+@pytest.mark.parametrize('hash_name', [name for name, algo in HASH_ALGORITHMS.items() if name != 'sha256' and algo.available()])
+def test_hash_algorithm_roundtrip(tree, tmp_path, hash_name):
+    writer_args = dict(hash_name=hash_name)
+    snap_file = take(tree, tmp_path / f'{hash_name}.snap', **writer_args)
+    check_roundtrip(tree, snap_file, writer_args, SNAPSHOT_FLAG_HASH_ALGO)
+    info = SnapshotReader(snap_file).read_info()
+    assert (info.hash_name, info.digest_size) == (hash_name, HASH_ALGORITHMS[hash_name].digest_size)
+
+def test_compare_needs_same_algorithm(tree, tmp_path):
+    a = take(tree, tmp_path / 'a.snap')
+    b = take(tree, tmp_path / 'b.snap', hash_name='blake2b')
+    with pytest.raises(ValueError):
+        list(SnapshotReader.iter_diff(a, b))
+    # By size and time only, nothing changed
+    assert list(SnapshotReader.iter_diff(a, b, compare_hashes=False)) == []
+
+def test_header_size_must_match(tree, tmp_path):
+    snap_file = take(tree, tmp_path / 'a.snap', hash_name='blake2b')
+    data = bytearray(snap_file.read_bytes())
+    data[len(SNAPSHOT_FILE_HEADER_V2)] -= 1
+    snap_file.write_bytes(data)
+    with pytest.raises(ValueError):
+        SnapshotReader(snap_file).read_info()
@@ -0,0 +1,18 @@
+import os
+
+import pytest
+
+from conftest import take
+from Snapshot import SnapshotReader, EXTRA_FIELDS_STAT
+
+@pytest.mark.parametrize('writer_args', [
+    dict(version=1), dict(), dict(sort_paths=True), dict(hash_files=False), dict(compression='zlib'),
+    dict(extra_fields=EXTRA_FIELDS_STAT),
+])
+def test_lookup(tree, tmp_path, writer_args):
+    reader = SnapshotReader(take(tree, tmp_path / 'a.snap', **writer_args))
+    entries = reader.read_snapshot()
+    for e in entries:
+        assert reader.lookup(e['path']) == e
+    assert reader.lookup(os.path.join('tree', 'missing')) is None
+    assert reader.read_info().entry_count == (None if writer_args.get('version') == 1 else len(entries))
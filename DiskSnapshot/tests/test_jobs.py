@@ -0,0 +1,13 @@
+import pytest
+
+from conftest import CHUNK_ARGS, take
+from Snapshot import EXTRA_FIELDS_LINKS, EXTRA_FIELDS_STAT
+
+@pytest.mark.parametrize('writer_args', [
+    dict(version=1), dict(), dict(sort_paths=True), dict(compression='zlib'),
+    dict(extra_fields=EXTRA_FIELDS_LINKS | EXTRA_FIELDS_STAT), dict(**CHUNK_ARGS),
+])
+def test_jobs_byte_identical(tree, tmp_path, writer_args):
+    serial = take(tree, tmp_path / 'serial.snap', **writer_args)
+    parallel = take(tree, tmp_path / 'parallel.snap', jobs=4, **writer_args)
+    assert parallel.read_bytes() == serial.read_bytes()
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+from conftest import take
+from Snapshot import SnapshotWriter, SnapshotReader, EXTRA_FIELDS_LINKS
+
+@pytest.mark.skipif(not hasattr(os, 'link'), reason='hard links')
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_hard_links_hashed_once(tree, tmp_path, jobs):
+    for i in range(3):
+        os.link(tree / 'sub' / 'big.bin', tree / f'big{i}.bin')
+    writer = SnapshotWriter(tree, tmp_path / 'a.snap', jobs=jobs, extra_fields=EXTRA_FIELDS_LINKS)
+    writer.write_snapshot()
+    assert writer.hashes_linked == 3
+    entries = {e['path']: e for e in SnapshotReader(tmp_path / 'a.snap').read_snapshot()}
+    big = entries[os.path.join('tree', 'sub', 'big.bin')]
+    for i in range(3):
+        link = entries[os.path.join('tree', f'big{i}.bin')]
+        assert (link['hash'], link['ino'], link['nlink']) == (big['hash'], big['ino'], 4)
+    # Hashing each inode once records what hashing every link does
+    assert take(tree, tmp_path / 'b.snap', jobs=jobs, extra_fields=EXTRA_FIELDS_LINKS).read_bytes() == \
+           (tmp_path / 'a.snap').read_bytes()
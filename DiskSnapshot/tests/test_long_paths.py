@@ -0,0 +1,38 @@
+import pytest
+
+from Snapshot import SnapshotReader, SnapshotFileWriter, ENTRY_TYPE_DIR, ENTRY_TYPE_FILE, V1_MAX_PATH_SIZE
+from SnapshotTableView import open_view
+
+# Path lengths around the one-, two- and three-byte varints, and past what a v1 record holds
+PATHS = [b'root'] + [b'root/' + b'p' * n for n in (122, 123, 300, 16400, V1_MAX_PATH_SIZE + 10)]
+
+def write_paths(snap_file, **writer_args):
+    with snap_file.open('wb') as f:
+        out = SnapshotFileWriter(f, **writer_args)
+        out.write_record(ENTRY_TYPE_DIR, PATHS[0], 0, 1, bytes(32))
+        for i, rel_path in enumerate(PATHS[1:]):
+            out.write_record(ENTRY_TYPE_FILE, rel_path, i, 2, bytes([i]) * 32 if i % 2 else b'')
+        out.finish()
+    return snap_file
+
+@pytest.mark.parametrize('writer_args', [dict(), dict(sort_paths=True), dict(compression='zlib')])
+def test_long_paths(tmp_path, writer_args):
+    snap_file = write_paths(tmp_path / 'a.snap', **writer_args)
+    reader = SnapshotReader(snap_file)
+    entries = reader.read_snapshot()
+    assert sorted(e['path'].encode('utf-8') for e in entries) == sorted(PATHS)
+    assert [r.to_dict() for r in reader.iter_records()] == entries
+    table = reader.read_table()
+    assert [table.path_bytes(row) for row in range(len(table))] == [e['path'].encode('utf-8') for e in entries]
+    for e in entries:
+        assert reader.lookup(e['path']) == e
+    view = open_view(snap_file)
+    view.sort('path')
+    assert [e['path'] for e in view.page(0, view.total)] == sorted(e['path'] for e in entries)
+
+def test_v1_path_limit(tmp_path):
+    with (tmp_path / 'a.snap').open('wb') as f:
+        out = SnapshotFileWriter(f, version=1)
+        out.write_record(ENTRY_TYPE_FILE, PATHS[-2], 0, 1, bytes(32))
+        with pytest.raises(ValueError, match='Path too long'):
+            out.write_record(ENTRY_TYPE_FILE, PATHS[-1], 0, 1, bytes(32))
@@ -0,0 +1,39 @@
+import pytest
+
+from conftest import CHUNK_ARGS, take, change_tree, entries_by_path, expected_entries
+from Snapshot import SnapshotWriter, ENTRY_TYPE_FILE
+from SnapshotShards import ShardedSnapshotWriter, merge_snapshots
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_shards_merge_to_full_snapshot(tree, tmp_path, compression):
+    full = take(tree, tmp_path / 'full.snap', sort_paths=True, compression=compression)
+    shard_files = [take(tree, tmp_path / f'{i}.snap', sort_paths=True, shard=(i, 3)) for i in range(3)]
+    merged = tmp_path / 'merged.snap'
+    assert merge_snapshots(shard_files, merged, compression) == len(expected_entries(tree))
+    assert merged.read_bytes() == full.read_bytes()
+
+def test_sharded_writer(tree, tmp_path):
+    full = take(tree, tmp_path / 'full.snap', sort_paths=True)
+    sharded = tmp_path / 'sharded.snap'
+    ShardedSnapshotWriter(tree, sharded, processes=2, sort_paths=True).write_snapshot()
+    assert sharded.read_bytes() == full.read_bytes()
+
+def test_sharded_writer_with_base(tree, tmp_path):
+    base = take(tree, tmp_path / 'base.snap', sort_paths=True, **CHUNK_ARGS)
+    change_tree(tree)
+    full = take(tree, tmp_path / 'full.snap', sort_paths=True, **CHUNK_ARGS)
+    # Each shard is given the base records of its top-level entries only
+    parts = SnapshotWriter(tree, full, sort_paths=True, base_file=base, **CHUNK_ARGS)
+    parts.read_base()
+    parts = parts.base_parts(8)
+    records = entries_by_path(base)
+    assert sorted(p for part, _ in parts for p in part) == sorted(p.encode('utf-8') for p, e in records.items() if e['type'] == ENTRY_TYPE_FILE)
+    assert sum(len(manifests) for _, manifests in parts) == 1
+
+    sharded = tmp_path / 'sharded.snap'
+    writer = ShardedSnapshotWriter(tree, sharded, processes=2, sort_paths=True, base_file=base, **CHUNK_ARGS)
+    writer.write_snapshot()
+    assert sharded.read_bytes() == full.read_bytes()
+    # a.txt and big.bin changed and x.txt is new; f03.dat and c.txt are gone
+    assert writer.files_hashed == 3
+    assert writer.hashes_reused == sum(1 for e in records.values() if e['type'] == ENTRY_TYPE_FILE) - 4
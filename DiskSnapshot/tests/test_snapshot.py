@@ -0,0 +1,54 @@
+import os
+import hashlib
+
+import pytest
+
+from conftest import take, entries_by_path, check_roundtrip, expected_entries
+from Snapshot import SnapshotHashFiller, ENTRY_TYPE_FILE, SNAPSHOT_FLAG_SORTED, SNAPSHOT_FLAG_UNHASHED
+
+# generate options -> header flags they set, besides SNAPSHOT_FLAG_INDEXED
+FORMATS = {
+    'v1': (dict(version=1), None),
+    'v2': (dict(), 0),
+    'sorted': (dict(sort_paths=True), SNAPSHOT_FLAG_SORTED),
+    'no-hash': (dict(hash_files=False), SNAPSHOT_FLAG_UNHASHED),
+}
+
+@pytest.mark.parametrize('name', FORMATS)
+def test_generate_read_roundtrip(tree, tmp_path, name):
+    writer_args, flags = FORMATS[name]
+    check_roundtrip(tree, take(tree, tmp_path / f'{name}.snap', **writer_args), writer_args, flags)
+
+def test_fill_hashes(tree, tmp_path):
+    hashed = entries_by_path(take(tree, tmp_path / 'hashed.snap'))
+    snap_file = take(tree, tmp_path / 'fast.snap', hash_files=False)
+
+    filler = SnapshotHashFiller(snap_file, tree)
+    filler.fill(min_size=5000)
+    entries = entries_by_path(snap_file)
+    for path, e in entries.items():
+        if e['type'] == ENTRY_TYPE_FILE:
+            assert e['hash'] == (hashed[path]['hash'] if e['size'] >= 5000 else b'')
+
+    filler.fill()
+    assert entries_by_path(snap_file) == hashed
+    assert filler.files_hashed == sum(1 for e in hashed.values() if e['type'] == ENTRY_TYPE_FILE and e['size'] < 5000)
+
+def test_fill_hashes_from_baseline(tree, tmp_path):
+    base = take(tree, tmp_path / 'base.snap')
+    (tree / 'a.txt').write_bytes(b'changed contents\n')
+    snap_file = take(tree, tmp_path / 'fast.snap', hash_files=False)
+    filler = SnapshotHashFiller(snap_file, tree)
+    filler.fill(changed_from=base)
+    # Only the changed file is read again
+    assert filler.files_hashed == 1
+    entries = entries_by_path(snap_file)
+    assert entries[os.path.join('tree', 'a.txt')]['hash'] == hashlib.sha256(b'changed contents\n').digest()
+    assert entries == entries_by_path(take(tree, tmp_path / 'hashed.snap'))
+
+def test_relative_source(tree, tmp_path, monkeypatch):
+    # The current directory is recorded as '.', not as the filesystem root
+    monkeypatch.chdir(tree)
+    entries = entries_by_path(take('.', tmp_path / 'dot.snap'))
+    assert sorted(entries) == sorted('.' + path[len('tree'):] for path in expected_entries(tree))
+    assert entries[os.path.join('.', 'a.txt')]['size'] == 6
@@ -0,0 +1,97 @@
+import os
+import sys
+import stat
+
+import pytest
+
+from conftest import CHUNK_ARGS, take, change_tree
+from Snapshot import SnapshotWriter, EXTRA_FIELDS_LINKS, EXTRA_FIELDS_STAT
+from SnapshotWatch import ChangeJournal, SnapshotWatcher
+
+UPDATE_ARGS = {
+    'default': dict(),
+    'jobs': dict(jobs=4),
+    'zlib': dict(compression='zlib'),
+    'hash-none': dict(hash_name='none'),
+    'no-hash': dict(hash_files=False),
+    'extra': dict(extra_fields=EXTRA_FIELDS_LINKS | EXTRA_FIELDS_STAT),
+    'chunks': dict(**CHUNK_ARGS),
+}
+
+@pytest.mark.parametrize('name', UPDATE_ARGS)
+def test_update_matches_fresh_snapshot(tree, tmp_path, name):
+    writer_args = dict(sort_paths=True, **UPDATE_ARGS[name])
+    snap_file = take(tree, tmp_path / 'a.snap', **writer_args)
+    changes = change_tree(tree)
+    writer = SnapshotWriter(tree, snap_file, base_file=snap_file, **writer_args)
+    writer.write_update(changes)
+    fresh = take(tree, tmp_path / 'fresh.snap', **writer_args)
+    assert snap_file.read_bytes() == fresh.read_bytes()
+    # Only the files under the changes were looked at again
+    if writer_args.get('hash_files', True) and writer_args.get('hash_name') != 'none':
+        assert writer.files_hashed == 3
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith('.')] == []
+
+def test_update_from_journal(tree, tmp_path):
+    snap_file = take(tree, tmp_path / 'a.snap', sort_paths=True)
+    journal = ChangeJournal(tmp_path / 'a.journal')
+    journal.open()
+    for rel_path, recursive in change_tree(tree):
+        journal.add(rel_path, recursive)
+        # Repeats of a path are recorded once
+        journal.add(rel_path)
+    journal.close()
+    # A journal reopened after a restart keeps the changes
+    journal = ChangeJournal(tmp_path / 'a.journal')
+    journal.open()
+    SnapshotWriter(tree, snap_file, base_file=snap_file, sort_paths=True).write_update(journal.changes())
+    journal.clear()
+    assert len(journal) == 0
+    journal.close()
+    assert ChangeJournal.read(tmp_path / 'a.journal') == {}
+    assert snap_file.read_bytes() == take(tree, tmp_path / 'fresh.snap', sort_paths=True).read_bytes()
+
+@pytest.mark.skipif(os.name != 'posix', reason='permission bits')
+def test_update_keeps_file_mode(tree, tmp_path):
+    snap_file = take(tree, tmp_path / 'a.snap', sort_paths=True)
+    snap_file.chmod(0o640)
+    SnapshotWriter(tree, snap_file, base_file=snap_file, sort_paths=True).write_update(change_tree(tree))
+    assert stat.S_IMODE(snap_file.stat().st_mode) == 0o640
+
+def test_update_needs_matching_writer(tree, tmp_path):
+    snap_file = take(tree, tmp_path / 'a.snap', sort_paths=True)
+    with pytest.raises(ValueError):
+        SnapshotWriter(tree, snap_file, base_file=snap_file).write_update([])
+    with pytest.raises(ValueError):
+        SnapshotWriter(tree, snap_file, base_file=snap_file, sort_paths=True, hash_name='blake2b').write_update([])
+    with pytest.raises(ValueError):
+        SnapshotWriter(tree, snap_file, sort_paths=True).write_update([])
+
+def test_update_skips_what_the_walk_skips(tree, tmp_path):
+    writer_args = dict(sort_paths=True, ignore_hidden=True, max_rec_depth=2)
+    (tree / '.hidden').mkdir()
+    (tree / '.hidden' / 'x.txt').write_bytes(b'x')
+    snap_file = take(tree, tmp_path / 'a.snap', **writer_args)
+    # Changes under a hidden directory or beyond max_rec_depth are not recorded either
+    (tree / '.hidden' / 'y.txt').write_bytes(b'y')
+    (tree / '.hidden' / 'inner').mkdir()
+    (tree / 'sub' / 'deep' / 'c.txt').write_bytes(b'changed')
+    changes = [(os.path.join('tree', *parts).encode('utf-8'), recursive)
+               for parts, recursive in ((('.hidden', 'y.txt'), False), (('.hidden', 'inner'), True),
+                                        (('sub', 'deep', 'c.txt'), False), (('sub', 'deep'), True))]
+    SnapshotWriter(tree, snap_file, base_file=snap_file, **writer_args).write_update(changes)
+    assert snap_file.read_bytes() == take(tree, tmp_path / 'fresh.snap', **writer_args).read_bytes()
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify')
+def test_watch_keeps_journal_when_last_update_fails(tree, tmp_path, monkeypatch):
+    snap_file = tmp_path / 'a.snap'
+    watcher = SnapshotWatcher(tree, snap_file)
+    def change(writer):
+        (tree / 'a.txt').write_bytes(b'changed while stopping')
+        watcher.stop()
+    def fail(writer, changes):
+        raise OSError('disk full')
+    watcher.on_update = change
+    monkeypatch.setattr(SnapshotWriter, 'write_update', fail)
+    watcher.run()
+    assert ChangeJournal.read(tmp_path / 'a.snap.journal') == {os.path.join('tree', 'a.txt').encode('utf-8'): False}
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from conftest import take, change_tree
+from Snapshot import SnapshotReader, EXTRA_FIELDS_STAT
+from SnapshotTableView import TableView, RecordView, DiffView, open_view
+
+@pytest.mark.parametrize('writer_args', [dict(version=1), dict(), dict(hash_files=False), dict(extra_fields=EXTRA_FIELDS_STAT)])
+def test_record_view_matches_table_view(tree, tmp_path, writer_args):
+    snap_file = take(tree, tmp_path / 'a.snap', **writer_args)
+    view = open_view(snap_file)
+    assert isinstance(view, RecordView)
+    table_view = TableView(SnapshotReader(snap_file).read_table())
+    assert view.total == table_view.total
+    for key in (None,) + TableView.SORT_KEYS:
+        for reverse in (False, True):
+            for prefix in ('', os.path.join('tree', 'sub', 'f')):
+                for v in (view, table_view):
+                    v.sort(key, reverse)
+                    v.filter(prefix)
+                assert view.page(0, view.total) == table_view.page(0, table_view.total)
+    assert len(view) == 40
+
+def test_block_files_open_as_table(tree, tmp_path):
+    view = open_view(take(tree, tmp_path / 'a.snap', compression='zlib'))
+    assert type(view) is TableView
+    assert view.page(0, 1)[0]['path'] == 'tree'
+
+def test_diff_view(tree, tmp_path):
+    a = take(tree, tmp_path / 'a.snap')
+    change_tree(tree)
+    view = DiffView.from_snapshots(a, take(tree, tmp_path / 'b.snap'))
+    view.sort('op')
+    assert view.total == 10
+    assert [e['op'] for e in view.page(0, 10)] == sorted(e['op'] for e in view.page(0, 10))
+    modified = [e for e in view.page(0, 10) if e['op'] == '*']
+    assert all(e['old'] is not None for e in modified)
+
+def test_copy_leaves_view_alone(tree, tmp_path):
+    snap_file = take(tree, tmp_path / 'a.snap')
+    for view in (open_view(snap_file), TableView(SnapshotReader(snap_file).read_table())):
+        before = view.page(0, view.total)
+        other = view.copy()
+        other.sort('size', True)
+        other.filter(os.path.join('tree', 'sub'))
+        assert view.page(0, view.total) == before
+        assert (view.sort_key, view.prefix, len(view)) == (None, '', view.total)
+        assert len(other) < view.total and other.sort_key == 'size'